@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the flickr_insert plugin
+
+Run with 'python bench_flickr_insert.py [benchmark ...]'; see --help for
+the options.  Use --json to write machine-readable results
+
+"""
+import argparse
+import configparser
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pelican import ArticlesGenerator
+import flickr_insert
+
+# Filler paragraph placed between tags in synthetic documents
+FILLER = "<p>" + "Lorem ipsum dolor sit amet, consectetur adipiscing. " * 8 + \
+         "</p>\n"
+
+BENCHMARKS = ['substitution', 'scanning', 'tag_parsing', 'rendering',
+              'cache_io', 'cache_memory', 'build']
+
+# The tag pattern as it was before the scanner: greedy, to the line's
+#  last ']'
+GREEDY_FLICKR_REGEX = re.compile(r'<p>\s*(\[flickr:(.*)\])\s*</p>',
+                                 re.IGNORECASE)
+
+
+# A stand-in for a Pelican article or page
+class BenchDocument(object):
+    def __init__(self, content):
+        self._content = content
+
+
+# A stand-in for a Pelican generator with a ready flickr_insert context
+class BenchGenerator(object):
+    def __init__(self, cache):
+        cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'])
+        self.settings = {'FLICKR_INSERT_CACHE_CFG': cache_cfg}
+        self.context = dict(self.settings)
+        self.context['flickr_insert_ctx'] = {
+            'cache_cfg': cache_cfg,
+            'template': flickr_insert.Template(
+                flickr_insert.DEFAULT_TEMPLATE),
+        }
+        self.cache = cache
+
+
+def make_photo_ids(count):
+    return [str(16010503393 + n) for n in range(count)]
+
+
+def make_cache(photo_ids, cur_time=0):
+    return {pic_id: {
+        'pic_id': pic_id,
+        'title': 'Photo ' + pic_id,
+        'insert_image_url_base':
+            'https://farm9.staticflickr.com/8579/' + pic_id + '_7cfe88c078_',
+        'last_changed': cur_time,
+        'last_updated': cur_time,
+        'next_update': cur_time + 14 * 86400,
+    } for pic_id in photo_ids}
+
+
+# Answers photos.getInfo like Flickr, after a configurable delay
+class BenchFlickrPhotos(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def getInfo(self, photo_id, format=None):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return {'stat': 'ok', 'photo': {
+            'id': photo_id, 'farm': 9, 'server': '8579',
+            'secret': '7cfe88c078', 'title': {'_content': 'Photo ' + photo_id}
+        }}
+
+
+class BenchFlickr(object):
+    def __init__(self, latency=0.0):
+        self.photos = BenchFlickrPhotos(latency)
+
+
+# Returns document content with the given number of tags, of which
+#  roughly duplicate_ratio repeat an earlier tag in the same document
+def make_document_content(photo_ids, tags, duplicate_ratio=0.0, rng=random):
+    chunks = []
+    used = []
+    for _ in range(tags):
+        if used and rng.random() < duplicate_ratio:
+            pic_id = rng.choice(used)
+        else:
+            pic_id = rng.choice(photo_ids)
+            used.append(pic_id)
+        chunks.append(FILLER)
+        chunks.append("<p>[flickr:id=%s]</p>\n" % pic_id)
+    chunks.append(FILLER)
+    return "".join(chunks)
+
+
+# The substitution loop as it was before single-pass rewriting: one
+#  str.replace over the whole document per tag
+def replace_tags_with_str_replace(document, generator, cache):
+    flickr_ctx = generator.context['flickr_insert_ctx']
+    key_field = flickr_ctx['cache_cfg']['key_field']
+
+    for match in flickr_insert.FLICKR_REGEX.findall(document._content):
+        photo = flickr_insert.get_photo_from_tag(match[1], key_field)
+        photo.update(cache.get(photo[key_field], {}))
+        photo.update(flickr_insert.ensure_photo_insert_image_url(photo))
+        context = generator.context.copy()
+        context.update(photo)
+        replacement = flickr_ctx['template'].render(context)
+        document._content = document._content.replace(match[0], replacement)
+
+
+def time_replacement(replace_func, contents, generator, repeat=3):
+    best = None
+    for _ in range(repeat):
+        documents = [BenchDocument(content) for content in contents]
+        flickr_insert.clear_render_cache()
+        start = time.time()
+        for document in documents:
+            replace_func(document, generator, generator.cache)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_substitution(documents=20, tags=150, duplicate_ratio=0.3,
+                       repeat=3, seed=0):
+    rng = random.Random(seed)
+    photo_ids = make_photo_ids(tags * 2)
+    generator = BenchGenerator(make_cache(photo_ids))
+    contents = [make_document_content(photo_ids, tags, duplicate_ratio, rng)
+                for _ in range(documents)]
+
+    results = {}
+    for name, replace_func in [
+            ('str_replace', replace_tags_with_str_replace),
+            ('single_pass', flickr_insert.replace_tags_in_document)]:
+        results[name] = time_replacement(replace_func, contents, generator,
+                                         repeat=repeat)
+    return results
+
+
+# A corpus like a large site's: most documents have no tags, the rest a
+#  few, some sharing a line
+def make_mixed_corpus(documents, tagged_ratio, photo_ids, rng=random):
+    contents = []
+    for _ in range(documents):
+        if rng.random() < tagged_ratio:
+            chunks = [FILLER * 4]
+            for _ in range(rng.randint(1, 4)):
+                chunks.append('<p>[flickr:id=%s,title="A, B"]</p>'
+                              % rng.choice(photo_ids))
+                if rng.random() < 0.25:
+                    chunks.append('<p>[flickr:id=%s]</p>'
+                                  % rng.choice(photo_ids))
+                chunks.append('\n' + FILLER)
+            contents.append(''.join(chunks))
+        else:
+            contents.append(FILLER * rng.randint(4, 40))
+    return contents
+
+
+def bench_scanning(documents=5000, tagged_ratio=0.05, repeat=3, seed=0):
+    rng = random.Random(seed)
+    contents = make_mixed_corpus(documents, tagged_ratio,
+                                 make_photo_ids(1000), rng)
+
+    def run_greedy():
+        for content in contents:
+            GREEDY_FLICKR_REGEX.findall(content)
+
+    def run_scanner():
+        for content in contents:
+            for _ in flickr_insert.iter_flickr_tags(content):
+                pass
+
+    return {name: best_time(func, repeat) for name, func in [
+        ('greedy_findall', run_greedy),
+        ('iter_flickr_tags', run_scanner)]}
+
+
+# The tag parser as it was before the tokenizer: a ConfigParser per tag
+def parse_tag_with_configparser(tag_str):
+    config = configparser.ConfigParser()
+    config.read_string(u"[temp]\n" + tag_str.replace(",", "\n"))
+    return {item[0]: item[1] for item in config.items('temp')}
+
+
+def bench_tag_parsing(tags=20000, distinct=2000, repeat=3, seed=0):
+    rng = random.Random(seed)
+    sizes = sorted(flickr_insert.photo_suffixes)
+    distinct_tags = [
+        "url=https://flic.kr/p/%s,size=%s,caption=%s,float=%s"
+        % (flickr_insert.shorturl.encode(pic_id), rng.choice(sizes),
+           rng.choice(['true', 'false']), rng.choice(['left', 'right']))
+        for pic_id in make_photo_ids(distinct)]
+    tag_strs = [rng.choice(distinct_tags) for _ in range(tags)]
+
+    def run_cold():
+        flickr_insert._parse_flickr_tag.cache_clear()
+        for tag_str in tag_strs:
+            flickr_insert.parse_flickr_tag(tag_str)
+
+    def run_warm():
+        for tag_str in tag_strs:
+            flickr_insert.parse_flickr_tag(tag_str)
+
+    def run_configparser():
+        for tag_str in tag_strs:
+            parse_tag_with_configparser(tag_str)
+
+    return {name: best_time(func, repeat) for name, func in [
+        ('configparser', run_configparser),
+        ('tokenizer_cold', run_cold),
+        ('tokenizer_warm', run_warm)]}
+
+
+def bench_rendering(photos=2000, repeat=3, seed=0):
+    rng = random.Random(seed)
+    template = flickr_insert.Template(flickr_insert.DEFAULT_TEMPLATE)
+    # A large site context, as Pelican's is
+    context = {'article%d' % n: n for n in range(5000)}
+    sizes = sorted(flickr_insert.photo_suffixes)
+    photo_ids = make_photo_ids(photos)
+    cache = make_cache(photo_ids)
+
+    tags = []
+    for pic_id in photo_ids:
+        photo = flickr_insert.get_photo_from_tag(
+            'id=%s,size=%s,float=%s' % (pic_id, rng.choice(sizes),
+                                       rng.choice(['left', 'right', ''])),
+            'pic_id')
+        tags.append((photo, cache[pic_id]))
+
+    def run_template_render():
+        for photo, cache_entry in tags:
+            full_context = context.copy()
+            full_context.update(photo)
+            full_context.update(cache_entry)
+            full_context.update(
+                flickr_insert.ensure_photo_insert_image_url(full_context))
+            template.render(full_context)
+
+    def run_render_photo(render_template):
+        def run():
+            flickr_insert.clear_render_cache()
+            for photo, cache_entry in tags:
+                flickr_insert.render_photo_cached(
+                    render_template, photo, cache_entry, context)
+        return run
+
+    source = flickr_insert.DEFAULT_TEMPLATE
+    return {name: best_time(func, repeat) for name, func in [
+        ('template_render', run_template_render),
+        ('render_photo_cached', run_render_photo(template)),
+        ('minimal_context', run_render_photo(
+            flickr_insert.PhotoTemplate(template, source, fast=False))),
+        ('fast_template', run_render_photo(
+            flickr_insert.PhotoTemplate(template, source)))]}
+
+
+def make_cache_cfg(work_dir, backend='csv', document_index=False):
+    cache_cfg = dict(
+        flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG']['default'])
+    cache_cfg.update({
+        'backend': backend,
+        'filename': os.path.join(work_dir, 'cache.csv'),
+        'sqlite_filename': os.path.join(work_dir, 'cache.sqlite3'),
+        'document_index_filename': os.path.join(work_dir, 'documents.json')
+        if document_index else None,
+    })
+    return cache_cfg
+
+
+def remove_cache_files(cache_cfg):
+    for name in ('filename', 'sqlite_filename', 'document_index_filename'):
+        if cache_cfg.get(name) and os.path.exists(cache_cfg[name]):
+            os.remove(cache_cfg[name])
+
+
+# Times loading and saving a cache of the given size.  changed is the
+#  number of entries updated before the save
+def bench_cache_io(entries=20000, changed=100, backend='csv', repeat=3):
+    work_dir = tempfile.mkdtemp()
+    try:
+        cache_cfg = make_cache_cfg(work_dir, backend)
+        photo_ids = make_photo_ids(entries)
+        cache = flickr_insert.PhotoCache(cache_cfg)
+        for pic_id, entry in make_cache(photo_ids).items():
+            cache[pic_id] = entry
+        cache.save()
+
+        results = {'load': None, 'save': None}
+        for _ in range(repeat):
+            cache = flickr_insert.PhotoCache(cache_cfg)
+            start = time.time()
+            cache.entries
+            results['load'] = min_time(results['load'], time.time() - start)
+
+            for pic_id in photo_ids[:changed]:
+                cache[pic_id]['title'] = 'Changed %f' % time.time()
+                cache.mark_dirty(pic_id)
+            start = time.time()
+            cache.save()
+            results['save'] = min_time(results['save'], time.time() - start)
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+# Compares a cache loaded as plain dictionaries of strings, as it used to
+#  be, with the compact CacheEntry objects: memory held once loaded (in
+#  MB), load time and the time for a pass over every entry's next_update
+def bench_cache_memory(entries=100000, repeat=3):
+    work_dir = tempfile.mkdtemp()
+    try:
+        cache_cfg = make_cache_cfg(work_dir)
+        cur_time = int(time.time())
+        cache = make_cache(make_photo_ids(entries), cur_time)
+        for entry in cache.values():
+            for name in flickr_insert.TIMESTAMP_FIELDS:
+                entry[name + '_str'] = flickr_insert.epoch_to_str(entry[name])
+            entry['flickr_error'] = ''
+        flickr_insert.save_cache_to_csv(
+            cache, filename=cache_cfg['filename'],
+            fieldnames=cache_cfg['field_names'], key_name='pic_id')
+        del cache
+
+        loaders = [
+            ('dict', lambda: flickr_insert.load_cache_from_csv(
+                cache_cfg['filename'], key_name='pic_id')),
+            ('compact', flickr_insert.CsvCacheBackend(cache_cfg).load),
+        ]
+
+        results = {}
+        for name, load in loaders:
+            tracemalloc.start()
+            loaded = load()
+            results[name + '_mb'] = \
+                tracemalloc.get_traced_memory()[0] / 1e6
+            tracemalloc.stop()
+
+            results[name + '_load'] = best_time(load, repeat)
+            results[name + '_scan'] = best_time(
+                lambda: sum(flickr_insert.make_int(entry['next_update'])
+                            for entry in loaded.values()), repeat)
+            del loaded
+        return results
+    finally:
+        shutil.rmtree(work_dir)
+
+
+# A Pelican articles generator holding synthetic documents
+def make_generator(contents, cache_cfg, flickr, **settings):
+    generator = ArticlesGenerator.__new__(ArticlesGenerator)
+    generator.settings = {
+        'FLICKR_INSERT_API_KEY': 'key',
+        'FLICKR_INSERT_API_SECRET': 'secret',
+        'FLICKR_INSERT_CACHE_CFG': cache_cfg,
+    }
+    generator.settings.update(settings)
+    generator.context = dict(generator.settings)
+    generator.articles = [BenchDocument(content) for content in contents]
+    generator.drafts = []
+
+    flickr_insert.init_flickr_insert(generator)
+    generator.context['flickr_insert_ctx']['flickr_conn'] = flickr
+    return generator
+
+
+# Times a whole build: finding tags, fetching photos missing from the
+#  cache (cache_hit_ratio of the photos are cached and fresh) from a fake
+#  Flickr with the given latency, rewriting documents and saving the cache
+def bench_build(documents=2000, tags=10, duplicate_ratio=0.3,
+                cache_hit_ratio=0.9, latency=0.01, backend='csv',
+                max_workers=8, processes=0, document_index=False,
+                repeat=3, seed=0):
+    rng = random.Random(seed)
+    photo_ids = make_photo_ids(max(1, documents * tags // 2))
+    contents = [make_document_content(photo_ids, tags, duplicate_ratio, rng)
+                for _ in range(documents)]
+    cached_ids = photo_ids[:int(len(photo_ids) * cache_hit_ratio)]
+
+    results = {'replace_document_tags': None, 'save': None,
+               'api_calls': 0}
+    work_dir = tempfile.mkdtemp()
+    try:
+        cache_cfg = make_cache_cfg(work_dir, backend, document_index)
+        for _ in range(repeat):
+            remove_cache_files(cache_cfg)
+            cache = flickr_insert.PhotoCache(cache_cfg)
+            for pic_id, entry in make_cache(cached_ids,
+                                            int(time.time())).items():
+                cache[pic_id] = entry
+            cache.save()
+
+            flickr = BenchFlickr(latency)
+            generator = make_generator(
+                contents, cache_cfg, flickr,
+                FLICKR_INSERT_MAX_WORKERS=max_workers,
+                FLICKR_INSERT_PROCESSES=processes,
+                FLICKR_INSERT_PROCESS_THRESHOLD=0)
+
+            start = time.time()
+            flickr_insert.replace_document_tags(generator)
+            results['replace_document_tags'] = min_time(
+                results['replace_document_tags'], time.time() - start)
+
+            start = time.time()
+            flickr_insert.flush_photo_cache()
+            results['save'] = min_time(results['save'], time.time() - start)
+            results['api_calls'] = flickr.photos.calls
+        return results
+    finally:
+        flickr_insert.flush_photo_cache()
+        shutil.rmtree(work_dir)
+
+
+def min_time(best, elapsed):
+    return elapsed if best is None else min(best, elapsed)
+
+
+def best_time(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def print_results(results, baseline=None):
+    for name, value in sorted(results.items()):
+        if not isinstance(value, float):
+            print('  %-22s %8s' % (name, value))
+        elif name.endswith('_mb'):
+            print('  %-22s %8.1f MB' % (name, value))
+        elif baseline:
+            print('  %-22s %8.3f s  %6.2fx'
+                  % (name, value, results[baseline] / value))
+        else:
+            print('  %-22s %8.3f s' % (name, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark flickr_insert hot paths')
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+                        help='any of: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--documents', type=int, default=20)
+    parser.add_argument('--tags', type=int, default=150,
+                        help='tags per document')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scan-documents', type=int, default=5000,
+                        help='documents in the scanning benchmark')
+    parser.add_argument('--tagged-ratio', type=float, default=0.05,
+                        help='share of those documents with tags')
+    parser.add_argument('--build-documents', type=int, default=2000)
+    parser.add_argument('--build-tags', type=int, default=10,
+                        help='tags per document in the build benchmark')
+    parser.add_argument('--cache-hit-ratio', type=float, default=0.9)
+    parser.add_argument('--cache-entries', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds per fake Flickr call')
+    parser.add_argument('--backend', default='csv',
+                        choices=sorted(flickr_insert.CACHE_BACKENDS))
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=0)
+    parser.add_argument('--document-index', action='store_true')
+    parser.add_argument('--json', metavar='FILE',
+                        help="write results as JSON to FILE ('-' for"
+                             " standard output)")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    benchmarks = {
+        'substitution': (lambda: bench_substitution(
+            documents=args.documents, tags=args.tags,
+            duplicate_ratio=args.duplicate_ratio, repeat=args.repeat),
+            'str_replace'),
+        'scanning': (lambda: bench_scanning(
+            documents=args.scan_documents, tagged_ratio=args.tagged_ratio,
+            repeat=args.repeat), 'greedy_findall'),
+        'tag_parsing': (lambda: bench_tag_parsing(
+            tags=args.documents * args.tags, repeat=args.repeat),
+            'configparser'),
+        'rendering': (lambda: bench_rendering(repeat=args.repeat),
+                      'template_render'),
+        'cache_memory': (lambda: bench_cache_memory(
+            entries=args.cache_entries * 5, repeat=args.repeat), None),
+        'cache_io': (lambda: bench_cache_io(
+            entries=args.cache_entries, backend=args.backend,
+            repeat=args.repeat), None),
+        'build': (lambda: bench_build(
+            documents=args.build_documents, tags=args.build_tags,
+            duplicate_ratio=args.duplicate_ratio,
+            cache_hit_ratio=args.cache_hit_ratio, latency=args.latency,
+            backend=args.backend, max_workers=args.max_workers,
+            processes=args.processes, document_index=args.document_index,
+            repeat=args.repeat), None),
+    }
+
+    output = {'options': vars(args), 'results': {}}
+    for name in args.benchmarks:
+        bench_func, baseline = benchmarks[name]
+        results = bench_func()
+        output['results'][name] = results
+        if args.json != '-':
+            print(name)
+            print_results(results, baseline)
+
+    if args.json == '-':
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(output, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
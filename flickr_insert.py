@@ -3,18 +3,40 @@
 Inserts a Flickr image in a Pelican article
 
 """
+import argparse
+import asyncio
+import cProfile
 import logging
+import math
 import re
-import configparser
+import functools
+import hashlib
+import heapq
+import http.client
+import json
 import csv
+import os
+import sqlite3
 import time
+import multiprocessing
+import pickle
 import random
-import copy
+import shutil
+import ssl
+import struct
+import sys
+import threading
+import urllib.parse
+import urllib.request
+from collections import ChainMap, deque
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
 from itertools import chain
 import flickrapi
 from flickrapi import shorturl
 from pelican import signals, ArticlesGenerator, PagesGenerator
-from jinja2 import Template
+from jinja2 import Environment, Template, meta, nodes
+from jinja2.defaults import DEFAULT_FILTERS, DEFAULT_NAMESPACE, DEFAULT_TESTS
 
 # Load settings
 plugin_settings = {
@@ -28,11 +50,121 @@ plugin_settings = {
         'required': False,
         'default': 'Medium 640'
     },
+    'FLICKR_INSERT_MODE': {
+        'required': False,
+        'default': 'online'  # one of FLICKR_INSERT_MODES
+    },
+    'FLICKR_INSERT_MAX_WORKERS': {
+        'required': False,
+        'default': 8  # concurrent Flickr API calls when prefetching
+    },
+    'FLICKR_INSERT_CLIENT_CFG': {
+        'required': False,
+        'default': {
+            "rate": 10.0,  # API calls per second, on average
+            "burst": 10,  # calls that may be made at once before limiting
+            "max_retries": 3,  # retries of a failed call
+            "backoff": 0.5,  # seconds before the first retry, then doubled
+            "max_backoff": 8.0,  # longest wait between retries
+            "breaker_threshold": 5,  # consecutive failures that stop calls
+            "breaker_reset": 60  # seconds before calls are tried again
+        }
+    },
+    'FLICKR_INSERT_ASYNC_CLIENT': {
+        'required': False,
+        'default': {
+            "enabled": False,  # call Flickr over pooled keep-alive
+            #  connections instead of through flickrapi
+            "endpoint": "https://api.flickr.com/services/rest/",
+            "pool_size": 4,  # connections kept open to Flickr
+            "pipeline": 1,  # requests sent on a connection before the
+            #  first is answered; 1 waits for each answer
+            "timeout": 10,  # seconds before a call is given up
+            "connect_timeout": 5  # seconds before a connection is given up
+        }
+    },
+    'FLICKR_INSERT_REFRESH_BUDGET': {
+        'required': False,
+        'default': {
+            "max_calls": None,  # most refreshes per build; None for no limit
+            "max_seconds": None,  # most seconds per build spent refreshing
+            "report_days": 14  # days ahead covered by the refresh report
+        }
+    },
+    'FLICKR_INSERT_PROFILE': {
+        'required': False,
+        'default': {
+            "report": True,  # log time per stage at the end of the build
+            "json_filename": None,  # also write the report here, as JSON
+            "cprofile_filename": None  # cProfile the plugin's work to here
+        }
+    },
+    'FLICKR_INSERT_PROCESSES': {
+        'required': False,
+        'default': 0  # worker processes for rendering; 0 or 1 is serial
+    },
+    'FLICKR_INSERT_PROCESS_THRESHOLD': {
+        'required': False,
+        'default': 200  # documents below which rendering stays serial
+    },
+    'FLICKR_INSERT_FAST_TEMPLATE': {
+        'required': False,
+        'default': True  # render the default template without Jinja
+    },
+    'FLICKR_INSERT_BULK_WARM': {
+        'required': False,
+        'default': {
+            "photoset_ids": [],  # albums to page through
+            "user_ids": [],  # users whose public photos to page through
+            "per_page": 500  # the most Flickr returns per listing page
+        }
+    },
+    'FLICKR_INSERT_REVALIDATE': {
+        'required': False,
+        'default': {
+            "user_ids": [],  # owners whose photos are checked by listing
+            "recently_updated": False,  # list with photos.recentlyUpdated;
+            #  needs a connection authenticated as the one user in user_ids
+            "per_page": 500  # the most Flickr returns per listing page
+        }
+    },
+    'FLICKR_INSERT_MIRROR': {
+        'required': False,
+        'default': {
+            "enabled": False,  # serve images from the site, not Flickr
+            "suffixes": ["m", "z", "b"],  # sizes to download; see
+            #  photo_suffix_sizes.  Non-square sizes also make the srcset
+            "store_dir": "flickr_insert_images",  # downloads, by content hash
+            "output_dir": "images/flickr",  # under OUTPUT_PATH and SITEURL
+            "max_workers": 4,  # concurrent downloads
+            "timeout": 30  # seconds before a download is given up
+        }
+    },
     'FLICKR_INSERT_CACHE_CFG': {
         'required': False,
         'default': {
+            "backend":
+                "csv",  # one of CACHE_BACKENDS
             "filename":
                 "flickr_insert_cache.csv",
+            "sqlite_filename":
+                "flickr_insert_cache.sqlite3",  # for the sqlite backend
+            "remote_url":  # for the remote backend, a shared cache server
+                None,  # run with flickr_insert_cache_server.py
+            "remote_local_backend":
+                "csv",  # the remote backend's own copy of the cache
+            "remote_timeout":
+                5,  # seconds before the server is given up on
+            "document_index_filename":  # None to always rewrite documents
+                "flickr_insert_documents.json",
+            "journal":  # keep refreshed entries in <cache file>.journal
+                True,  # until the cache is saved
+            "evict_after_builds":  # remove entries no build has used in
+                None,  # this many builds; None for no limit
+            "evict_after_days":  # and in this many days; if both are
+                None,  # None, nothing is removed or tracked
+            "archive_filename":  # CSV file that removed entries are moved
+                None,  # to and restored from; None to discard them
             "key_field":
                 "pic_id",  # cache key field
             "increment":
@@ -48,53 +180,101 @@ plugin_settings = {
                 ["title", "insert_image_url_base",
                  "last_changed", "last_updated", "next_update",
                  "last_changed_str", "last_updated_str", "next_update_str",
-                 "flickr_error"]
+                 "flickr_error", "lastupdate", "owner",
+                 "last_seen", "last_seen_build"]
         }
     }
 }
 
 
+# When a build may call Flickr:
+#  online: whenever a photo is missing from the cache or due a refresh
+#  cache_only: never; photos are rendered from whatever is cached
+#  cache_first_async: missing photos are fetched, but due refreshes happen
+#   in the background while the build renders the cached information
+FLICKR_INSERT_MODES = ('online', 'cache_only', 'cache_first_async')
+
+
 def get_cache_cfg():
     return plugin_settings['FLICKR_INSERT_CACHE_CFG']
 
 
 # This produces two matches: one for the whole tag,
 #  one for all the parameters after, such as url= or id=
-FLICKR_REGEX = re.compile(r'<p>\s*(\[flickr:(.*)\])\s*</p>', re.IGNORECASE)
+# The parameters end at the first ']' outside a quoted value, so two tags on
+#  one line are two matches.  As in TAG_PARAM_REGEX, quotes only count at
+#  the start of a value, and only if closed on the same line, so there is
+#  just one way to match each character and a tag that doesn't match is
+#  given up on without backtracking
+FLICKR_REGEX = re.compile(r"""<p>\s*(\[flickr:(
+    (?:[^\]=\n]
+    |=[ \t]*(?:"[^"\n]*"|'[^'\n]*')
+    |=(?![ \t]*(?:"[^"\n]*"|'[^'\n]*')))*
+    )\])\s*</p>""", re.IGNORECASE | re.VERBOSE)
 
 BOOLEAN_STATES = {
     '1': True, 'yes': True, 'y': True, 'true': True, 'on': True,
     '0': False, 'no': False, 'n': False, 'false': False, 'off': False}
 
 
+# Matches one key=value parameter of a [flickr:] tag, up to the comma that
+#  ends it.  Values may be quoted to include commas, e.g. title="Reno, NV"
+TAG_PARAM_REGEX = re.compile(r"""
+    \s*(?P<key>[^=,]*?)\s*
+    (?:=\s*(?P<value>"[^"]*"|'[^']*'|[^,]*?)\s*)?
+    (?:,|$)""", re.VERBOSE)
+
+# How many distinct tag strings to keep parsed
+TAG_PARSE_CACHE_SIZE = 4096
+
+
 # Returns a list of regex matches
 def get_flickr_tags(content):
     tags = []
 
-    matches = FLICKR_REGEX.findall(content)
-    params = {}
+    for match in iter_flickr_tags(content):
+        params = parse_flickr_tag(match.group(2))
+        params['full_tag'] = match.group(1)
+        tags.append(params)
 
-    for m in matches:
-        config = configparser.ConfigParser()
-        config.read_string(u"[temp]\n" + m[1].replace(",", "\n"))
-        params = {item[0]: item[1] for item in config.items('temp')}
-        params['full_tag'] = m[0]
+    return tags
 
-    tags.append(params)
 
-    return tags
+# Yields the match of each [flickr:] tag in content, in order, as it is
+#  found.  FLICKR_REGEX starts with a literal '<p>', which re already
+#  searches for quickly, so untagged content needs no separate prefilter
+def iter_flickr_tags(content):
+    return FLICKR_REGEX.finditer(content)
 
 
 def parse_flickr_tag(tag_str):
-    tag_params = {}
+    # Callers update the returned dictionary, so hand out a fresh copy
+    return dict(timed('parse_tag', _parse_flickr_tag, tag_str))
+
 
-    cp_temp = configparser.ConfigParser()
-    cp_temp.read_string("[temp]\n" + tag_str.replace(",", "\n"))
-    read_params = {item[0]: item[1] for item in cp_temp.items('temp')}
+# Splits a tag's parameters into (key, value) pairs.  Keys are lower-cased
+#  and, as with the ConfigParser this replaces, the last of any repeated
+#  key wins; a parameter without a value is ignored
+@functools.lru_cache(maxsize=TAG_PARSE_CACHE_SIZE)
+def _parse_flickr_tag(tag_str):
+    params = {}
 
-    tag_params.update(read_params)
+    pos = 0
+    end = len(tag_str)
+    while pos < end:
+        match = TAG_PARAM_REGEX.match(tag_str, pos)
+        if match.end() == pos:
+            break
+        pos = match.end()
 
-    return tag_params
+        value = match.group('value')
+        if not match.group('key') or value is None:
+            continue
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+        params[match.group('key').lower()] = value
+
+    return tuple(params.items())
 
 
 # if the parameter float is not supplied, the image will be full-width
@@ -104,7 +284,9 @@ DEFAULT_TEMPLATE = """<div class="caption-container">
         <img src="{{insert_image_url}}"
             alt="{{title}}"
             title="{{title}}"
-            class="img-polaroid"
+            class="img-polaroid"{% if srcset %}
+            srcset="{{srcset}}"{% if sizes %}
+            sizes="{{sizes}}"{% endif %}{% endif %}
             {% if FLICKR_TAG_INCLUDE_DIMENSIONS %}
                 width="{{width}}"
                 height="{{height}}"
@@ -148,6 +330,9 @@ caption_for_size = {letter: caption
                     for caption, letters in photo_captions_enabled.items()
                     for letter in letters}
 
+# Square crops can't stand in for the other sizes in a srcset
+square_photo_suffixes = ("s", "q")
+
 logger = logging.getLogger(__name__)
 
 
@@ -161,11 +346,18 @@ def init_flickr_insert(generator):
             generator.settings.setdefault(setting_name,
                                           setting_value['default'])
 
+    if generator.settings['FLICKR_INSERT_MODE'] not in FLICKR_INSERT_MODES:
+        raise Exception('Unknown FLICKR_INSERT_MODE: '
+                        + str(generator.settings['FLICKR_INSERT_MODE']))
+
     # Add context settings for this particular invocation
-    # Create the flickr 'connection'
-    flickr_conn = flickrapi.FlickrAPI(
+    # Create the flickr 'connection', shared by all generators so that rate
+    #  limits and failures are tracked across the whole build
+    flickr_conn = get_flickr_client(
         generator.context.get('FLICKR_INSERT_API_KEY'),
-        generator.context.get('FLICKR_INSERT_API_SECRET'))
+        generator.context.get('FLICKR_INSERT_API_SECRET'),
+        generator.settings.get('FLICKR_INSERT_CLIENT_CFG'),
+        generator.settings.get('FLICKR_INSERT_ASYNC_CLIENT'))
     flicker_insert_ctx = {"flickr_conn": flickr_conn}
     generator.context.update({'flickr_insert_ctx': flicker_insert_ctx})
 
@@ -174,9 +366,14 @@ def init_flickr_insert(generator):
 
     # Get the article template
     template_name = generator.context.get('FLICKR_INSERT_TEMPLATE_NAME')
+    template_source = DEFAULT_TEMPLATE
+    template_environment = None
     if template_name is not None:
         try:
             template = generator.get_template(template_name)
+            template_source = get_template_source(template)
+            template_environment = get_template_environment_cfg(
+                template, generator.settings)
         except Exception:
             logger.error('[flickr_insert]:'
                          ' Unable to get custom template %s'
@@ -185,22 +382,1715 @@ def init_flickr_insert(generator):
     else:
         template = Template(DEFAULT_TEMPLATE)
 
-    flicker_insert_ctx.update({"template": template})
+    fast_template = generator.settings.get('FLICKR_INSERT_FAST_TEMPLATE')
+    flicker_insert_ctx.update({"template": PhotoTemplate(
+        template, template_source, fast_template)})
+    flicker_insert_ctx.update({"fast_template": fast_template})
+    # Worker processes rebuild the template from source, in an environment
+    #  like the one it was loaded from
+    flicker_insert_ctx.update({"template_source": template_source})
+    flicker_insert_ctx.update({"template_environment": template_environment})
 
     # add cache_config from settings to context
     cache_cfg = generator.settings.get('FLICKR_INSERT_CACHE_CFG')
     flicker_insert_ctx.update({"cache_cfg": cache_cfg})
     flicker_insert_ctx.update({"key_field": cache_cfg['key_field']})
 
-    cache_loader = load_cache_from_csv
-    cache = cache_loader(cache_cfg['filename'],
-                         key_name=cache_cfg['key_field'])
-
-    flicker_insert_ctx.update({"cache": cache})
+    # The cache itself is shared by all generators and loaded on first use
+    flicker_insert_ctx.update({"cache": get_photo_cache(cache_cfg)})
+    get_refresh_budget(generator.settings.get('FLICKR_INSERT_REFRESH_BUDGET'))
+    get_build_profile(generator.settings.get('FLICKR_INSERT_PROFILE'))
 
     return
 
 
+# Returns the source of a template loaded from the theme, or None
+def get_template_source(template):
+    environment = template.environment
+    if environment.loader is None or template.name is None:
+        return None
+    try:
+        return environment.loader.get_source(environment, template.name)[0]
+    except Exception:
+        return None
+
+
+# What a worker process needs to rebuild the Jinja environment a template
+#  was loaded from: Pelican's JINJA_ENVIRONMENT options, the loader, and the
+#  filters, tests and globals added to Jinja's own (by Pelican and its
+#  JINJA_FILTERS, JINJA_TESTS and JINJA_GLOBALS settings)
+def get_template_environment_cfg(template, settings):
+    environment = template.environment
+
+    def added(items, defaults):
+        return {name: value for name, value in items.items()
+                if defaults.get(name) is not value}
+
+    return {
+        'options': dict(settings.get('JINJA_ENVIRONMENT') or {}),
+        'loader': environment.loader,
+        'filters': added(environment.filters, DEFAULT_FILTERS),
+        'tests': added(environment.tests, DEFAULT_TESTS),
+        'globals': added(environment.globals, DEFAULT_NAMESPACE),
+    }
+
+
+# Builds the environment described by get_template_environment_cfg, or a
+#  default one, as used for DEFAULT_TEMPLATE, if environment_cfg is None
+def make_template_environment(environment_cfg=None):
+    if environment_cfg is None:
+        return Environment()
+    environment = Environment(loader=environment_cfg['loader'],
+                              **environment_cfg['options'])
+    environment.filters.update(environment_cfg['filters'])
+    environment.tests.update(environment_cfg['tests'])
+    environment.globals.update(environment_cfg['globals'])
+    return environment
+
+
+# Raised instead of calling Flickr while the circuit breaker is open
+class CircuitOpenError(flickrapi.exceptions.FlickrError):
+    pass
+
+
+# Flickr error codes that retrying won't fix, such as 'Photo not found'
+#  (1), 'Permission denied' (2) and 'Invalid API Key' (100)
+NON_RETRYABLE_FLICKR_CODES = (1, 2, 100)
+
+
+# Limits calls to an average rate, allowing bursts of up to burst calls
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    # Blocks until a call may be made
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (
+                    now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+# Stops calls after threshold consecutive failures; after reset_after
+#  seconds one trial call is let through, and closes the breaker again if
+#  it succeeds
+class CircuitBreaker(object):
+    def __init__(self, threshold, reset_after, clock=time.time):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or \
+                    self.clock() - self.opened_at < self.reset_after:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logger.warning('[flickr_insert]: Too many Flickr'
+                                   ' errors; using cached information only')
+                self.opened_at = self.clock()
+
+
+# Wraps a flickr_conn (flickrapi.FlickrAPI) so that every call is rate
+#  limited, retried with jittered exponential backoff and guarded by a
+#  circuit breaker.  Methods are called just as on flickr_conn, such as
+#  client.photos.getInfo(photo_id=...)
+class FlickrClient(object):
+    def __init__(self, flickr, rate=10.0, burst=10, max_retries=3,
+                 backoff=0.5, max_backoff=8.0, breaker_threshold=5,
+                 breaker_reset=60, clock=time.time, sleep=time.sleep):
+        self.flickr = flickr
+        self.bucket = TokenBucket(rate, burst, clock=clock, sleep=sleep)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset,
+                                      clock=clock)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'errors': 0, 'retries': 0, 'rejected': 0}
+        self.latencies = {}
+
+    def __getattr__(self, name):
+        return FlickrClientMethod(self, name)
+
+    def call(self, method_name, **kwargs):
+        flickr_method = self.flickr
+        for name in method_name.split('.'):
+            flickr_method = getattr(flickr_method, name)
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.count('rejected')
+                raise CircuitOpenError('Flickr calls suspended after'
+                                       ' repeated errors')
+
+            self.bucket.acquire()
+            start = time.time()
+            try:
+                response = flickr_method(**kwargs)
+            except Exception as e:
+                self.record(method_name, time.time() - start, error=True)
+                if not self.is_retryable(e):
+                    self.breaker.record_success()
+                    raise
+                self.breaker.record_failure()
+                if attempt >= self.max_retries or self.breaker.is_open:
+                    raise
+            else:
+                self.record(method_name, time.time() - start)
+                self.breaker.record_success()
+                return response
+
+            self.count('retries')
+            self.sleep(self.get_backoff(attempt))
+            attempt += 1
+
+    @staticmethod
+    def is_retryable(e):
+        if isinstance(e, flickrapi.exceptions.FlickrError):
+            return getattr(e, 'code', None) not in NON_RETRYABLE_FLICKR_CODES
+        return isinstance(e, (IOError, OSError))
+
+    def get_backoff(self, attempt):
+        return min(self.max_backoff, self.backoff * (2 ** attempt)) * \
+            random.uniform(0.5, 1.0)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def record(self, method_name, latency, error=False):
+        with self.lock:
+            self.stats['calls'] += 1
+            if error:
+                self.stats['errors'] += 1
+            self.latencies.setdefault(method_name, []).append(latency)
+
+    # Returns call counts and per-method latency (in seconds)
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['methods'] = {
+                method_name: {
+                    'calls': len(latencies),
+                    'mean': sum(latencies) / len(latencies),
+                    'max': max(latencies),
+                } for method_name, latencies in self.latencies.items()}
+        return stats
+
+    # Closes the connections to Flickr, if kept open.  flickrapi turns any
+    #  attribute into an API method, so only ours are closed
+    def close(self):
+        if isinstance(self.flickr, AsyncFlickrAPI):
+            self.flickr.close()
+
+
+# A Flickr method, or namespace of methods, on a FlickrClient
+class FlickrClientMethod(object):
+    def __init__(self, client, method_name):
+        self.client = client
+        self.method_name = method_name
+
+    def __getattr__(self, name):
+        return FlickrClientMethod(self.client,
+                                  self.method_name + '.' + name)
+
+    def __call__(self, **kwargs):
+        return self.client.call(self.method_name, **kwargs)
+
+
+# Calls Flickr's REST API over a pool of keep-alive HTTP connections run by
+#  asyncio, in place of flickrapi.FlickrAPI.  Coroutines await call_async
+#  or get_info; other code calls methods just as on flickrapi, such as
+#  api.photos.getInfo(photo_id=...), which runs the call on an event loop
+#  in a thread of its own.  Responses are parsed JSON, as flickrapi's
+#  'parsed-json' format gives.  Calls are not signed, so only methods that
+#  need no authentication can be used
+class AsyncFlickrAPI(object):
+    def __init__(self, api_key, api_secret=None,
+                 endpoint='https://api.flickr.com/services/rest/',
+                 pool_size=4, pipeline=1, timeout=10, connect_timeout=5,
+                 ssl_context=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.path = urllib.parse.urlsplit(endpoint).path or '/'
+        self.pool = AsyncConnectionPool(endpoint, pool_size, pipeline,
+                                        connect_timeout, ssl_context)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return FlickrClientMethod(self, name)
+
+    # Calls a Flickr method and returns its parsed response.  Raises
+    #  FlickrError for a failed call, as flickrapi does, and IOError if
+    #  Flickr can't be reached or doesn't answer in time
+    async def call_async(self, method_name, **params):
+        params.pop('format', None)
+        params.update({'method': method_name, 'api_key': self.api_key,
+                       'format': 'json', 'nojsoncallback': 1})
+        target = self.path + '?' + urllib.parse.urlencode(sorted(
+            (name, value) for name, value in params.items()
+            if value is not None))
+        try:
+            status, body = await asyncio.wait_for(
+                self.pool.request(target), self.timeout)
+        except asyncio.TimeoutError:
+            raise IOError('Flickr did not answer %s within %s seconds'
+                          % (method_name, self.timeout))
+        if status != 200:
+            raise IOError('Flickr answered %s with HTTP status %d'
+                          % (method_name, status))
+
+        try:
+            response = json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            raise IOError('Unreadable response from Flickr: %s' % e)
+        if response.get('stat', '') == 'fail':
+            raise flickrapi.exceptions.FlickrError(
+                'Error: %(code)s: %(message)s' % response,
+                code=response['code'])
+        return response
+
+    # Returns a photo's information, as get_info_from_flickr does
+    async def get_info(self, photo_id):
+        try:
+            response = await self.call_async('flickr.photos.getInfo',
+                                             photo_id=photo_id)
+        except (flickrapi.exceptions.FlickrError, IOError) as e:
+            return {'flickr_error': str(e)}
+        return get_info_from_response(response)
+
+    # Returns the information of each photo, keyed by photo id
+    async def get_infos(self, photo_ids):
+        photo_ids = list(photo_ids)
+        infos = await asyncio.gather(
+            *[self.get_info(photo_id) for photo_id in photo_ids])
+        return dict(zip(photo_ids, infos))
+
+    # Calls a method from outside the event loop, waiting for its result
+    def call(self, method_name, **params):
+        if not method_name.startswith('flickr.'):
+            method_name = 'flickr.' + method_name
+        return asyncio.run_coroutine_threadsafe(
+            self.call_async(method_name, **params),
+            self.get_loop()).result()
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever,
+                    name='flickr_insert-async-client', daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def get_stats(self):
+        return dict(self.pool.stats)
+
+    # Closes the connections and stops the event loop's thread
+    def close(self):
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = self.thread = None
+        if loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.pool.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+# Up to pool_size HTTP/1.1 connections to one host, each kept open between
+#  requests and sent up to pipeline requests at a time
+class AsyncConnectionPool(object):
+    def __init__(self, url, pool_size=4, pipeline=1, connect_timeout=5,
+                 ssl_context=None):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.secure = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.secure else 80)
+        self.netloc = parts.netloc
+        self.ssl_context = ssl_context
+        if self.secure and ssl_context is None:
+            self.ssl_context = ssl.create_default_context()
+        self.pool_size = max(1, pool_size)
+        self.pipeline = max(1, pipeline)
+        self.connect_timeout = connect_timeout
+        self.connections = []
+        self.slots = None
+        self.stats = {'connections': 0, 'requests': 0, 'reused': 0}
+
+    # Sends a GET request for target, returning the response's status and
+    #  body
+    async def request(self, target):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.pool_size * self.pipeline)
+        async with self.slots:
+            connection = self.get_connection()
+            connection.in_flight += 1
+            try:
+                await connection.connect()
+                if connection.requests:
+                    self.stats['reused'] += 1
+                self.stats['requests'] += 1
+                return await connection.request(
+                    'GET %s HTTP/1.1\r\nHost: %s\r\n'
+                    'Accept: application/json\r\n'
+                    'User-Agent: flickr_insert\r\n\r\n'
+                    % (target, self.netloc))
+            except BaseException:
+                connection.close()
+                raise
+            finally:
+                connection.in_flight -= 1
+                if connection.closed and connection in self.connections:
+                    self.connections.remove(connection)
+
+    # Returns an idle open connection, or a new one if none is idle and
+    #  the pool isn't full, or else the connection with the fewest
+    #  requests in flight
+    def get_connection(self):
+        self.connections = [connection for connection in self.connections
+                            if not connection.closed]
+        for connection in self.connections:
+            if not connection.in_flight:
+                return connection
+        if len(self.connections) < self.pool_size:
+            connection = AsyncHTTPConnection(
+                self.host, self.port, self.ssl_context, self.connect_timeout)
+            self.connections.append(connection)
+            self.stats['connections'] += 1
+            return connection
+        return min(self.connections,
+                   key=lambda connection: connection.in_flight)
+
+    async def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+# One keep-alive HTTP/1.1 connection.  Requests are written as they come;
+#  responses are read back in the same order by a single reader task
+class AsyncHTTPConnection(object):
+    def __init__(self, host, port, ssl_context=None, connect_timeout=5):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.connect_timeout = connect_timeout
+        self.in_flight = 0
+        self.requests = 0
+        self.closed = False
+        self.connecting = None
+        self.reader = self.writer = None
+        self.reader_task = None
+        self.waiting = deque()
+
+    async def connect(self):
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.open())
+        await asyncio.shield(self.connecting)
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.host, self.port, ssl=self.ssl_context,
+                    server_hostname=self.host if self.ssl_context else None),
+                self.connect_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.closed = True
+            raise IOError('Unable to connect to %s:%d: %s'
+                          % (self.host, self.port, e or 'timed out'))
+        self.reader_task = asyncio.ensure_future(self.read_responses())
+
+    async def request(self, data):
+        if self.closed:
+            raise IOError('Connection to %s closed' % self.host)
+        response = asyncio.get_running_loop().create_future()
+        self.waiting.append(response)
+        self.requests += 1
+        self.writer.write(data.encode('latin-1'))
+        return await response
+
+    async def read_responses(self):
+        try:
+            while not self.closed:
+                response = await read_http_response(self.reader)
+                if response is None:
+                    break
+                status, body, keep_alive = response
+                if self.waiting:
+                    waiter = self.waiting.popleft()
+                    if not waiter.done():
+                        waiter.set_result((status, body))
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self.fail(IOError('Connection to %s failed: %s' % (self.host, e)))
+        self.close()
+
+    # Fails the requests still waiting for a response
+    def fail(self, error):
+        while self.waiting:
+            waiter = self.waiting.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+
+    def close(self):
+        self.closed = True
+        self.fail(IOError('Connection to %s closed' % self.host))
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.reader_task is not None and \
+                self.reader_task is not asyncio.current_task():
+            self.reader_task.cancel()
+
+
+# Reads one HTTP/1.1 response, returning its status, body and whether the
+#  connection stays open after it, or None if the connection was closed
+#  before a response began
+async def read_http_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        return None
+    parts = status_line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise ValueError('bad status line %r' % status_line)
+    status = int(parts[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        if line in (b'\r\n', b'\n'):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = headers.get('connection', '').lower() != 'close' and \
+        parts[0] != 'HTTP/1.0'
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                # Skip any trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n',
+                                                        b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif status in (204, 304) or 100 <= status < 200:
+        body = b''
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return status, body, keep_alive
+
+
+_flickr_client = None
+
+
+# Returns the Flickr client for the current build, creating it if needed
+def get_flickr_client(api_key, api_secret, client_cfg=None, async_cfg=None):
+    global _flickr_client
+    if _flickr_client is None:
+        async_cfg = dict(async_cfg or {})
+        if async_cfg.pop('enabled', False):
+            flickr = AsyncFlickrAPI(api_key, api_secret, **async_cfg)
+        else:
+            flickr = flickrapi.FlickrAPI(api_key, api_secret)
+        _flickr_client = FlickrClient(flickr, **(client_cfg or {}))
+    return _flickr_client
+
+
+# Makes sure each key is resolved only once: requests for a key already
+#  being resolved, or resolved earlier, share that first result
+class SingleFlight(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.stats = {'resolved': 0, 'shared': 0}
+
+    def do(self, key, func, *args):
+        with self.lock:
+            future = self.results.get(key, None)
+            is_first = future is None
+            if is_first:
+                future = self.results[key] = Future()
+                self.stats['resolved'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if is_first:
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
+_photo_lookups = None
+
+
+# Limits how many refreshes a build makes, by number of calls or by time
+#  spent.  Photos with nothing cached are always fetched but still count
+class RefreshBudget(object):
+    def __init__(self, max_calls=None, max_seconds=None, report_days=14,
+                 clock=time.time):
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self.report_days = report_days
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.started = None
+        self.stats = {'refreshed': 0, 'deferred': 0}
+
+    # Returns True if a refresh may be made, counting it against the budget
+    def take(self, required=False):
+        with self.lock:
+            if self.started is None:
+                self.started = self.clock()
+            if not required and self.is_spent():
+                self.stats['deferred'] += 1
+                return False
+            self.stats['refreshed'] += 1
+            return True
+
+    def is_spent(self):
+        if self.max_calls is not None and \
+                self.stats['refreshed'] >= self.max_calls:
+            return True
+        if self.max_seconds is not None and \
+                self.clock() - self.started >= self.max_seconds:
+            return True
+        return False
+
+
+_refresh_budget = None
+
+
+# Returns the refresh budget for the current build, creating it if needed
+def get_refresh_budget(budget_cfg=None):
+    global _refresh_budget
+    if _refresh_budget is None:
+        _refresh_budget = RefreshBudget(**(budget_cfg or {}))
+    return _refresh_budget
+
+
+# Times and counts the plugin's stages over a build.  Each stage keeps the
+#  duration of every call so that the report can give percentiles
+class BuildProfile(object):
+    def __init__(self, report=True, json_filename=None,
+                 cprofile_filename=None, clock=time.perf_counter):
+        self.report = report
+        self.json_filename = json_filename
+        self.cprofile_filename = cprofile_filename
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.photo_ids = set()
+        self.profiler = cProfile.Profile() if cprofile_filename else None
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    # Calls func, recording how long it took under stage
+    def timed(self, stage, func, *args, **kwargs):
+        start = self.clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(stage, self.clock() - start)
+
+    # Calls func under cProfile, when a cprofile_filename is set
+    def profiled(self, func, *args, **kwargs):
+        if self.profiler is None:
+            return func(*args, **kwargs)
+        return self.profiler.runcall(func, *args, **kwargs)
+
+    def get_stage_stats(self):
+        stage_stats = {}
+        with self.lock:
+            for stage, samples in self.samples.items():
+                samples = sorted(samples)
+                stage_stats[stage] = {
+                    'calls': len(samples),
+                    'total': sum(samples),
+                    'p50': get_percentile(samples, 50),
+                    'p95': get_percentile(samples, 95),
+                    'max': samples[-1],
+                }
+        return stage_stats
+
+    def save(self, report):
+        if self.json_filename:
+            write_file_atomically(
+                self.json_filename,
+                lambda json_file: json.dump(report, json_file, indent=2,
+                                            sort_keys=True))
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.cprofile_filename)
+
+
+# Calls func, timing it under stage when a build is being profiled
+def timed(stage, func, *args, **kwargs):
+    profile = _build_profile
+    if profile is None:
+        return func(*args, **kwargs)
+    return profile.timed(stage, func, *args, **kwargs)
+
+
+def record_time(stage, seconds):
+    profile = _build_profile
+    if profile is not None:
+        profile.record(stage, seconds)
+
+
+# Returns the nearest-rank percentile of a sorted, non-empty list
+def get_percentile(samples, percent):
+    rank = int(math.ceil(percent / 100.0 * len(samples)))
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+_build_profile = None
+
+
+# Returns the profile of the current build, creating it if needed
+def get_build_profile(profile_cfg=None):
+    global _build_profile
+    if _build_profile is None:
+        _build_profile = BuildProfile(**(profile_cfg or {}))
+    return _build_profile
+
+
+# Returns the registry of Flickr photo lookups made in the current build
+def get_photo_lookups():
+    global _photo_lookups
+    if _photo_lookups is None:
+        _photo_lookups = SingleFlight()
+    return _photo_lookups
+
+
+TIMESTAMP_FIELDS = ('last_changed', 'last_updated', 'next_update')
+
+# Cache fields held as integers: the timestamps, when Flickr says the photo
+#  last changed, and when and in which build it was last used
+INTEGER_FIELDS = TIMESTAMP_FIELDS + ('lastupdate', 'last_seen',
+                                     'last_seen_build')
+
+# Cache columns the plugin relies on, for revalidation and compaction.
+#  Backends store them even if the configured field_names predate them
+BOOKKEEPING_FIELDS = ('lastupdate', 'owner', 'last_seen', 'last_seen_build')
+
+# When and in which build a site last used a photo; only meaningful to the
+#  site that recorded them, so they aren't shared through a cache server
+SITE_FIELDS = ('last_seen', 'last_seen_build')
+
+
+# Returns the columns a backend stores besides the key field: the
+#  configured field_names plus any bookkeeping fields missing from them
+def get_cache_field_names(cache_cfg):
+    field_names = [name for name in cache_cfg['field_names']
+                   if name != cache_cfg['key_field']]
+    field_names.extend(name for name in BOOKKEEPING_FIELDS
+                       if name not in field_names)
+    return field_names
+
+
+# Human-readable copies of the timestamps, as written to the cache file
+TIMESTAMP_STR_FIELDS = {name + '_str': name for name in TIMESTAMP_FIELDS}
+
+
+# A cache entry that behaves like a dictionary but holds the usual fields
+#  in slots, with timestamps as integers.  The *_str fields are not stored;
+#  they are derived from the timestamps when read, so the cache file keeps
+#  its columns.  Any other field is kept in a dictionary of its own
+class CacheEntry(MutableMapping):
+    __slots__ = ('pic_id', 'title', 'insert_image_url_base',
+                 'flickr_error', 'owner') + INTEGER_FIELDS + ('_extra',)
+
+    def __init__(self, entry=()):
+        self._extra = None
+        if hasattr(entry, 'items'):
+            entry = entry.items()
+        for name, value in entry:
+            self[name] = value
+
+    def __getitem__(self, name):
+        if name in CACHE_ENTRY_SLOTS:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                raise KeyError(name) from None
+        if name in TIMESTAMP_STR_FIELDS:
+            return epoch_to_str(self[TIMESTAMP_STR_FIELDS[name]])
+        if self._extra is None:
+            raise KeyError(name)
+        return self._extra[name]
+
+    def __setitem__(self, name, value):
+        if name in INTEGER_FIELDS:
+            # An empty timestamp, as read from a CSV cache, is left unset
+            if value is None or value == '':
+                self.pop(name, None)
+                return
+            setattr(self, name, make_int(value))
+        elif name in CACHE_ENTRY_SLOTS:
+            setattr(self, name, value)
+        elif name not in TIMESTAMP_STR_FIELDS:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+
+    def __delitem__(self, name):
+        if name in CACHE_ENTRY_SLOTS:
+            try:
+                delattr(self, name)
+            except AttributeError:
+                raise KeyError(name) from None
+        elif self._extra is not None and name in self._extra:
+            del self._extra[name]
+        else:
+            raise KeyError(name)
+
+    def __iter__(self):
+        for name in CACHE_ENTRY_SLOTS_ORDER:
+            if hasattr(self, name):
+                yield name
+        for name, timestamp_name in TIMESTAMP_STR_FIELDS.items():
+            if hasattr(self, timestamp_name):
+                yield name
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'CacheEntry(%r)' % dict(self)
+
+    # Returns a function that makes an entry from a row of values in the
+    #  order of field_names, as read from a CSV file.  Loading large caches
+    #  is dominated by this, so slots are set directly
+    @classmethod
+    def row_loader(cls, field_names):
+        width = len(field_names)
+        columns = list(enumerate(field_names))
+        slot_columns = [(index, name) for index, name in columns
+                        if name in CACHE_ENTRY_SLOTS
+                        and name not in INTEGER_FIELDS]
+        int_columns = [(index, name) for index, name in columns
+                       if name in INTEGER_FIELDS]
+        other_columns = [(index, name) for index, name in columns
+                         if name not in CACHE_ENTRY_SLOTS
+                         and name not in TIMESTAMP_STR_FIELDS]
+        new_entry = cls.__new__
+
+        def load_row(row):
+            if len(row) != width:
+                return cls(zip(field_names, row))
+            entry = new_entry(cls)
+            entry._extra = None
+            for index, name in slot_columns:
+                setattr(entry, name, row[index])
+            for index, name in int_columns:
+                if row[index]:
+                    setattr(entry, name, make_int(row[index]))
+            for index, name in other_columns:
+                entry[name] = row[index]
+            return entry
+
+        return load_row
+
+
+CACHE_ENTRY_SLOTS_ORDER = [name for name in CacheEntry.__slots__
+                           if name != '_extra']
+CACHE_ENTRY_SLOTS = frozenset(CACHE_ENTRY_SLOTS_ORDER)
+
+
+# Photo cache shared by every generator in a build.  Entries are loaded
+#  lazily on first use and saved once, when Pelican finishes the build
+class PhotoCache(object):
+    def __init__(self, cache_cfg):
+        self.cache_cfg = cache_cfg
+        self.key_field = cache_cfg['key_field']
+        self.backend = get_cache_backend(cache_cfg)
+        self.lock = threading.Lock()
+        self.stats = {'loaded': 0, 'hits': 0, 'misses': 0, 'written': 0}
+        self.dirty_keys = set()
+        self.deleted_keys = set()
+        self.bulk_warmed = False
+        # When each photo last changed, from revalidation listings
+        self.last_updates = None
+        self._entries = None
+
+        index_filename = cache_cfg.get('document_index_filename', None)
+        self.document_index = \
+            DocumentIndex(index_filename) if index_filename else None
+        self.journal = CacheJournal(self.backend.filename + '.journal') \
+            if cache_cfg.get('journal', False) else None
+
+        # The photos used by this build, for compaction
+        self.seen_ids = set()
+        archive_filename = cache_cfg.get('archive_filename', None)
+        self.archive = CacheArchive(cache_cfg, archive_filename) \
+            if archive_filename else None
+        self.compaction_stats = None
+
+    @property
+    def entries(self):
+        with self.lock:
+            if self._entries is None:
+                entries = timed('cache_load', self.backend.load)
+                self.stats['loaded'] = len(entries)
+                if self.journal is not None:
+                    self.replay_journal(entries)
+                self._entries = entries
+        return self._entries
+
+    # Brings loaded entries up to date with those journaled by a build that
+    #  stopped before saving the cache
+    def replay_journal(self, entries):
+        replayed = self.journal.replay()
+        for entry in replayed:
+            pic_id = entry[self.key_field]
+            entries[pic_id] = CacheEntry(entry)
+            self.dirty_keys.add(pic_id)
+        if replayed:
+            logger.info('[flickr_insert]: Recovered %d cache entries from'
+                        ' %s' % (len(replayed), self.journal.filename))
+
+    @property
+    def is_loaded(self):
+        return self._entries is not None
+
+    def get(self, pic_id, default=None):
+        return self.entries.get(pic_id, default)
+
+    def items(self):
+        return self.entries.items()
+
+    def __getitem__(self, pic_id):
+        return self.entries[pic_id]
+
+    def __setitem__(self, pic_id, entry):
+        if not isinstance(entry, CacheEntry):
+            entry = CacheEntry(entry)
+        self.entries[pic_id] = entry
+        self.dirty_keys.add(pic_id)
+
+    def __contains__(self, pic_id):
+        return pic_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns the entry for a photo, adding an empty one (a miss) if the
+    #  photo isn't cached yet
+    def get_entry(self, pic_id):
+        entry = self.entries.get(pic_id, None)
+        if entry:
+            self.stats['hits'] += 1
+        else:
+            self.stats['misses'] += 1
+            self[pic_id] = {self.key_field: pic_id}
+            entry = self.entries[pic_id]
+        return entry
+
+    # Flags an entry as changed so that the backend writes it out
+    def mark_dirty(self, pic_id):
+        self.dirty_keys.add(pic_id)
+
+    def remove(self, pic_id):
+        self.entries.pop(pic_id, None)
+        self.dirty_keys.discard(pic_id)
+        self.deleted_keys.add(pic_id)
+
+    # Brings the given photos' entries up to date from a shared cache, when
+    #  the backend has one.  Returns the number of entries taken from it
+    def fetch_shared(self, photo_ids):
+        get_many = getattr(self.backend, 'get_many', None)
+        if get_many is None:
+            return 0
+
+        entries = self.entries
+        merged = 0
+        for pic_id, entry in get_many(photo_ids).items():
+            local = entries.get(pic_id, None)
+            if local is None or make_int(local.get('last_updated', 0)) < \
+                    make_int(entry.get('last_updated', 0)):
+                # Another site's record of when it used the photo would
+                #  throw off this site's compaction
+                entry = {name: value for name, value in entry.items()
+                         if name not in SITE_FIELDS}
+                if local is not None:
+                    entry.update((name, local[name]) for name in SITE_FIELDS
+                                 if name in local)
+                self[pic_id] = entry
+                merged += 1
+        if merged:
+            logger.info('[flickr_insert]: Took %d cache entries from the'
+                        ' shared cache' % merged)
+        return merged
+
+    # Brings back the archived entries of any of the given photos missing
+    #  from the cache.  Returns the number restored
+    def restore_archived(self, photo_ids):
+        if self.archive is None:
+            return 0
+        missing = [pic_id for pic_id in photo_ids
+                   if pic_id not in self.entries]
+        if not missing:
+            return 0
+        restored = self.archive.take(missing)
+        for pic_id, entry in restored.items():
+            self[pic_id] = entry
+        if restored:
+            logger.info('[flickr_insert]: Restored %d cache entries from'
+                        ' %s' % (len(restored), self.archive.filename))
+        return len(restored)
+
+    def mark_seen(self, photo_ids):
+        self.seen_ids.update(photo_ids)
+
+    # Records which photos this build used, then removes the entries of
+    #  photos unused for evict_after_builds builds and evict_after_days
+    #  days, moving them to the archive if there is one.  Builds are
+    #  numbered from the entries themselves, one past the highest
+    #  last_seen_build.  A used entry is only marked dirty once its stored
+    #  bookkeeping is half way to eviction, so that backends which save
+    #  dirty entries alone don't rewrite every used entry on every build;
+    #  one used entry is always written, to store the build number.
+    #  Returns what was removed, or None if compaction is off or the cache
+    #  was never loaded
+    def compact(self, cur_time):
+        max_builds = self.cache_cfg.get('evict_after_builds', None)
+        max_days = self.cache_cfg.get('evict_after_days', None)
+        if (max_builds is None and max_days is None) or not self.is_loaded:
+            return None
+
+        entries = self.entries
+        build = 1 + max((entry.get('last_seen_build', 0)
+                         for entry in entries.values()), default=0)
+        evicted = {}
+        build_stored = False
+        last_used_id = None
+        for pic_id, entry in entries.items():
+            if pic_id in self.seen_ids or 'last_seen_build' not in entry:
+                # Entries from before compaction was turned on count as
+                #  used now
+                if needs_seen_update(entry, build, cur_time, max_builds,
+                                     max_days):
+                    self.dirty_keys.add(pic_id)
+                build_stored = build_stored or pic_id in self.dirty_keys
+                entry['last_seen'] = cur_time
+                entry['last_seen_build'] = build
+                last_used_id = pic_id
+            elif is_unused_entry(entry, build, cur_time, max_builds,
+                                 max_days):
+                evicted[pic_id] = entry
+        if not build_stored and last_used_id is not None:
+            self.dirty_keys.add(last_used_id)
+
+        for pic_id in evicted:
+            self.remove(pic_id)
+        if self.archive is not None and evicted:
+            self.archive.add(evicted)
+
+        self.compaction_stats = {
+            'build': build,
+            'before': len(entries) + len(evicted),
+            'after': len(entries),
+            'evicted': len(evicted),
+            'archived': len(evicted) if self.archive is not None else 0,
+        }
+        return self.compaction_stats
+
+    # Records an updated entry in the journal, if there is one
+    def journal_entry(self, entry):
+        if self.journal is not None:
+            self.journal.append(entry)
+
+    # Syncs the entries journaled so far to disk
+    def sync_journal(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def save(self):
+        if not self.is_loaded:
+            return
+        self.stats['written'] = timed(
+            'cache_save', self.backend.save,
+            self.entries, self.dirty_keys, self.deleted_keys)
+        self.dirty_keys = set()
+        self.deleted_keys = set()
+
+        # Everything journaled is now in the cache file
+        if self.journal is not None:
+            self.journal.clear()
+
+        if self.archive is not None:
+            self.archive.save()
+
+        if self.document_index is not None:
+            self.document_index.save()
+
+
+# Write-ahead log of refreshed cache entries, one JSON object per line.
+#  Each entry is written out as soon as it arrives from Flickr, so a build
+#  that is killed before saving the cache loses none of its API calls.
+#  Entries are only synced to disk, which is slow, by sync(): once for each
+#  batch of fetches rather than once per entry
+class CacheJournal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.file = None
+        self.unsynced = False
+        self.stats = {'entries': 0, 'syncs': 0}
+
+    def append(self, entry):
+        line = json.dumps(dict(entry), sort_keys=True) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filename, 'a')
+            self.file.write(line)
+            self.file.flush()
+            self.unsynced = True
+            self.stats['entries'] += 1
+
+    def sync(self):
+        with self.lock:
+            if self.file is None or not self.unsynced:
+                return
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+            self.stats['syncs'] += 1
+
+    # Returns the journaled entries, oldest first.  A line cut short by a
+    #  crash, and anything after it, is ignored
+    def replay(self):
+        entries = []
+        try:
+            with open(self.filename) as journal_file:
+                for line in journal_file:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def clear(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            self.unsynced = False
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+
+
+# Entries removed from the cache by compaction, kept in a CSV file of their
+#  own so that a photo used again is restored rather than fetched from
+#  Flickr.  The file is only read when a photo is missing from the cache
+class CacheArchive(object):
+    def __init__(self, cache_cfg, filename):
+        self.filename = filename
+        self.backend = CsvCacheBackend(dict(cache_cfg, filename=filename))
+        self.changed = False
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self.backend.load()
+        return self._entries
+
+    def add(self, entries):
+        self.entries.update(entries)
+        self.changed = True
+
+    # Removes and returns the archived entries of the given photos
+    def take(self, photo_ids):
+        taken = {pic_id: self.entries.pop(pic_id) for pic_id in photo_ids
+                 if pic_id in self.entries}
+        if taken:
+            self.changed = True
+        return taken
+
+    def save(self):
+        if self.changed:
+            self.backend.save(self.entries, set(self.entries))
+            self.changed = False
+
+
+# Returns True if a cache entry hasn't been used for at least max_builds
+#  builds and max_days days; a limit of None always counts as reached
+def is_unused_entry(entry, build, cur_time, max_builds=None, max_days=None):
+    if max_builds is not None and \
+            build - entry.get('last_seen_build', 0) < max_builds:
+        return False
+    if max_days is not None and \
+            cur_time - entry.get('last_seen', 0) < max_days * 86400:
+        return False
+    return True
+
+
+# Returns True if the last_seen and last_seen_build stored for a used entry
+#  are half way or more to making it unused, or missing
+def needs_seen_update(entry, build, cur_time, max_builds=None,
+                      max_days=None):
+    if 'last_seen_build' not in entry:
+        return True
+    if max_builds is not None and \
+            build - entry['last_seen_build'] >= max(1, max_builds // 2):
+        return True
+    if max_days is not None and \
+            cur_time - entry.get('last_seen', 0) >= max_days * 86400 // 2:
+        return True
+    return False
+
+
+# Cache backends persist cache entries.  load() returns a dictionary of
+#  entries keyed by photo id; save() is given all entries plus the keys of
+#  those changed and removed since loading, and returns the number of
+#  entries written
+class CsvCacheBackend(object):
+    def __init__(self, cache_cfg):
+        self.filename = cache_cfg['filename']
+        self.key_field = cache_cfg['key_field']
+        self.field_names = get_cache_field_names(cache_cfg)
+
+    def load(self):
+        entries = {}
+        try:
+            with open(self.filename) as csv_file:
+                reader = csv.reader(csv_file)
+                field_names = next(reader, None)
+                if field_names:
+                    load_row = CacheEntry.row_loader(field_names)
+                    for row in reader:
+                        if row:
+                            entry = load_row(row)
+                            entries[entry[self.key_field]] = entry
+        except FileNotFoundError:
+            save_cache_to_csv(entries, filename=self.filename,
+                              fieldnames=self.field_names,
+                              key_name=self.key_field)
+        return entries
+
+    # The CSV file is always rewritten in full
+    def save(self, entries, dirty_keys, deleted_keys=()):
+        save_cache_to_csv(entries, filename=self.filename,
+                          fieldnames=self.field_names,
+                          key_name=self.key_field)
+        return len(entries)
+
+
+# Stores one row per photo in an SQLite database, upserting only changed
+#  entries.  An existing CSV cache is migrated when the database is created
+class SqliteCacheBackend(object):
+    table = 'photos'
+
+    def __init__(self, cache_cfg):
+        self.filename = cache_cfg.get('sqlite_filename',
+                                      'flickr_insert_cache.sqlite3')
+        self.csv_filename = cache_cfg['filename']
+        self.key_field = cache_cfg['key_field']
+        self.field_names = get_cache_field_names(cache_cfg)
+        self.columns = [self.key_field] + self.field_names
+
+    def connect(self):
+        conn = sqlite3.connect(self.filename)
+        columns = ['"%s" TEXT PRIMARY KEY' % self.key_field]
+        columns.extend('"%s"' % name for name in self.field_names)
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)'
+                     % (self.table, ', '.join(columns)))
+
+        # Add columns for any field names added since the table was made
+        existing = [row[1] for row in
+                    conn.execute('PRAGMA table_info(%s)' % self.table)]
+        for name in self.field_names:
+            if name not in existing:
+                conn.execute('ALTER TABLE %s ADD COLUMN "%s"'
+                             % (self.table, name))
+
+        # The primary key already indexes the key field
+        if 'next_update' in self.field_names:
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_next_update'
+                         ' ON %s (next_update)' % (self.table, self.table))
+        return conn
+
+    def load(self):
+        is_new = not os.path.exists(self.filename)
+        conn = self.connect()
+        try:
+            if is_new and os.path.exists(self.csv_filename):
+                self.migrate_from_csv(conn)
+
+            cursor = conn.execute(
+                'SELECT %s FROM %s' % (self.column_list(), self.table))
+            entries = {}
+            for row in cursor:
+                entry = CacheEntry((name, value) for name, value
+                                   in zip(self.columns, row)
+                                   if value is not None)
+                entries[entry[self.key_field]] = entry
+            return entries
+        finally:
+            conn.close()
+
+    def save(self, entries, dirty_keys, deleted_keys=()):
+        rows = [self.make_row(entries[key])
+                for key in sorted(dirty_keys) if key in entries]
+        if not rows and not deleted_keys:
+            return 0
+
+        conn = self.connect()
+        try:
+            with conn:
+                self.upsert(conn, rows)
+                conn.executemany(
+                    'DELETE FROM %s WHERE "%s" = ?'
+                    % (self.table, self.key_field),
+                    [(key,) for key in sorted(deleted_keys)])
+        finally:
+            conn.close()
+        return len(rows)
+
+    def migrate_from_csv(self, conn):
+        entries = load_cache_from_csv(self.csv_filename,
+                                      key_name=self.key_field)
+        with conn:
+            self.upsert(conn, [self.make_row(entry)
+                               for _, entry in sorted(entries.items())])
+        logger.info('[flickr_insert]: Migrated %d cache entries from %s'
+                    % (len(entries), self.csv_filename))
+
+    def upsert(self, conn, rows):
+        conn.executemany(
+            'INSERT OR REPLACE INTO %s (%s) VALUES (%s)'
+            % (self.table, self.column_list(),
+               ', '.join('?' * len(self.columns))),
+            rows)
+
+    def column_list(self):
+        return ', '.join('"%s"' % name for name in self.columns)
+
+    # Timestamps are stored as integers so next_update sorts correctly
+    def make_row(self, entry):
+        row = []
+        for name in self.columns:
+            value = entry.get(name, None)
+            if name in INTEGER_FIELDS and value is not None:
+                value = make_int(value)
+            row.append(value)
+        return row
+
+
+# Remembers, for the source content of each document, which photos it
+#  uses and what it was rewritten to, so that documents which haven't
+#  changed since the last build can skip parsing and rendering
+class DocumentIndex(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+        # Only the documents seen in this build are saved
+        self.seen = {}
+        self._documents = None
+
+    @property
+    def documents(self):
+        with self.lock:
+            if self._documents is None:
+                try:
+                    with open(self.filename) as index_file:
+                        self._documents = json.load(index_file)
+                except (IOError, ValueError):
+                    self._documents = {}
+        return self._documents
+
+    # Splits documents into those with an index entry, returned as
+    #  (document, content hash, entry), and those without
+    def partition(self, documents, fingerprint):
+        indexed = []
+        unindexed = []
+        for document in documents:
+            content_hash = hash_content(document._content)
+            entry = self.documents.get(content_hash, None)
+            if entry and entry['fingerprint'] == fingerprint:
+                indexed.append((document, content_hash, entry))
+            else:
+                unindexed.append(document)
+                self.stats['misses'] += 1
+        return indexed, unindexed
+
+    # Keeps an entry if none of its photos have changed in the cache, or
+    #  in which of their sizes are mirrored
+    def reuse(self, content_hash, entry, cache):
+        for pic_id, version in entry['photos'].items():
+            if get_photo_output_version(cache.get(pic_id, {})) != version:
+                self.stats['misses'] += 1
+                return False
+
+        self.stats['hits'] += 1
+        self.seen[content_hash] = entry
+        return True
+
+    def add(self, content_hash, fingerprint, photo_ids, cache, output):
+        self.seen[content_hash] = {
+            'fingerprint': fingerprint,
+            'photos': {pic_id: get_photo_output_version(cache.get(pic_id, {}))
+                       for pic_id in photo_ids},
+            'output': output,
+        }
+
+    def save(self):
+        if self._documents is None:
+            return
+        write_file_atomically(
+            self.filename,
+            lambda index_file: json.dump(self.seen, index_file,
+                                         sort_keys=True))
+
+
+# Identifies what a document's output depends on for one of its photos: the
+#  version of its cache entry and the local copy of each of its sizes
+#  mirrored in this build, as a JSON-compatible list
+def get_photo_output_version(cache_entry):
+    mirrored = []
+    base = cache_entry.get('insert_image_url_base', None)
+    if base and mirrored_images:
+        for letter in sorted(photo_suffix_sizes):
+            image = mirrored_images.get(base + letter + '.jpg', None)
+            if image is not None:
+                mirrored.append([letter, image['url'], image['width'],
+                                 image['height']])
+    return list(get_cache_entry_version(cache_entry)) + [mirrored]
+
+
+def hash_content(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+# Identifies how snippets are rendered: the template and the values it
+#  uses from the context.  Returns None when the template isn't known
+def get_render_fingerprint(template_source, context):
+    worker_ctx = get_worker_context(template_source, context)
+    if worker_ctx is None:
+        return None
+    return hash_content(template_source + repr(sorted(worker_ctx.items())))
+
+
+# Shares entries between sites through a cache server, keeping a full copy
+#  in a local backend.  A build's photos are fetched from the server in one
+#  request and changed entries are sent back when the cache is saved.  If
+#  the server can't be reached the local copy is used alone
+class RemoteCacheBackend(object):
+    def __init__(self, cache_cfg):
+        self.url = (cache_cfg.get('remote_url', None) or '').rstrip('/')
+        if not self.url:
+            raise Exception('The remote FLICKR_INSERT_CACHE_CFG backend'
+                            ' needs a remote_url')
+        self.timeout = cache_cfg.get('remote_timeout', 5)
+        local_name = cache_cfg.get('remote_local_backend', 'csv')
+        if local_name == 'remote':
+            raise Exception('remote_local_backend cannot be remote')
+        self.local = get_cache_backend(dict(cache_cfg, backend=local_name))
+        self.filename = self.local.filename
+        # last_updated of each entry as the server last sent or was sent it
+        self.shared = {}
+        self.requested = set()
+        self.available = True
+
+    def load(self):
+        return self.local.load()
+
+    # Returns the server's entries for those of the photos not already
+    #  asked for
+    def get_many(self, photo_ids):
+        photo_ids = sorted(set(photo_ids) - self.requested)
+        if not photo_ids or not self.available:
+            return {}
+        self.requested.update(photo_ids)
+
+        response = self.request('/photos/get', {'ids': photo_ids})
+        entries = response.get('photos', {}) if response else {}
+        for pic_id, entry in entries.items():
+            self.shared[pic_id] = make_int(entry.get('last_updated', 0))
+        return entries
+
+    def save(self, entries, dirty_keys, deleted_keys=()):
+        written = self.local.save(entries, dirty_keys, deleted_keys)
+
+        # Send only what this site learned from Flickr, not what it was
+        #  sent, and nothing without photo information
+        shared = {}
+        for pic_id in dirty_keys:
+            entry = entries.get(pic_id, None)
+            if entry is None or not has_flickr_info(entry):
+                continue
+            last_updated = make_int(entry.get('last_updated', 0))
+            if self.shared.get(pic_id, None) == last_updated:
+                continue
+            shared[pic_id] = {name: value for name, value in entry.items()
+                              if name not in SITE_FIELDS}
+        if shared and self.available and \
+                self.request('/photos/put', {'photos': shared}) is not None:
+            for pic_id, entry in shared.items():
+                self.shared[pic_id] = make_int(entry.get('last_updated', 0))
+        return written
+
+    # Sends a JSON request, returning the response or None if the server
+    #  couldn't be reached.  After a failure the server isn't tried again
+    #  this build
+    def request(self, path, body):
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except (IOError, ValueError) as e:
+            logger.warning('[flickr_insert]: Shared cache at %s unavailable,'
+                           ' using the local cache: %s' % (self.url, e))
+            self.available = False
+            return None
+
+
+CACHE_BACKENDS = {
+    'csv': CsvCacheBackend,
+    'sqlite': SqliteCacheBackend,
+    'remote': RemoteCacheBackend,
+}
+
+
+def get_cache_backend(cache_cfg):
+    backend_name = cache_cfg.get('backend', 'csv')
+    try:
+        backend_class = CACHE_BACKENDS[backend_name]
+    except KeyError:
+        raise Exception('Unknown FLICKR_INSERT_CACHE_CFG backend: '
+                        + backend_name)
+    return backend_class(cache_cfg)
+
+
+_photo_cache = None
+
+
+def log_flickr_client_stats(client):
+    stats = client.get_stats()
+    if not stats['calls'] and not stats['rejected']:
+        return
+    logger.info('[flickr_insert]: Flickr API calls: %(calls)d,'
+                ' errors: %(errors)d, retries: %(retries)d,'
+                ' suspended: %(rejected)d' % stats)
+    for method_name, method_stats in sorted(stats['methods'].items()):
+        logger.info('[flickr_insert]: %s latency mean %.0f ms, max %.0f ms'
+                    % (method_name, method_stats['mean'] * 1000,
+                       method_stats['max'] * 1000))
+    if isinstance(client.flickr, AsyncFlickrAPI):
+        logger.info('[flickr_insert]: HTTP requests: %(requests)d, over'
+                    ' %(connections)d connections (%(reused)d reused one)'
+                    % client.flickr.get_stats())
+
+
+# Returns the cache for the current build, creating it if needed
+def get_photo_cache(cache_cfg):
+    global _photo_cache
+    if _photo_cache is None:
+        _photo_cache = PhotoCache(cache_cfg)
+    return _photo_cache
+
+
+# Saves the build's cache and starts afresh for the next build; connected
+#  to Pelican's finalized signal
+def flush_photo_cache(pelican_obj=None):
+    global _photo_cache, _flickr_client, _photo_lookups, _refresh_budget, \
+        _build_profile, _image_mirror
+    finish_background_refreshes()
+
+    if _image_mirror is not None:
+        _image_mirror.save()
+        logger.info('[flickr_insert]: Images downloaded: %(downloaded)d,'
+                    ' already stored: %(stored)d, failed: %(failed)d'
+                    % _image_mirror.stats)
+        _image_mirror = None
+    mirrored_images.clear()
+
+    client_stats = None
+    if _flickr_client is not None:
+        client_stats = _flickr_client.get_stats()
+        log_flickr_client_stats(_flickr_client)
+        _flickr_client.close()
+        _flickr_client = None
+
+    if _photo_lookups is not None:
+        logger.info('[flickr_insert]: Photos looked up: %(resolved)d,'
+                    ' API calls saved by sharing lookups: %(shared)d'
+                    % _photo_lookups.stats)
+        _photo_lookups = None
+
+    report_days = 14
+    if _refresh_budget is not None:
+        if _refresh_budget.stats['deferred']:
+            logger.info('[flickr_insert]: Refreshes deferred to later'
+                        ' builds: %(deferred)d' % _refresh_budget.stats)
+        report_days = _refresh_budget.report_days
+        _refresh_budget = None
+
+    cache = _photo_cache
+    if cache is None:
+        _build_profile = None
+        clear_render_cache()
+        return
+
+    compaction = cache.compact(int(time.time()))
+    cache.save()
+    _photo_cache = None
+
+    profile = _build_profile
+    _build_profile = None
+
+    if compaction is not None:
+        compaction['seconds_saved'] = get_compaction_savings(compaction,
+                                                             profile)
+        log_compaction_stats(compaction)
+
+    if profile is not None:
+        report = get_build_report(profile, cache, client_stats)
+        if profile.report:
+            log_build_report(report)
+        profile.save(report)
+
+    if cache.is_loaded:
+        log_refresh_load_report(cache, int(time.time()), report_days)
+
+    logger.info('[flickr_insert]: Cache entries loaded: %(loaded)d,'
+                ' hits: %(hits)d, misses: %(misses)d,'
+                ' written: %(written)d' % cache.stats)
+    logger.info('[flickr_insert]: Snippets rendered: %(renders)d,'
+                ' reused: %(hits)d' % render_stats)
+    if cache.document_index is not None:
+        logger.info('[flickr_insert]: Unchanged documents reused: %(hits)d,'
+                    ' rewritten: %(misses)d' % cache.document_index.stats)
+    clear_render_cache()
+    return cache.stats
+
+
+# Summarizes a build: the photos in its documents, how the cache and Flickr
+#  were used and the time taken by each stage.  Times are in seconds
+def get_build_report(profile, cache, client_stats=None):
+    client_stats = client_stats or {}
+    return {
+        'photos': len(profile.photo_ids),
+        'cache': dict(cache.stats),
+        'api_calls': client_stats.get('calls', 0),
+        'api_errors': client_stats.get('errors', 0),
+        'renders': dict(render_stats),
+        'stages': profile.get_stage_stats(),
+        'compaction': cache.compaction_stats,
+    }
+
+
+# Estimates the seconds of cache loading and saving that compaction saves
+#  each later build, from this build's times and the share of entries
+#  removed, or None without a build profile
+def get_compaction_savings(compaction, profile):
+    if profile is None or not compaction['before']:
+        return None
+    stages = profile.get_stage_stats()
+    seconds = sum(stages[name]['total'] for name in ('cache_load',
+                                                     'cache_save')
+                  if name in stages)
+    return seconds * compaction['evicted'] / compaction['before']
+
+
+def log_compaction_stats(compaction):
+    if not compaction['evicted']:
+        return
+    message = '[flickr_insert]: Cache compacted from %(before)d to' \
+              ' %(after)d entries (%(archived)d archived)' % compaction
+    if compaction['seconds_saved'] is not None:
+        message += ', saving about %.0f ms of cache load and save per' \
+                   ' build' % (compaction['seconds_saved'] * 1000)
+    logger.info(message)
+
+
+def log_build_report(report):
+    logger.info('[flickr_insert]: Build report: %d photos, cache hits: %d,'
+                ' misses: %d, API calls: %d'
+                % (report['photos'], report['cache']['hits'],
+                   report['cache']['misses'], report['api_calls']))
+    for stage, stage_stats in sorted(report['stages'].items()):
+        logger.info('[flickr_insert]: %-16s %6d calls, %8.1f ms total,'
+                    ' p50 %.2f ms, p95 %.2f ms'
+                    % (stage, stage_stats['calls'],
+                       stage_stats['total'] * 1000,
+                       stage_stats['p50'] * 1000, stage_stats['p95'] * 1000))
+
+
 def get_photo_id_and_url(photo_dict, id_field="id"):
     pic_id = photo_dict.get(id_field, photo_dict.get('id', None))
 
@@ -280,115 +2170,1053 @@ def ensure_photo_float(photo):
 
 
 def replace_document_tags(generator):
-    # Setup cache
-    cache_cfg = generator.settings.get('FLICKR_INSERT_CACHE_CFG')
-    key_field = cache_cfg['key_field']
-    cache_loader = load_cache_from_csv
-    cache_saver = save_cache_to_csv
-    cache = cache_loader(cache_cfg['filename'], key_name=key_field)
+    profile = get_build_profile(
+        generator.settings.get('FLICKR_INSERT_PROFILE'))
+    profile.profiled(_replace_document_tags, generator, profile)
+
+
+def _replace_document_tags(generator, profile):
+    # The cache is shared across generators and saved by flush_photo_cache
+    cache = get_photo_cache(generator.settings.get('FLICKR_INSERT_CACHE_CFG'))
 
     logger.info('[flickr_insert]: Looking for flickr tags in content')
 
+    # Documents without tags need no substitution, and aren't indexed
+    documents = [document for document in get_generator_documents(generator)
+                 if any(iter_flickr_tags(document._content))]
+
+    # Documents rewritten by an earlier build are set aside; only the
+    #  photos recorded for them need checking
+    flickr_ctx = generator.context.get('flickr_insert_ctx', None)
+    index = cache.document_index if flickr_ctx else None
+    fingerprint = None
+    indexed = []
+    mirror_cfg = generator.settings.get('FLICKR_INSERT_MIRROR', None)
+    if index is not None:
+        fingerprint = get_render_fingerprint(flickr_ctx['template_source'],
+                                             generator.context)
+    if fingerprint is not None and mirror_cfg and mirror_cfg.get('enabled'):
+        fingerprint = hash_content(fingerprint + repr(sorted(
+            mirror_cfg.items())))
+    if fingerprint is not None:
+        indexed, documents = index.partition(documents, fingerprint)
+
+    # Fetch everything the cache is missing up front, so that the
+    #  substitution pass below works only from the in-memory cache
+    photo_ids = prefetch_flickr_info(
+        documents, generator, cache,
+        extra_photo_ids=chain.from_iterable(
+            entry['photos'] for _, _, entry in indexed))
+    profile.photo_ids.update(photo_ids)
+    cache.mark_seen(photo_ids)
+
+    mirror = get_image_mirror(generator.settings)
+    if mirror is not None:
+        # Sizes tags ask for are mirrored too, for indexed documents as well
+        #  as those about to be rendered
+        tag_suffixes = get_tag_size_suffixes(
+            chain(documents, (document for document, _, _ in indexed)),
+            cache.cache_cfg['key_field'])
+        # cache_only builds make no network connections at all
+        mirror.mirror(get_mirror_urls(cache, photo_ids,
+                                      mirror_cfg.get('suffixes', ()),
+                                      tag_suffixes),
+                      download=generator.settings.get(
+                          'FLICKR_INSERT_MODE', 'online') != 'cache_only')
+
+    # Reuse the earlier output of documents whose photos haven't changed
+    for document, content_hash, entry in indexed:
+        if index.reuse(content_hash, entry, cache):
+            document._content = entry['output']
+        else:
+            documents.append(document)
+
+    source_hashes = [hash_content(document._content)
+                     for document in documents] if fingerprint else []
+
+    processes = generator.settings.get('FLICKR_INSERT_PROCESSES', 0)
+    threshold = generator.settings.get('FLICKR_INSERT_PROCESS_THRESHOLD', 0)
+    if processes > 1 and photo_ids and len(documents) >= threshold:
+        document_photo_ids = replace_tags_in_documents_parallel(
+            documents, generator, cache, photo_ids, processes)
+    else:
+        document_photo_ids = [
+            replace_tags_in_document(document, generator, cache)
+            for document in documents]
+
+    for content_hash, document, document_photos in zip(
+            source_hashes, documents, document_photo_ids):
+        index.add(content_hash, fingerprint, document_photos, cache,
+                  document._content)
+
+
+# Returns the documents of a generator that may contain [flickr:] tags
+def get_generator_documents(generator):
+    documents = []
+
     # For articles and draft articles
     if isinstance(generator, ArticlesGenerator):
-        for document in chain(generator.articles, generator.drafts):
-            replace_tags_in_document(document, generator, cache)
+        documents.extend(chain(generator.articles, generator.drafts))
 
     # For pages
     if isinstance(generator, PagesGenerator):
-        for document in chain(generator.pages, generator.hidden_pages):
-            replace_tags_in_document(document, generator, cache)
+        documents.extend(chain(generator.pages, generator.hidden_pages))
 
-    # Save away cache
-    cache_saver(cache, filename=cache_cfg['filename'],
-                fieldnames=cache_cfg['field_names'], key_name=key_field)
+    return documents
 
 
-def replace_tags_in_document(document, generator, cache):
+# Gather and clean a [flickr:] tag from article content
+def get_photo_from_tag(tag_str, key_field):
+    photo = parse_flickr_tag(tag_str)
+    photo.update(get_photo_id_and_url(photo, id_field=key_field))
+    photo.update(ensure_photo_size(photo))
+    photo.update(ensure_photo_show_caption(photo))
+    photo.update(ensure_photo_float(photo))
+
+    return photo
+
+
+# Scans all documents for [flickr:] tags, works out which photos need
+#  fresh information and fetches them concurrently into the cache, along
+#  with any extra_photo_ids.  Returns the set of photo ids found
+def prefetch_flickr_info(documents, generator, cache, extra_photo_ids=()):
     # Note that cache is modified in this function with any updates
 
     flickr_ctx = generator.context.get('flickr_insert_ctx', None)
     if not flickr_ctx:
-        return
+        return set()
 
     cache_cfg = flickr_ctx['cache_cfg']
     key_field = cache_cfg['key_field']
-    # cache = flickr_ctx['cache']
+    cur_time = flickr_ctx['cur_time']
+
+    document_photo_ids = [
+        get_photo_from_tag(match.group(2), key_field)[key_field]
+        for document in documents
+        for match in iter_flickr_tags(document._content)]
+    extra_photo_ids = list(extra_photo_ids)
+
+    # Photos removed from the cache by compaction, and used again, come
+    #  back from the archive; other sites may already have fetched them
+    cache.restore_archived(chain(document_photo_ids, extra_photo_ids))
+    cache.fetch_shared(chain(document_photo_ids, extra_photo_ids))
+
+    seen_ids = set()
+    pending_updates = get_pending_updates(
+        cache, chain(document_photo_ids, extra_photo_ids), cur_time,
+        cache_cfg, seen_ids=seen_ids)
+
+    mode = generator.settings.get('FLICKR_INSERT_MODE', 'online')
+    if mode == 'cache_only':
+        log_offline_report(get_offline_report(cache, pending_updates))
+        return seen_ids
+
+    budget = get_refresh_budget(
+        generator.settings.get('FLICKR_INSERT_REFRESH_BUDGET'))
+    max_workers = generator.settings.get('FLICKR_INSERT_MAX_WORKERS', 1)
+
+    # Most photos due a refresh haven't changed; a few listing calls can
+    #  tell which, rather than one photos.getInfo call per photo
+    revalidate = generator.settings.get('FLICKR_INSERT_REVALIDATE', None)
+    if pending_updates and revalidate and revalidate.get('user_ids'):
+        pending_updates = revalidate_cache_entries(
+            flickr_ctx['flickr_conn'], cache, pending_updates, cur_time,
+            cache_cfg, **revalidate)
+
+    if mode == 'cache_first_async':
+        # Only photos with nothing cached hold up the build
+        stale_updates = {pic_id: item_update
+                         for pic_id, item_update in pending_updates.items()
+                         if has_flickr_info(cache[pic_id])}
+        if stale_updates:
+            start_background_refresh(
+                flickr_ctx['flickr_conn'], cache, stale_updates, cur_time,
+                cache_cfg, max_workers=max_workers, budget=budget)
+        pending_updates = {pic_id: item_update
+                           for pic_id, item_update in pending_updates.items()
+                           if pic_id not in stale_updates}
+
+    # Listing whole albums refreshes hundreds of entries per API call, so
+    #  try that first and only look up what it didn't cover
+    bulk_warm = generator.settings.get('FLICKR_INSERT_BULK_WARM', None)
+    if pending_updates and bulk_warm and not cache.bulk_warmed:
+        cache.bulk_warmed = True
+        if warm_cache_from_listings(flickr_ctx['flickr_conn'], cache,
+                                    cur_time, cache_cfg, **bulk_warm):
+            pending_updates = get_pending_updates(
+                cache, pending_updates, cur_time, cache_cfg)
+
+    if not pending_updates:
+        return seen_ids
+
+    logger.info('[flickr_insert]: Fetching info for %d of %d photos'
+                % (len(pending_updates), len(seen_ids)))
+
+    refresh_cache_entries(
+        flickr_ctx['flickr_conn'], cache, pending_updates, cur_time,
+        cache_cfg, max_workers=max_workers, budget=budget)
+
+    return seen_ids
+
+
+# Lists the photos a cache_only build could not bring up to date: those
+#  with nothing cached and those due a refresh
+def get_offline_report(cache, pending_updates):
+    report = {'missing': [], 'stale': []}
+    for pic_id in sorted(pending_updates):
+        if has_flickr_info(cache[pic_id]):
+            report['stale'].append(pic_id)
+        else:
+            report['missing'].append(pic_id)
+    return report
+
+
+def log_offline_report(report):
+    if report['missing']:
+        logger.warning('[flickr_insert]: %d photos are not cached and'
+                       ' will render without Flickr information: %s'
+                       % (len(report['missing']),
+                          ', '.join(report['missing'])))
+    if report['stale']:
+        logger.info('[flickr_insert]: %d photos are due a refresh and'
+                    ' render from the cache: %s'
+                    % (len(report['stale']), ', '.join(report['stale'])))
+
+
+# Fetches fresh information in a background thread.  Results are only
+#  merged into the cache by finish(), once the build has rendered, so
+#  that a build never mixes old and new information for a photo
+class BackgroundRefresh(object):
+    def __init__(self, flickr, cache, pending_updates, cur_time, cache_cfg,
+                 max_workers=1, budget=None):
+        self.cache = cache
+        self.pending_updates = pending_updates
+        self.cur_time = cur_time
+        self.cache_cfg = cache_cfg
+        self.flickr_infos = {}
+        self.thread = threading.Thread(
+            target=self.run, name='flickr_insert-refresh',
+            args=(flickr, max_workers, budget))
+
+    def start(self):
+        self.thread.start()
+
+    def run(self, flickr, max_workers, budget):
+        try:
+            self.flickr_infos = fetch_flickr_infos(
+                flickr, schedule_refreshes(self.cache, self.pending_updates),
+                max_workers=max_workers, lookups=get_photo_lookups(),
+                budget=budget,
+                on_fetched=get_journal_writer(
+                    self.cache, self.pending_updates, self.cur_time,
+                    self.cache_cfg))
+        except Exception:
+            logger.exception('[flickr_insert]: Background refresh failed')
+        finally:
+            self.cache.sync_journal()
 
-    for match in FLICKR_REGEX.findall(document._content):
+    # Waits for the refresh and merges its results into the cache
+    def finish(self):
+        self.thread.join()
+        return apply_flickr_infos(self.cache, self.pending_updates,
+                                  self.flickr_infos, self.cur_time,
+                                  self.cache_cfg)
 
-        # Gather and clean [flickr:] tag from article content
-        photo = parse_flickr_tag(match[1])
-        photo.update(get_photo_id_and_url(photo, id_field=key_field))
-        photo.update(ensure_photo_size(photo))
-        photo.update(ensure_photo_show_caption(photo))
-        photo.update(ensure_photo_float(photo))
 
-        # Ensure there's a cache entry before calling update
-        # Cache entries look like {"A", {"pic_id": "A", "prop1": "foo"... }
-        if not cache.get(photo[key_field], None):
-            cache[photo[key_field]] = {key_field: photo[key_field]}
+_background_refreshes = []
+
+
+def start_background_refresh(flickr, cache, pending_updates, cur_time,
+                             cache_cfg, max_workers=1, budget=None):
+    logger.info('[flickr_insert]: Refreshing %d photos in the background'
+                % len(pending_updates))
+    refresh = BackgroundRefresh(flickr, cache, pending_updates, cur_time,
+                                cache_cfg, max_workers=max_workers,
+                                budget=budget)
+    _background_refreshes.append(refresh)
+    refresh.start()
+    return refresh
+
+
+# Waits for any background refreshes and merges their results
+def finish_background_refreshes():
+    while _background_refreshes:
+        _background_refreshes.pop(0).finish()
+
 
-        # Pass in a value, not a reference
-        cache_entry = copy.deepcopy(cache[photo[key_field]])
+# Returns the cache updates, keyed by photo id, for the photos that need
+#  fresh information from Flickr.  Entries are added for photos not yet in
+#  the cache, and the ids looked at are added to seen_ids, if given
+def get_pending_updates(cache, photo_ids, cur_time, cache_cfg,
+                        seen_ids=None):
+    if seen_ids is None:
+        seen_ids = set()
 
+    pending_updates = {}
+    for pic_id in photo_ids:
+        if pic_id in seen_ids:
+            continue
+        seen_ids.add(pic_id)
+
+        # Ensure there's a cache entry before calling update
+        # Cache entries look like {"A", {"pic_id": "A", "prop1": "foo"...}
         item_update = get_cache_update_for_item(
-            cache_entry,
-            flickr_ctx['cur_time'],
-            generator.settings.get('FLICKR_INSERT_CACHE_CFG')
-        )
+            cache.get_entry(pic_id), cur_time, cache_cfg)
 
-        # Update cache item as needed
         if item_update['status'] == 'needs_update':
-            flickr_info = get_info_from_flickr(
-                flickr_ctx['flickr_conn'], photo[key_field])
-
-            if flickr_info:
-                # Set a flag to indicate item hasn't changed if
-                # Flickr response is same as cached
-                unchanged = all(item in cache_entry.items() for item in
-                    flickr_info.items())
-
-                # Update with changed Flickr info as needed
-                if not unchanged:
-                    item_update.update(flickr_info)
-                    item_update.update({
-                        'last_changed': flickr_ctx['cur_time'],
-                        'last_changed_str': epoch_to_str(flickr_ctx[
-                                                            'cur_time']),
-                    })
-
-                # Set a next update time for revisiting this item
-                next_update_time = get_next_update_time(
-                    flickr_ctx['cur_time'], cache_cfg)
-
-                # Add details about when this item was checked
-                item_update.update({
-                    'last_updated': flickr_ctx['cur_time'],
-                    'last_updated_str': epoch_to_str(flickr_ctx['cur_time']),
-                    'next_update': next_update_time,
-                    'next_update_str': epoch_to_str(next_update_time)
-                })
-
-                # Update the cache entry and photo dictionary
-                cache[photo[key_field]].update(item_update)
-                photo.update(item_update)
+            pending_updates[pic_id] = item_update
+
+    return pending_updates
+
+
+# Fetches and stores fresh information for the photos in pending_updates
+#  (as from get_pending_updates).  Returns the number of photos refreshed,
+#  deferred by the budget and failed
+def refresh_cache_entries(flickr, cache, pending_updates, cur_time,
+                          cache_cfg, max_workers=1, budget=None):
+    # Refresh the most overdue photos first, leaving whatever is over this
+    #  build's budget until later builds
+    flickr_infos = fetch_flickr_infos(
+        flickr, schedule_refreshes(cache, pending_updates),
+        max_workers=max_workers, lookups=get_photo_lookups(), budget=budget,
+        required_ids={pic_id for pic_id in pending_updates
+                      if not has_flickr_info(cache[pic_id])},
+        on_fetched=get_journal_writer(cache, pending_updates, cur_time,
+                                      cache_cfg))
+    cache.sync_journal()
+
+    return apply_flickr_infos(cache, pending_updates, flickr_infos, cur_time,
+                              cache_cfg)
+
+
+# Returns a function for fetch_flickr_infos that journals what each
+#  successful fetch will make of a photo's cache entry, or None if the
+#  cache has no journal
+def get_journal_writer(cache, pending_updates, cur_time, cache_cfg):
+    if cache.journal is None:
+        return None
+
+    def journal_flickr_info(pic_id, flickr_info):
+        entry = dict(cache[pic_id])
+        if update_cache_entry(entry, dict(pending_updates[pic_id]),
+                              flickr_info, cur_time, cache_cfg):
+            cache.journal_entry(entry)
+
+    return journal_flickr_info
+
+
+# Stores the results of fetch_flickr_infos in the cache.  Returns the number
+#  of photos refreshed, deferred by the budget and failed
+def apply_flickr_infos(cache, pending_updates, flickr_infos, cur_time,
+                       cache_cfg):
+    deferred = len(pending_updates) - len(flickr_infos)
+    if deferred:
+        logger.info('[flickr_insert]: Refresh budget spent; deferring %d'
+                    ' photos to later builds' % deferred)
+
+    failures = 0
+    for pic_id, item_update in pending_updates.items():
+        if pic_id not in flickr_infos:
+            continue
+        if not update_cache_entry(cache[pic_id], item_update,
+                                  flickr_infos[pic_id], cur_time,
+                                  cache_cfg):
+            failures += 1
+        cache.mark_dirty(pic_id)
+
+    if failures:
+        logger.warning('[flickr_insert]: Could not fetch info for %d'
+                       ' photos; using cached information for them'
+                       % failures)
+
+    return {'refreshed': len(flickr_infos) - failures,
+            'deferred': deferred, 'failed': failures}
+
+
+# Calls get_info_from_flickr for each photo id using a bounded pool of
+#  threads, returning a dictionary of photo id to Flickr info.  When given
+#  a SingleFlight registry, each photo is only looked up once through it.
+#  Photos are fetched in the order given; once a RefreshBudget is spent,
+#  photos not in required_ids are left out of the results.  on_fetched, if
+#  given, is called with each photo id and its info as soon as it arrives
+def fetch_flickr_infos(flickr, photo_ids, max_workers=1, lookups=None,
+                       budget=None, required_ids=(), on_fetched=None):
+    def fetch(photo_id):
+        if budget is not None and \
+                not budget.take(required=photo_id in required_ids):
+            return None
+        if lookups is None:
+            info = get_info_from_flickr(flickr, photo_id)
+        else:
+            info = lookups.do(photo_id, get_info_from_flickr, flickr,
+                              photo_id)
+        if on_fetched is not None:
+            on_fetched(photo_id, info)
+        return info
+
+    if max_workers <= 1 or len(photo_ids) <= 1:
+        infos = [fetch(photo_id) for photo_id in photo_ids]
+    else:
+        with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(photo_ids))) as executor:
+            infos = list(executor.map(fetch, photo_ids))
+
+    return {photo_id: info for photo_id, info in zip(photo_ids, infos)
+            if info is not None}
+
+
+# Returns True if an entry has what's needed to render its photo
+def has_flickr_info(cache_entry):
+    return bool(cache_entry.get('insert_image_url_base', None))
+
+
+# Orders photos due a refresh with a priority queue: photos with nothing
+#  cached come first, then the rest by how long they have been due
+def schedule_refreshes(cache, photo_ids):
+    queue = []
+    for pic_id in photo_ids:
+        cache_entry = cache.get(pic_id, {})
+        if has_flickr_info(cache_entry):
+            priority = (1, make_int(cache_entry.get('next_update', 0)))
+        else:
+            priority = (0, 0)
+        heapq.heappush(queue, (priority, pic_id))
+
+    return [heapq.heappop(queue)[1] for _ in range(len(queue))]
+
+
+# Counts the refreshes due on each of the next days, from the next_update
+#  times in the cache.  Overdue entries count towards day 0 and entries
+#  due later than that are counted on the last day
+def get_refresh_load_report(cache, cur_time, days=14):
+    load = [0] * (days + 1)
+    for _, cache_entry in cache.items():
+        next_update = make_int(cache_entry.get('next_update', 0))
+        day = max(0, next_update - cur_time) // 86400
+        load[min(day, days)] += 1
+    return load
+
+
+def log_refresh_load_report(cache, cur_time, days=14):
+    load = get_refresh_load_report(cache, cur_time, days)
+    logger.info('[flickr_insert]: Refreshes due per day over the next %d'
+                ' days: %s (%d later)'
+                % (days, ' '.join(str(count) for count in load[:-1]),
+                   load[-1]))
+
+
+# Merges the result of a Flickr lookup into a cache entry.  Returns False
+#  if the lookup failed, in which case the entry keeps its (possibly stale)
+#  information and is tried again on the next build
+def update_cache_entry(cache_entry, item_update, flickr_info, cur_time,
+                       cache_cfg):
+    if not flickr_info or flickr_info.get('flickr_error'):
+        cache_entry['flickr_error'] = \
+            (flickr_info or {}).get('flickr_error', 'No response')
+        return False
+
+    # Set a flag to indicate item hasn't changed if
+    # Flickr response is same as cached.  The owner and last update time
+    #  are only bookkeeping for revalidation
+    unchanged = all(item in cache_entry.items()
+                    for item in flickr_info.items()
+                    if item[0] not in REVALIDATION_FIELDS)
+
+    # Update with changed Flickr info as needed
+    item_update.update(flickr_info)
+    if not unchanged:
+        item_update.update({
+            'last_changed': cur_time,
+            'last_changed_str': epoch_to_str(cur_time),
+        })
+
+    mark_cache_entry_checked(cache_entry, item_update, cur_time, cache_cfg)
+    return True
+
+
+# Records that a cache entry is up to date with Flickr, scheduling its
+#  next refresh
+def mark_cache_entry_checked(cache_entry, item_update, cur_time, cache_cfg):
+    # Set a next update time for revisiting this item
+    next_update_time = get_next_update_time(cur_time, cache_cfg)
+
+    # Add details about when this item was checked
+    item_update.update({
+        'last_updated': cur_time,
+        'last_updated_str': epoch_to_str(cur_time),
+        'next_update': next_update_time,
+        'next_update_str': epoch_to_str(next_update_time)
+    })
+
+    item_update.pop('status', None)
+    item_update['flickr_error'] = ""
+    cache_entry.update(item_update)
+
+
+def replace_tags_in_document(document, generator, cache):
+    # Renders tags from the cache only; prefetch_flickr_info must have
+    #  already brought the cache up to date for this document
+
+    # Returns the ids of the photos in the document
+
+    flickr_ctx = generator.context.get('flickr_insert_ctx', None)
+    if not flickr_ctx:
+        return set()
+
+    photo_ids = set()
+    document._content = timed(
+        'replace', rewrite_content,
+        document._content, flickr_ctx['template'], cache, generator.context,
+        flickr_ctx['cache_cfg']['key_field'], photo_ids=photo_ids)
+    return photo_ids
+
+
+# Returns content with every [flickr:] tag replaced by its rendered snippet
+#  and adds the ids of the photos rendered to photo_ids, if given
+def rewrite_content(content, template, cache, context, key_field,
+                    photo_ids=None):
+    # Identical tags in a document are only rendered once
+    rendered = {}
+
+    def render_match(match):
+        tag_str = match.group(2)
+        if tag_str in rendered:
+            return rendered[tag_str]
+
+        photo = get_photo_from_tag(tag_str, key_field)
+        if photo_ids is not None:
+            photo_ids.add(photo[key_field])
+        rendered[tag_str] = render_photo_cached(
+            template, photo, cache.get(photo[key_field], {}), context)
+        return rendered[tag_str]
+
+    # Substitute all tags in a single pass over the document, copying the
+    #  text between them as is
+    pieces = []
+    pos = 0
+    for match in iter_flickr_tags(content):
+        pieces.append(content[pos:match.start()])
+        pieces.append(render_match(match))
+        pos = match.end()
+    if not pieces:
+        return content
+    pieces.append(content[pos:])
+    return ''.join(pieces)
+
+
+# Rewrites documents in a pool of worker processes.  Each worker gets a
+#  read-only snapshot of the cache entries the documents use, the template
+#  source and the context variables the template refers to.  Documents a
+#  worker could not rewrite are done here instead.  Returns the ids of the
+#  photos in each document
+def replace_tags_in_documents_parallel(documents, generator, cache,
+                                       photo_ids, processes):
+    flickr_ctx = generator.context['flickr_insert_ctx']
+    key_field = flickr_ctx['cache_cfg']['key_field']
+
+    environment_cfg = flickr_ctx.get('template_environment')
+    worker_ctx = get_worker_context(flickr_ctx['template_source'],
+                                    generator.context, environment_cfg)
+    if worker_ctx is None:
+        logger.info('[flickr_insert]: Template or context cannot be sent'
+                    ' to worker processes; rendering serially')
+        return [replace_tags_in_document(document, generator, cache)
+                for document in documents]
+
+    document_photo_ids = [set() for _ in documents]
+
+    snapshot = {pic_id: dict(cache[pic_id]) for pic_id in photo_ids}
+    tasks = [(index, document._content)
+             for index, document in enumerate(documents)
+             if any(iter_flickr_tags(document._content))]
+
+    logger.info('[flickr_insert]: Rendering %d documents in %d processes'
+                % (len(tasks), processes))
+
+    pool = multiprocessing.Pool(
+        processes, initializer=_init_render_worker,
+        initargs=(flickr_ctx['template_source'], worker_ctx, snapshot,
+                  key_field, dict(mirrored_images),
+                  flickr_ctx.get('fast_template', True), environment_cfg))
+    try:
+        chunksize = max(1, len(tasks) // (processes * 4))
+        results = pool.imap_unordered(_render_worker_task, tasks,
+                                      chunksize=chunksize)
+        for index, content, stats, task_photo_ids in results:
+            # Only whole documents are timed in worker processes
+            record_time('replace', stats.pop('seconds'))
+            for name, value in stats.items():
+                render_stats[name] += value
+            if content is None:
+                document_photo_ids[index] = replace_tags_in_document(
+                    documents[index], generator, cache)
             else:
-                # todo: add additional error handling when Flickr errs out
-                pass
+                documents[index]._content = content
+                document_photo_ids[index] = task_photo_ids
+    finally:
+        pool.close()
+        pool.join()
 
-        if item_update['status'] == 'ok':
-            photo.update(cache_entry)
+    return document_photo_ids
 
-        # Update the image url (needed to show the same picture with
-        # different sizes on the same page)
-        photo.update(ensure_photo_insert_image_url(photo))
 
-        # Copy and update the context for this picture and (re)render
-        context = generator.context.copy()
-        context.update(photo)
-        replacement = flickr_ctx['template'].render(context)
-        document._content = document._content.replace(match[0], replacement)
+# Returns the subset of the context a template refers to, or None if the
+#  template source is unknown or any of those values, or the template's
+#  environment, can't be pickled
+def get_worker_context(template_source, context, environment_cfg=None):
+    if template_source is None:
+        return None
+
+    try:
+        environment = make_template_environment(environment_cfg)
+        names = meta.find_undeclared_variables(
+            environment.parse(template_source))
+        worker_ctx = {name: context[name] for name in names
+                      if name in context}
+        pickle.dumps((worker_ctx, environment_cfg))
+    except Exception:
+        return None
+    return worker_ctx
+
+
+_worker_state = {}
+
+
+def _init_render_worker(template_source, context, cache, key_field,
+                        images=None, fast_template=True,
+                        environment_cfg=None):
+    mirrored_images.update(images or {})
+    template = make_template_environment(environment_cfg).from_string(
+        template_source)
+    _worker_state.update({
+        'template': PhotoTemplate(template, template_source, fast_template),
+        'context': context,
+        'cache': cache,
+        'key_field': key_field,
+    })
+
+
+def _render_worker_task(task):
+    index, content = task
+    before = dict(render_stats)
+    photo_ids = set()
+    start = time.perf_counter()
+    try:
+        content = rewrite_content(
+            content, _worker_state['template'], _worker_state['cache'],
+            _worker_state['context'], _worker_state['key_field'],
+            photo_ids=photo_ids)
+    except Exception:
+        content = None
+    stats = {name: render_stats[name] - before[name] for name in before}
+    stats['seconds'] = time.perf_counter() - start
+    return index, content, stats, photo_ids
+
+
+# Snippets rendered so far in this build, keyed on the template, the
+#  normalized photo parameters and the version of the photo's cache entry
+_render_cache = {}
+render_stats = {'renders': 0, 'hits': 0}
+
+
+# Renders a photo, given the parameters from its tag and its cache entry
+def render_photo_cached(template, photo, cache_entry, context):
+    # Tag parameters are strings or booleans once normalized
+    key = (getattr(template, 'name', None),
+           tuple(sorted(photo.items())),
+           get_cache_entry_version(cache_entry))
+
+    snippet = _render_cache.get(key, None)
+    if snippet is not None:
+        render_stats['hits'] += 1
+        return snippet
+
+    photo = dict(photo)
+    photo.update(cache_entry)
+
+    # Update the image url (needed to show the same picture with
+    # different sizes on the same page)
+    photo.update(ensure_photo_insert_image_url(photo))
+    if mirrored_images:
+        photo.update(get_mirrored_photo(photo, mirrored_images))
+
+    snippet = timed(
+        'render', render_photo, template, photo, context)
+    _render_cache[key] = snippet
+    render_stats['renders'] += 1
+    return snippet
+
+
+# Identifies the state of a cache entry; changes whenever its information
+#  from Flickr does
+def get_cache_entry_version(cache_entry):
+    return (cache_entry.get('title', None),
+            cache_entry.get('insert_image_url_base', None),
+            make_int(cache_entry.get('last_changed', 0)))
+
+
+# Renders a photo without copying the (possibly very large) site context;
+#  the photo's values are layered over the generator context instead
+def render_photo(template, photo, context):
+    if isinstance(template, PhotoTemplate):
+        return template.render(photo, context)
+
+    layered = ChainMap(photo, context, template.globals)
+    try:
+        return template.environment.concat(template.root_render_func(
+            template.new_context(layered, shared=True)))
+    except Exception:
+        return template.environment.handle_exception()
+
+
+# A template prepared once for rendering many photos.  The variables it
+#  refers to are found up front, so each photo is rendered from a dict of
+#  just those values rather than layered over the whole site context.  The
+#  default template is rendered by render_default_template instead of Jinja,
+#  unless fast is false
+class PhotoTemplate(object):
+    def __init__(self, template, source=None, fast=True):
+        self.template = template
+        self.name = template.name
+        self.globals = template.globals
+        self.names = get_template_names(template.environment, source)
+        self.fast_render = None
+        if (fast and source == DEFAULT_TEMPLATE
+                and not template.environment.autoescape
+                and template.environment.finalize is None):
+            self.fast_render = render_default_template
+
+    # The values of the template's variables, looked up as render_photo
+    #  does: the photo's own first, then the context's, then globals
+    def get_values(self, photo, context):
+        values = {}
+        for name in self.names:
+            for scope in (photo, context, self.globals):
+                if name in scope:
+                    values[name] = scope[name]
+                    break
+        return values
+
+    def render(self, photo, context):
+        if self.names is None:
+            return render_photo(self.template, photo, context)
+        values = self.get_values(photo, context)
+        if self.fast_render is not None:
+            return self.fast_render(values)
+        template = self.template
+        try:
+            return template.environment.concat(template.root_render_func(
+                template.new_context(values, shared=True)))
+        except Exception:
+            return template.environment.handle_exception()
+
+
+# Returns the names of the variables a template's source refers to, or None
+#  if the source is unknown or it includes or imports other templates,
+#  which may refer to anything in the context
+def get_template_names(environment, source):
+    if source is None:
+        return None
+    try:
+        ast = environment.parse(source)
+    except Exception:
+        return None
+    if any(ast.find_all((nodes.Extends, nodes.Include, nodes.Import,
+                         nodes.FromImport))):
+        return None
+    return frozenset(meta.find_undeclared_variables(ast))
+
+
+# DEFAULT_TEMPLATE as a format string, with each of its {% if %} blocks
+#  filled in by render_default_template.  Like Jinja, the template's final
+#  newline is dropped
+DEFAULT_TEMPLATE_FORMAT = (
+    '<div class="caption-container">\n'
+    '    <a class="caption" href="{url}" target="_blank">\n'
+    '    <div class="image-wrapper{float_class}">\n'
+    '        <img src="{insert_image_url}"\n'
+    '            alt="{title}"\n'
+    '            title="{title}"\n'
+    '            class="img-polaroid"{srcset}\n'
+    '            {dimensions} />\n'
+    '        {caption}\n'
+    '    </div>\n'
+    '    </a>\n'
+    '</div>\n'
+    '{clearfix}')
+DEFAULT_TEMPLATE_SRCSET = '\n            srcset="{0}"'
+DEFAULT_TEMPLATE_SIZES = '\n            sizes="{0}"'
+DEFAULT_TEMPLATE_DIMENSIONS = ('\n                width="{0}"'
+                               '\n                height="{1}"\n            ')
+DEFAULT_TEMPLATE_CAPTION = ('\n        <div class="desc">'
+                            '\n            <p class="desc_content">{0}</p>'
+                            '\n        </div>\n        ')
+DEFAULT_TEMPLATE_CLEARFIX = '\n<div class="clearfix"></div>\n'
+
+
+# Renders DEFAULT_TEMPLATE from the values of its variables, giving what
+#  Jinja would: missing values are empty and tests are on truthiness
+def render_default_template(values):
+    get = values.get
+    title = str(get('title', ''))
+    float_value = get('float')
+    srcset = get('srcset')
+    sizes = get('sizes')
+    return DEFAULT_TEMPLATE_FORMAT.format(
+        url=get('url', ''),
+        insert_image_url=get('insert_image_url', ''),
+        title=title,
+        float_class=' pull-%s' % (float_value,) if float_value else '',
+        srcset=DEFAULT_TEMPLATE_SRCSET.format(srcset) +
+        (DEFAULT_TEMPLATE_SIZES.format(sizes) if sizes else '')
+        if srcset else '',
+        dimensions=DEFAULT_TEMPLATE_DIMENSIONS.format(
+            get('width', ''), get('height', ''))
+        if get('FLICKR_TAG_INCLUDE_DIMENSIONS') else '',
+        caption=DEFAULT_TEMPLATE_CAPTION.format(title)
+        if get('show_caption') else '',
+        clearfix='' if float_value else DEFAULT_TEMPLATE_CLEARFIX)
+
+
+def clear_render_cache():
+    _render_cache.clear()
+    render_stats.update({'renders': 0, 'hits': 0})
+
+
+# Copies the images a site uses from Flickr into its output.  Downloads
+#  are kept in store_dir under the hash of their content, with an index of
+#  the URL each came from, so an image is only downloaded once across
+#  builds.  Images are installed into output_dir, served from url_path
+class ImageMirror(object):
+    def __init__(self, store_dir, output_dir, url_path, max_workers=4,
+                 timeout=30, opener=urllib.request.urlopen):
+        self.store_dir = store_dir
+        self.output_dir = output_dir
+        self.url_path = url_path
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.opener = opener
+        self.index_filename = os.path.join(store_dir, 'index.json')
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'stored': 0, 'failed': 0}
+        self._index = None
+
+    @property
+    def index(self):
+        with self.lock:
+            if self._index is None:
+                try:
+                    with open(self.index_filename) as index_file:
+                        self._index = json.load(index_file)
+                except (FileNotFoundError, ValueError):
+                    self._index = {}
+        return self._index
+
+    def get_store_filename(self, stored):
+        return os.path.join(self.store_dir, stored['hash'][:2],
+                            stored['hash'] + stored['ext'])
+
+    # Makes sure each URL is downloaded and installed, and adds what's
+    #  needed to render it to mirrored_images.  Returns the number of URLs
+    #  that could not be mirrored; those stay on Flickr.  Unless download
+    #  is true, only images already in the store are installed
+    def mirror(self, urls, download=True):
+        urls = sorted(set(urls) - set(mirrored_images))
+        missing = [url for url in urls if url not in self.index or
+                   not os.path.exists(self.get_store_filename(
+                       self.index[url]))]
+        self.stats['stored'] += len(urls) - len(missing)
+
+        if missing and download:
+            logger.info('[flickr_insert]: Downloading %d images'
+                        % len(missing))
+            with ThreadPoolExecutor(max_workers=max(
+                    1, min(self.max_workers, len(missing)))) as executor:
+                for url, stored in zip(missing,
+                                       executor.map(self.download, missing)):
+                    if stored is not None:
+                        self.index[url] = stored
+
+        failed = 0
+        os.makedirs(self.output_dir, exist_ok=True)
+        for url in urls:
+            stored = self.index.get(url, None)
+            if stored is None:
+                failed += 1
+                continue
+            mirrored_images[url] = {
+                'url': self.url_path + '/' + self.install(stored),
+                'width': stored['width'],
+                'height': stored['height'],
+            }
+        return failed
+
+    # Downloads an image into the store, returning its index entry, or None
+    #  if it can't be downloaded or is truncated
+    def download(self, url):
+        try:
+            with self.opener(url, timeout=self.timeout) as response:
+                data = response.read()
+            width, height = get_image_size(data) or (None, None)
+        except (IOError, ValueError, http.client.HTTPException,
+                struct.error) as e:
+            logger.warning('[flickr_insert]: Unable to download %s: %s'
+                           % (url, e))
+            with self.lock:
+                self.stats['failed'] += 1
+            return None
+
+        stored = {
+            'hash': hashlib.sha256(data).hexdigest(),
+            'ext': os.path.splitext(url)[1] or '.jpg',
+            'width': width,
+            'height': height,
+        }
+        filename = self.get_store_filename(stored)
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            temp_filename = '%s.%d.tmp' % (filename, threading.get_ident())
+            with open(temp_filename, 'wb') as image_file:
+                image_file.write(data)
+            os.replace(temp_filename, filename)
+        with self.lock:
+            self.stats['downloaded'] += 1
+        return stored
+
+    # Links or copies a stored image into the output, returning its name
+    def install(self, stored):
+        name = stored['hash'] + stored['ext']
+        output_filename = os.path.join(self.output_dir, name)
+        if not os.path.exists(output_filename):
+            try:
+                os.link(self.get_store_filename(stored), output_filename)
+            except OSError:
+                shutil.copyfile(self.get_store_filename(stored),
+                                output_filename)
+        return name
+
+    def save(self):
+        if self._index is None:
+            return
+        os.makedirs(self.store_dir, exist_ok=True)
+        write_file_atomically(
+            self.index_filename,
+            lambda index_file: json.dump(self._index, index_file,
+                                         sort_keys=True))
+
+
+# Local copies of Flickr images in this build, keyed by their Flickr URL
+mirrored_images = {}
+
+_image_mirror = None
+
+
+# Returns the image mirror for the current build, or None if images are
+#  not mirrored
+def get_image_mirror(settings):
+    global _image_mirror
+    mirror_cfg = settings.get('FLICKR_INSERT_MIRROR', None)
+    if not mirror_cfg or not mirror_cfg.get('enabled', False):
+        return None
+    if _image_mirror is None:
+        output_dir = mirror_cfg.get('output_dir', 'images/flickr')
+        _image_mirror = ImageMirror(
+            mirror_cfg.get('store_dir', 'flickr_insert_images'),
+            os.path.join(settings.get('OUTPUT_PATH', 'output'), output_dir),
+            settings.get('SITEURL', '').rstrip('/') + '/' + output_dir,
+            max_workers=mirror_cfg.get('max_workers', 4),
+            timeout=mirror_cfg.get('timeout', 30))
+    return _image_mirror
+
+
+# Returns the Flickr URLs of the given sizes of each cached photo, and of
+#  any other sizes tag_suffixes lists for it
+def get_mirror_urls(cache, photo_ids, suffixes, tag_suffixes=None):
+    urls = []
+    for pic_id in photo_ids:
+        cache_entry = cache.get(pic_id, {})
+        if has_flickr_info(cache_entry):
+            photo_suffixes = set(suffixes)
+            if tag_suffixes:
+                photo_suffixes.update(tag_suffixes.get(pic_id, ()))
+            urls.extend(cache_entry['insert_image_url_base'] + suffix + '.jpg'
+                        for suffix in sorted(photo_suffixes))
+    return urls
+
+
+# Returns the size suffixes the tags in documents use for each photo
+def get_tag_size_suffixes(documents, key_field):
+    tag_suffixes = {}
+    for document in documents:
+        for match in iter_flickr_tags(document._content):
+            photo = get_photo_from_tag(match.group(2), key_field)
+            tag_suffixes.setdefault(photo[key_field], set()).add(
+                photo['size_suffix'])
+    return tag_suffixes
+
+
+# Returns the local image url, dimensions, srcset and sizes of a photo, for
+#  whichever of its sizes have been mirrored.  sizes tells the browser the
+#  image is shown at the chosen size's width, so it only fetches a larger
+#  size for high-density screens
+def get_mirrored_photo(photo, images):
+    base = photo.get('insert_image_url_base', '')
+    suffix = photo.get('size_suffix', DEFAULT_PHOTO_SUFFIX)
+    output = {}
+
+    image = images.get(base + suffix + '.jpg', None)
+    if image is not None:
+        output['insert_image_url'] = image['url']
+        if image['width']:
+            output['width'] = image['width']
+            output['height'] = image['height']
+
+    if suffix not in square_photo_suffixes and output.get('width'):
+        sources = [images[base + letter + '.jpg']
+                   for letter in photo_suffix_sizes
+                   if letter not in square_photo_suffixes and
+                   base + letter + '.jpg' in images]
+        sources = [source for source in sources if source['width']]
+        if sources:
+            sources.sort(key=lambda source: source['width'])
+            output['srcset'] = ', '.join(
+                '%s %dw' % (source['url'], source['width'])
+                for source in sources)
+            output['sizes'] = '(max-width: %dpx) 100vw, %dpx' % (
+                output['width'], output['width'])
+
+    return output
+
+
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+# Returns the (width, height) of a JPEG, PNG or GIF image, or None
+def get_image_size(data):
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return struct.unpack('>II', data[16:24])
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return struct.unpack('<HH', data[6:10])
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG segments to the start of frame, which holds the size
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xFF:
+            pos += 1
+            continue
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+        elif marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        else:
+            pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    return None
 
 
 def get_cache_update_for_item(cache_entry, cur_time, cache_cfg):
@@ -447,12 +3275,19 @@ def get_info_from_flickr(flickr, photo_id):
                 ' Fetching info from Flickr for ' + photo_id)
 
     try:
-        flickr_response = flickr.photos.getInfo(photo_id=photo_id,
-                                                format='parsed-json')
-    except flickrapi.exceptions.FlickrError as e:
+        flickr_response = timed(
+            'flickr_get_info', flickr.photos.getInfo,
+            photo_id=photo_id, format='parsed-json')
+    except (flickrapi.exceptions.FlickrError, IOError) as e:
         _flickr_info.update({"flickr_error": str(e)})
         return _flickr_info
 
+    return get_info_from_response(flickr_response)
+
+
+# Returns the information kept from a photos.getInfo response
+def get_info_from_response(flickr_response):
+    _flickr_info = {}
     if flickr_response['stat'] != 'ok':
         return _flickr_info
 
@@ -469,20 +3304,249 @@ def get_info_from_flickr(flickr, photo_id):
     # Note that the image size suffix and extension of z.jpg are not part of
     #  the base URL, but are added on a per-photo-use basis
 
-    u = []
-    u.append("https://farm" + str(response['farm']))
-    u.append(".staticflickr.com/" + str(response['server'] + "/"))
-    u.append(str(response['id']) + "_")
-    u.append(str(response['secret']) + "_")
-
-    _flickr_info['insert_image_url_base'] = "".join(u)
+    _flickr_info['insert_image_url_base'] = \
+        make_insert_image_url_base(response)
 
     # Update title (the actual caption visible on page)
     _flickr_info['title'] = response['title'].get('_content', "")
 
+    # Kept so that later refreshes can tell if the photo has changed
+    #  without calling photos.getInfo
+    _flickr_info.update(get_revalidation_info(
+        response, response.get('dates', {}).get('lastupdate', None)))
+
     return _flickr_info
 
 
+# Returns the owner and last update time of a photo from photos.getInfo,
+#  where the owner is a dictionary, or from a listing
+def get_revalidation_info(photo, lastupdate):
+    info = {}
+    owner = photo.get('owner', None)
+    if isinstance(owner, dict):
+        owner = owner.get('nsid', None)
+    if owner:
+        info['owner'] = owner
+    if lastupdate:
+        info['lastupdate'] = make_int(lastupdate)
+    return info
+
+
+def make_insert_image_url_base(photo):
+    u = []
+    u.append("https://farm" + str(photo['farm']))
+    u.append(".staticflickr.com/" + str(photo['server']) + "/")
+    u.append(str(photo['id']) + "_")
+    u.append(str(photo['secret']) + "_")
+
+    return "".join(u)
+
+
+# Photo listings, and the key their results are returned under
+FLICKR_LISTING_METHODS = {
+    'photosets.getPhotos': 'photoset',
+    'people.getPhotos': 'photos',
+    'photos.recentlyUpdated': 'photos',
+}
+
+
+# Yields every photo in a Flickr listing, a page at a time.  Listed
+#  photos carry id, title, server, farm and secret, the same fields
+#  photos.getInfo is used for.  A listing that fails part way through
+#  ends early, unless strict is set, when FlickrError is raised instead
+def get_photos_from_listing(flickr, method_name, per_page=500, strict=False,
+                            max_pages=None, **kwargs):
+    flickr_method = flickr
+    for name in method_name.split('.'):
+        flickr_method = getattr(flickr_method, name)
+    result_key = FLICKR_LISTING_METHODS[method_name]
+
+    page = 1
+    pages = 1
+    while page <= pages:
+        logger.info('[flickr_insert]: Fetching %s page %d'
+                    % (method_name, page))
+        try:
+            flickr_response = flickr_method(page=page, per_page=per_page,
+                                            format='parsed-json', **kwargs)
+        except (flickrapi.exceptions.FlickrError, IOError) as e:
+            if strict:
+                raise
+            logger.warning('[flickr_insert]: %s failed: %s'
+                           % (method_name, e))
+            return
+
+        if flickr_response['stat'] != 'ok':
+            if strict:
+                raise flickrapi.exceptions.FlickrError(
+                    '%s failed: %s' % (method_name,
+                                       flickr_response.get('message', '')))
+            return
+
+        listing = flickr_response[result_key]
+        for photo in listing['photo']:
+            yield photo
+
+        pages = make_int(listing.get('pages', 1))
+        if max_pages is not None and pages > max_pages:
+            raise ListingTooLongError('%s has %d pages, more than the %d'
+                                      ' allowed' % (method_name, pages,
+                                                    max_pages))
+        page += 1
+
+
+# Raised by get_photos_from_listing, after the first page, when a listing
+#  has more pages than it may fetch
+class ListingTooLongError(Exception):
+    pass
+
+
+# Fills the cache from album and user photo listings rather than one
+#  photos.getInfo call per photo.  Returns the number of entries refreshed
+def warm_cache_from_listings(flickr, cache, cur_time, cache_cfg,
+                             photoset_ids=(), user_ids=(), per_page=500):
+    key_field = cache_cfg['key_field']
+
+    listings = [('photosets.getPhotos', {'photoset_id': photoset_id})
+                for photoset_id in photoset_ids]
+    listings.extend(('people.getPhotos', {'user_id': user_id})
+                    for user_id in user_ids)
+
+    warmed = set()
+    for method_name, kwargs in listings:
+        for photo in get_photos_from_listing(flickr, method_name,
+                                             per_page=per_page,
+                                             extras='last_update', **kwargs):
+            pic_id = str(photo['id'])
+            if pic_id in warmed:
+                continue
+            warmed.add(pic_id)
+
+            if pic_id not in cache:
+                cache[pic_id] = {key_field: pic_id}
+
+            flickr_info = {
+                'insert_image_url_base': make_insert_image_url_base(photo),
+                'title': photo.get('title', ""),
+            }
+            flickr_info.update(get_revalidation_info(
+                photo, photo.get('lastupdate', None)))
+            update_cache_entry(cache[pic_id], {key_field: pic_id},
+                               flickr_info, cur_time, cache_cfg)
+            cache.mark_dirty(pic_id)
+            cache.journal_entry(cache[pic_id])
+        cache.sync_journal()
+
+    if listings:
+        logger.info('[flickr_insert]: Warmed %d cache entries from %d'
+                    ' listings' % (len(warmed), len(listings)))
+
+    return len(warmed)
+
+
+# Cache fields that record what revalidation needs rather than anything
+#  rendered
+REVALIDATION_FIELDS = ('lastupdate', 'owner')
+
+
+# Checks the photos due a refresh against listings of when their owners'
+#  photos last changed on Flickr, up to 500 photos per call.  Photos that
+#  haven't changed since they were cached are marked as checked without
+#  calling photos.getInfo.  Only photos owned by user_ids, with a cached
+#  lastupdate, can be revalidated.  Returns the updates still pending
+def revalidate_cache_entries(flickr, cache, pending_updates, cur_time,
+                             cache_cfg, user_ids=(), recently_updated=False,
+                             per_page=500):
+    eligible = [pic_id for pic_id in pending_updates
+                if cache[pic_id].get('owner', None) in user_ids and
+                cache[pic_id].get('lastupdate', None) and
+                has_flickr_info(cache[pic_id])]
+    if not eligible:
+        return pending_updates
+
+    # recentlyUpdated only lists photos changed since a date; a photo left
+    #  out hasn't changed since the oldest of these was last checked
+    since = min(make_int(cache[pic_id].get('last_updated', 0))
+                for pic_id in eligible) if recently_updated else 0
+    # Listing more pages than there are photos to check would cost more
+    #  calls than photos.getInfo
+    try:
+        last_updates = get_last_updates(flickr, cache, user_ids,
+                                        recently_updated, since, per_page,
+                                        max_pages=len(eligible))
+    except (flickrapi.exceptions.FlickrError, IOError,
+            ListingTooLongError) as e:
+        logger.warning('[flickr_insert]: Unable to revalidate photos: %s'
+                       % e)
+        return pending_updates
+
+    unchanged = []
+    for pic_id in eligible:
+        if pic_id not in last_updates:
+            # A photo missing from a user's listing may have been made
+            #  private or deleted, so look it up
+            if recently_updated:
+                unchanged.append(pic_id)
+            continue
+        lastupdate = last_updates[pic_id]
+        if lastupdate and \
+                lastupdate <= make_int(cache[pic_id]['lastupdate']):
+            unchanged.append(pic_id)
+
+    for pic_id in unchanged:
+        item_update = pending_updates[pic_id]
+        mark_cache_entry_checked(cache[pic_id], dict(item_update), cur_time,
+                                 cache_cfg)
+        cache.mark_dirty(pic_id)
+
+    logger.info('[flickr_insert]: Revalidated %d photos without'
+                ' photos.getInfo; %d changed or unlisted'
+                % (len(unchanged), len(eligible) - len(unchanged)))
+
+    unchanged = set(unchanged)
+    return {pic_id: item_update
+            for pic_id, item_update in pending_updates.items()
+            if pic_id not in unchanged}
+
+
+# Returns a dictionary of photo id to when it last changed on Flickr (or
+#  None, if not given), for the photos of user_ids or, with
+#  recently_updated, the authenticated user's photos changed since the
+#  given time.  Listings are fetched once per build, up to max_pages pages
+#  each; a longer people.getPhotos listing stops there, leaving the photos
+#  it didn't reach out of the results
+def get_last_updates(flickr, cache, user_ids, recently_updated, since,
+                     per_page=500, max_pages=None):
+    if cache.last_updates is not None and cache.last_updates[0] <= since:
+        return cache.last_updates[1]
+
+    if recently_updated:
+        listings = [('photos.recentlyUpdated', {'min_date': since})]
+    else:
+        listings = [('people.getPhotos', {'user_id': user_id})
+                    for user_id in user_ids]
+
+    last_updates = {}
+    for method_name, kwargs in listings:
+        try:
+            for photo in get_photos_from_listing(
+                    flickr, method_name, per_page=per_page, strict=True,
+                    max_pages=max_pages, extras='last_update', **kwargs):
+                lastupdate = photo.get('lastupdate', None)
+                last_updates[str(photo['id'])] = \
+                    make_int(lastupdate) if lastupdate else None
+        except ListingTooLongError as e:
+            # Photos left out of recentlyUpdated are taken as unchanged,
+            #  so only a complete listing will do
+            if recently_updated:
+                raise
+            logger.info('[flickr_insert]: %s; photos not listed are looked'
+                        ' up instead' % e)
+
+    cache.last_updates = (since, last_updates)
+    return last_updates
+
+
 def load_cache_from_csv(filename, key_name="id"):
     _cache = {}
 
@@ -500,16 +3564,44 @@ def save_cache_to_csv(cache, filename="cache.csv", fieldnames=None,
                       key_name="id"):
     if not fieldnames:
         fieldnames = []
-    with open(filename, 'w') as csv_file:
-        csv_fieldnames = [key_name, ]
-        csv_fieldnames.extend(fieldnames)
 
+    csv_fieldnames = [key_name, ]
+    csv_fieldnames.extend(fieldnames)
+
+    def write_rows(csv_file):
         writer = csv.DictWriter(csv_file, fieldnames=csv_fieldnames,
                                 extrasaction='ignore')
         writer.writeheader()
         for cache_key, entry in sorted(cache.items()):
             writer.writerow(entry)
 
+    # An interrupted save never leaves a truncated cache behind
+    write_file_atomically(filename, write_rows)
+
+
+# Writes a file by passing an open temporary file to write, syncing it to
+#  disk and renaming it over filename.  Readers see either the old file or
+#  the complete new one, even if the machine crashes part way through
+def write_file_atomically(filename, write):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as temp_file:
+        write(temp_file)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    os.replace(temp_filename, filename)
+
+    # Make the rename itself durable, where the platform allows it
+    try:
+        dir_fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
 
 def make_int(s):
     if isinstance(s, int):
@@ -522,7 +3614,172 @@ def epoch_to_str(epoch):
     return time.strftime("%Y-%m%d, %H:%M:%S", time.localtime(epoch))
 
 
+# Source files scanned for [flickr:] tags by the command line tools
+CONTENT_EXTENSIONS = ('.md', '.markdown', '.mdown', '.rst', '.html', '.htm')
+
+# Matches [flickr:] tags in source content, which isn't wrapped in <p>
+SOURCE_TAG_REGEX = re.compile(r'\[flickr:([^\]]*)\]', re.IGNORECASE)
+
+
+# Returns the ids of all photos tagged in the content files under a
+#  directory
+def get_content_photo_ids(content_dir, key_field):
+    photo_ids = set()
+    for dir_path, _, filenames in os.walk(content_dir):
+        for filename in filenames:
+            if not filename.lower().endswith(CONTENT_EXTENSIONS):
+                continue
+            with open(os.path.join(dir_path, filename),
+                      encoding='utf-8', errors='replace') as content_file:
+                content = content_file.read()
+            for tag_str in SOURCE_TAG_REGEX.findall(content):
+                photo = parse_flickr_tag(tag_str)
+                photo.update(get_photo_id_and_url(photo, id_field=key_field))
+                photo_ids.add(photo[key_field])
+    return photo_ids
+
+
+# Command line entry point for working on the cache outside of a build,
+#  such as from a nightly job so that site builds rarely call Flickr:
+#  python flickr_insert.py warm --content content/
+def main(argv=None, flickr_conn=None):
+    parser = argparse.ArgumentParser(
+        description='Maintain the flickr_insert photo cache')
+    parser.add_argument('--api-key',
+                        default=os.environ.get('FLICKR_INSERT_API_KEY'))
+    parser.add_argument('--api-secret',
+                        default=os.environ.get('FLICKR_INSERT_API_SECRET'))
+    parser.add_argument('--cache-backend', choices=sorted(CACHE_BACKENDS))
+    parser.add_argument('--cache-file',
+                        help='CSV cache file (the migration source for'
+                             ' the sqlite backend)')
+    parser.add_argument('--sqlite-file')
+    parser.add_argument('--remote-url',
+                        help='shared cache server, for the remote backend')
+    subparsers = parser.add_subparsers(dest='command')
+
+    warm_parser = subparsers.add_parser(
+        'warm', help='fetch photos tagged in content that are missing'
+                     ' or due a refresh')
+    warm_parser.add_argument('--content', required=True,
+                             help='Pelican content directory')
+
+    refresh_parser = subparsers.add_parser(
+        'refresh', help='refresh every cache entry that is due')
+
+    for command_parser in (warm_parser, refresh_parser):
+        command_parser.add_argument(
+            '--workers', type=int,
+            default=plugin_settings['FLICKR_INSERT_MAX_WORKERS']['default'])
+        command_parser.add_argument('--max-calls', type=int)
+
+    subparsers.add_parser('stats', help='summarize the cache')
+
+    prune_parser = subparsers.add_parser(
+        'prune', help='remove entries for photos not tagged in content')
+    prune_parser.add_argument('--content', required=True,
+                              help='Pelican content directory')
+    prune_parser.add_argument('--force', action='store_true',
+                              help='prune even when the content has no'
+                                   ' [flickr:] tags at all')
+
+    bulk_warm_parser = subparsers.add_parser(
+        'bulk-warm', help='fill the cache from album and user listings')
+    bulk_warm_parser.add_argument('--photoset', dest='photoset_ids',
+                                  action='append', default=[])
+    bulk_warm_parser.add_argument('--user', dest='user_ids',
+                                  action='append', default=[])
+    bulk_warm_parser.add_argument('--per-page', type=int, default=500)
+
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error('a command is required')
+    # A mistyped path walks nothing, which prune would read as "no photo
+    # is used any more"
+    if args.command in ('warm', 'prune') and not os.path.isdir(args.content):
+        parser.error('content directory not found: %s' % args.content)
+
+    cache_cfg = dict(plugin_settings['FLICKR_INSERT_CACHE_CFG']['default'])
+    if args.cache_backend:
+        cache_cfg['backend'] = args.cache_backend
+    if args.cache_file:
+        cache_cfg['filename'] = args.cache_file
+    if args.sqlite_file:
+        cache_cfg['sqlite_filename'] = args.sqlite_file
+    if args.remote_url:
+        cache_cfg['remote_url'] = args.remote_url
+    key_field = cache_cfg['key_field']
+
+    if flickr_conn is None and args.command in ('warm', 'refresh',
+                                                'bulk-warm'):
+        if not (args.api_key and args.api_secret):
+            parser.error('--api-key and --api-secret are required')
+        flickr_conn = get_flickr_client(
+            args.api_key, args.api_secret,
+            plugin_settings['FLICKR_INSERT_CLIENT_CFG']['default'])
+
+    cache = PhotoCache(cache_cfg)
+    cur_time = int(time.time())
+
+    if args.command in ('warm', 'refresh'):
+        if args.command == 'warm':
+            photo_ids = get_content_photo_ids(args.content, key_field)
+            cache.fetch_shared(photo_ids)
+        else:
+            photo_ids = [pic_id for pic_id, _ in cache.items()]
+        pending_updates = get_pending_updates(cache, photo_ids, cur_time,
+                                              cache_cfg)
+        results = refresh_cache_entries(
+            flickr_conn, cache, pending_updates, cur_time, cache_cfg,
+            max_workers=args.workers,
+            budget=RefreshBudget(max_calls=args.max_calls))
+        print('Photos checked: %d, refreshed: %d, deferred: %d,'
+              ' failed: %d' % (len(photo_ids), results['refreshed'],
+                               results['deferred'], results['failed']))
+
+    elif args.command == 'stats':
+        entries = [entry for _, entry in cache.items()]
+        print('Entries: %d' % len(entries))
+        print('Without Flickr info: %d'
+              % sum(1 for entry in entries if not has_flickr_info(entry)))
+        print('With errors: %d'
+              % sum(1 for entry in entries if entry.get('flickr_error')))
+        load = get_refresh_load_report(cache, cur_time)
+        print('Refreshes due per day: %s (%d later)'
+              % (' '.join(str(count) for count in load[:-1]), load[-1]))
+
+    elif args.command == 'prune':
+        photo_ids = get_content_photo_ids(args.content, key_field)
+        if not photo_ids and not args.force:
+            parser.error('no [flickr:] tags found in %s; use --force to'
+                         ' remove every cache entry' % args.content)
+        unused = [pic_id for pic_id, _ in cache.items()
+                  if pic_id not in photo_ids]
+        for pic_id in unused:
+            cache.remove(pic_id)
+        print('Removed %d of %d entries' % (len(unused),
+                                            len(unused) + len(cache)))
+
+    elif args.command == 'bulk-warm':
+        warmed = warm_cache_from_listings(
+            flickr_conn, cache, cur_time, cache_cfg,
+            photoset_ids=args.photoset_ids, user_ids=args.user_ids,
+            per_page=args.per_page)
+        print('Warmed %d cache entries' % warmed)
+
+    # Commands that only read the cache leave it alone
+    if cache.dirty_keys or cache.deleted_keys:
+        cache.save()
+    return 0
+
+
 def register():
     signals.generator_init.connect(init_flickr_insert)
     signals.article_generator_finalized.connect(replace_document_tags)
     signals.page_generator_finalized.connect(replace_document_tags)
+    signals.finalized.connect(flush_photo_cache)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
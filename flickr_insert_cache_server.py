@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Photo cache server shared by several sites using flickr_insert
+
+Sites set the "remote" backend in FLICKR_INSERT_CACHE_CFG with
+"remote_url" pointing here, so a photo fetched from Flickr by one site is
+reused by the rest.  Run with 'python flickr_insert_cache_server.py'
+
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted, in bytes
+MAX_REQUEST_SIZE = 64 * 1024 * 1024
+
+
+# Cache entries keyed by photo id, one JSON object per row.  A newer entry
+#  (by last_updated) replaces an older one; older ones are ignored
+class SharedPhotoStore(object):
+    table = 'photos'
+
+    def __init__(self, filename=':memory:'):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS %s (pic_id TEXT PRIMARY KEY,'
+                ' last_updated INTEGER, entry TEXT)' % self.table)
+        self.stats = {'gets': 0, 'hits': 0, 'puts': 0, 'stored': 0}
+
+    # Returns the stored entries of the given photos
+    def get_many(self, photo_ids):
+        photo_ids = list(photo_ids)
+        entries = {}
+        with self.lock:
+            # Keep well under SQLite's limit on query parameters
+            for start in range(0, len(photo_ids), 500):
+                chunk = photo_ids[start:start + 500]
+                cursor = self.conn.execute(
+                    'SELECT pic_id, entry FROM %s WHERE pic_id IN (%s)'
+                    % (self.table, ', '.join('?' * len(chunk))), chunk)
+                for pic_id, entry in cursor:
+                    entries[pic_id] = json.loads(entry)
+            self.stats['gets'] += len(photo_ids)
+            self.stats['hits'] += len(entries)
+        return entries
+
+    # Stores entries, given keyed by photo id, unless a newer one is
+    #  already stored.  Returns the number stored
+    def put_many(self, entries):
+        rows = [(str(pic_id), get_last_updated(entry),
+                 json.dumps(entry, sort_keys=True))
+                for pic_id, entry in entries.items()]
+        with self.lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                'INSERT INTO %s (pic_id, last_updated, entry)'
+                ' VALUES (?, ?, ?) ON CONFLICT (pic_id) DO UPDATE'
+                ' SET last_updated = excluded.last_updated,'
+                ' entry = excluded.entry'
+                ' WHERE excluded.last_updated > %s.last_updated'
+                % (self.table, self.table), rows)
+            stored = self.conn.total_changes - before
+            self.stats['puts'] += len(rows)
+            self.stats['stored'] += stored
+        return stored
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def get_last_updated(entry):
+    try:
+        return int(entry.get('last_updated') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# JSON over HTTP:
+#  POST /photos/get  {"ids": [id, ...]}           -> {"photos": {id: entry}}
+#  POST /photos/put  {"photos": {id: entry, ...}}  -> {"stored": n}
+#  GET  /stats  -> counts of requests and of entries stored
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_json({'error': 'not found'}, status=404)
+            return
+        stats = dict(self.store.stats)
+        stats['entries'] = len(self.store)
+        self.send_json(stats)
+
+    def do_POST(self):
+        try:
+            request = self.read_json()
+        except ValueError as e:
+            self.send_json({'error': str(e)}, status=400)
+            return
+
+        if self.path == '/photos/get':
+            photo_ids = [str(pic_id) for pic_id in request.get('ids', [])]
+            self.send_json({'photos': self.store.get_many(photo_ids)})
+        elif self.path == '/photos/put':
+            self.send_json(
+                {'stored': self.store.put_many(request.get('photos', {}))})
+        else:
+            self.send_json({'error': 'not found'}, status=404)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError('request too large')
+        request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        if not isinstance(request, dict):
+            raise ValueError('expected a JSON object')
+        return request
+
+    def send_json(self, response, status=200):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+# Returns a server for the store; call serve_forever() to run it.  Port 0
+#  picks a free port, available as server.server_port
+def make_server(host='127.0.0.1', port=8765, store=None):
+    server = ThreadingHTTPServer((host, port), CacheRequestHandler)
+    server.daemon_threads = True
+    server.store = store if store is not None else SharedPhotoStore()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve a flickr_insert photo cache shared by sites')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--db', default='flickr_insert_shared.sqlite3',
+                        help="SQLite database file (':memory:' to keep"
+                             " nothing)")
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, SharedPhotoStore(args.db))
+    logger.info('Serving the shared photo cache on http://%s:%d'
+                % (args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.store.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -1,7 +1,24 @@
+import asyncio
+import configparser
 import unittest
+import http.client
+import http.server
+import io
+import json
 import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+import jinja2
 import yaml
+from contextlib import redirect_stderr, redirect_stdout
+from pelican import ArticlesGenerator, PagesGenerator
 import flickr_insert
+import flickr_insert_cache_server
 
 CUR_DIR = os.path.dirname(__file__)
 TEST_DATA_DIR = os.path.join(CUR_DIR, 'test_data')
@@ -12,7 +29,7 @@ class TestFlickrInsert(unittest.TestCase):
         # Test content is multiple
         with open(os.path.join(
                 TEST_DATA_DIR, 'get_flickr_tags.yaml'), 'r') as f:
-            test_case_data = yaml.load(f)
+            test_case_data = yaml.safe_load(f)
 
         for single_test, expected in test_case_data.items():
             tags = flickr_insert.get_flickr_tags(single_test)
@@ -28,10 +45,55 @@ class TestFlickrInsert(unittest.TestCase):
                     self.assertEqual(expected[expected_key],
                                      tag.get(expected_key, None))
 
+    def test_iter_flickr_tags(self):
+        content = ('<p>[flickr:id=1000]</p><p>[FLICKR:id=1001,'
+                   'title="[draft] Reno, NV"]</p>\n'
+                   "<p>[flickr:id=1002,title=Don't]</p> it's\n"
+                   '<p>[flickr:id=1003,title="unclosed]</p>\n'
+                   '<p>[flickr:id=1004\n]</p>')
+        tags = flickr_insert.iter_flickr_tags(content)
+        self.assertEqual(next(tags).group(2), 'id=1000')
+        self.assertEqual([match.group(2) for match in tags],
+                         ['id=1001,title="[draft] Reno, NV"',
+                          "id=1002,title=Don't",
+                          'id=1003,title="unclosed'])
+        self.assertEqual(
+            list(flickr_insert.iter_flickr_tags('<p>No tags</p>' * 10)), [])
+
+    def test_rewrite_content_without_tags(self):
+        content = '<p>No tags [flickr] here</p>'
+        self.assertIs(flickr_insert.rewrite_content(
+            content, None, {}, {}, 'pic_id'), content)
+
+    def test_parse_flickr_tag_matches_configparser(self):
+        with open(os.path.join(
+                TEST_DATA_DIR, 'get_flickr_tags.yaml'), 'r') as f:
+            test_case_data = yaml.safe_load(f)
+
+        for single_test in test_case_data:
+            tag_str = flickr_insert.FLICKR_REGEX.findall(single_test)[0][1]
+            # The old parser could not handle quoting or '%'
+            if '"' in tag_str or '%' in tag_str:
+                continue
+
+            config = configparser.ConfigParser()
+            config.read_string(u"[temp]\n" + tag_str.replace(",", "\n"))
+            expected = dict(config.items('temp'))
+
+            self.assertEqual(flickr_insert.parse_flickr_tag(tag_str),
+                             expected, msg=tag_str)
+
+    def test_parse_flickr_tag_returns_copies(self):
+        params = flickr_insert.parse_flickr_tag('id=1000,size=small')
+        params['size'] = 'large'
+        self.assertEqual(
+            flickr_insert.parse_flickr_tag('id=1000,size=small')['size'],
+            'small')
+
     def test_get_photo_id_and_url(self):
         with open(os.path.join(
                 TEST_DATA_DIR, 'get_photo_id_and_url.yaml'), 'r') as f:
-            test_case_data = yaml.load(f)
+            test_case_data = yaml.safe_load(f)
 
         for single_test in test_case_data:
             output = flickr_insert.get_photo_id_and_url(single_test["input"])
@@ -266,5 +328,1676 @@ class TestFlickrInsert(unittest.TestCase):
         pass
 
 
+class FakeFlickrPhotos(object):
+    # Stands in for flickr_conn.photos, answering getInfo from a dict of
+    #  photo ids to titles after an artificial delay
+    def __init__(self, titles, latency=0.0):
+        self.titles = titles
+        self.latency = latency
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def getInfo(self, photo_id, format=None):
+        with self.lock:
+            self.calls.append(photo_id)
+        time.sleep(self.latency)
+        return {
+            'stat': 'ok',
+            'photo': {
+                'id': photo_id,
+                'farm': 9,
+                'server': '8579',
+                'secret': 'secret' + photo_id,
+                'title': {'_content': self.titles[photo_id]},
+                'owner': {'nsid': '34299485@N00'},
+                'dates': {'lastupdate': '1440000000'}
+            }
+        }
+
+
+class FailingFlickrPhotos(FakeFlickrPhotos):
+    # Raises the given errors, in turn, before answering normally
+    def __init__(self, titles, errors):
+        FakeFlickrPhotos.__init__(self, titles)
+        self.errors = list(errors)
+
+    def getInfo(self, photo_id, format=None):
+        if self.errors:
+            with self.lock:
+                self.calls.append(photo_id)
+            raise self.errors.pop(0)
+        return FakeFlickrPhotos.getInfo(self, photo_id, format=format)
+
+
+class FakeClock(object):
+    # A clock for the rate limiter and breaker that sleeping advances
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeFlickrListing(object):
+    # Serves recorded photo listing pages, as for flickr_conn.photosets
+    #  and flickr_conn.people
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+        self.kwargs = []
+
+    def getPhotos(self, page=1, per_page=500, format=None, **kwargs):
+        self.calls.append(page)
+        self.kwargs.append(kwargs)
+        return self.pages[page - 1]
+
+    # For listings that are methods themselves, like photos.recentlyUpdated
+    __call__ = getPhotos
+
+
+class FailingFlickrListing(FakeFlickrListing):
+    # Raises error when asked for fail_page, as on a dropped connection
+    def __init__(self, pages, error, fail_page=1):
+        FakeFlickrListing.__init__(self, pages)
+        self.error = error
+        self.fail_page = fail_page
+
+    def getPhotos(self, page=1, per_page=500, format=None, **kwargs):
+        if page == self.fail_page:
+            self.calls.append(page)
+            raise self.error
+        return FakeFlickrListing.getPhotos(self, page, per_page, format,
+                                           **kwargs)
+
+    __call__ = getPhotos
+
+
+class FakeFlickr(object):
+    def __init__(self, titles, latency=0.0, listings=None):
+        self.photos = FakeFlickrPhotos(titles, latency=latency)
+        listings = listings or {}
+        self.photosets = FakeFlickrListing(
+            listings.get('photosets.getPhotos', []))
+        self.people = FakeFlickrListing(listings.get('people.getPhotos', []))
+        self.photos.recentlyUpdated = FakeFlickrListing(
+            listings.get('photos.recentlyUpdated', []))
+
+
+class FakeDocument(object):
+    def __init__(self, content):
+        self._content = content
+
+
+# A Jinja filter for templates rendered in worker processes, which can only
+#  use filters they can import
+def shout(value):
+    return str(value).upper()
+
+
+def make_generator(contents, cache_dir, flickr_conn,
+                   generator_class=ArticlesGenerator, environment=None,
+                   **settings):
+    cache_cfg = dict(
+        flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG']['default'])
+    cache_cfg['filename'] = os.path.join(cache_dir, 'cache.csv')
+    cache_cfg['document_index_filename'] = os.path.join(cache_dir,
+                                                        'documents.json')
+    cache_cfg.update(settings.pop('cache_cfg', {}))
+
+    generator = generator_class.__new__(generator_class)
+    generator.settings = {
+        'FLICKR_INSERT_API_KEY': 'key',
+        'FLICKR_INSERT_API_SECRET': 'secret',
+        'FLICKR_INSERT_CACHE_CFG': cache_cfg,
+    }
+    generator.settings.update(settings)
+    generator.context = dict(generator.settings)
+    if environment is not None:
+        generator.env = environment
+        generator._templates = {}
+        generator.settings['TEMPLATE_EXTENSIONS'] = ['.html']
+    documents = [FakeDocument(content) for content in contents]
+    generator.articles = generator.pages = documents
+    generator.drafts = generator.hidden_pages = []
+
+    flickr_insert.init_flickr_insert(generator)
+    generator.context['flickr_insert_ctx']['flickr_conn'] = flickr_conn
+
+    return generator
+
+
+class TestReplaceDocumentTags(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.titles = {str(1000 + n): 'Photo %d' % n for n in range(10)}
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        shutil.rmtree(self.cache_dir)
+
+    def test_prefetch_is_concurrent(self):
+        flickr = FakeFlickr(self.titles, latency=0.1)
+        contents = ['<p>[flickr:id=%s]</p>' % pic_id
+                    for pic_id in sorted(self.titles)]
+        generator = make_generator(
+            contents, self.cache_dir, flickr, FLICKR_INSERT_MAX_WORKERS=10)
+
+        start = time.time()
+        flickr_insert.replace_document_tags(generator)
+        elapsed = time.time() - start
+
+        # Ten serial calls would take at least a second
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(sorted(flickr.photos.calls), sorted(self.titles))
+
+        for document, pic_id in zip(generator.articles, sorted(self.titles)):
+            self.assertNotIn('[flickr:', document._content)
+            self.assertIn('title="%s"' % self.titles[pic_id],
+                          document._content)
+            self.assertIn('_secret%s_z.jpg' % pic_id, document._content)
+
+    def test_repeated_photo_fetched_once(self):
+        flickr = FakeFlickr(self.titles)
+        contents = ['<p>[flickr:id=1000]</p>\n'
+                    '<p>[flickr:id=1000,size=small]</p>',
+                    '<p>[flickr:id=1000,float=left]</p>']
+        generator = make_generator(contents, self.cache_dir, flickr)
+
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(flickr.photos.calls, ['1000'])
+        self.assertIn('_secret1000_m.jpg', generator.articles[0]._content)
+        self.assertIn('pull-left', generator.articles[1]._content)
+
+    def test_cached_photos_not_fetched(self):
+        contents = ['<p>[flickr:id=1000]</p>']
+
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(contents, self.cache_dir, flickr)
+        flickr_insert.replace_document_tags(generator)
+        flickr_insert.flush_photo_cache()
+        self.assertEqual(flickr.photos.calls, ['1000'])
+
+        # A second build within the session interval uses the cache
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(contents, self.cache_dir, flickr)
+        flickr_insert.replace_document_tags(generator)
+        self.assertEqual(flickr.photos.calls, [])
+        self.assertIn('title="Photo 0"', generator.articles[0]._content)
+
+    def test_identical_tags_rendered_once(self):
+        flickr = FakeFlickr(self.titles)
+        contents = ['<p>[flickr:id=1000]</p>\n' * 3 +
+                    '<p>[flickr:id=1000,size=small]</p>\n']
+        generator = make_generator(contents, self.cache_dir, flickr)
+
+        render_photo = flickr_insert.render_photo
+        renders = []
+
+        def counting_render_photo(template, photo, context):
+            renders.append(photo['size'])
+            return render_photo(template, photo, context)
+
+        flickr_insert.render_photo = counting_render_photo
+        try:
+            flickr_insert.replace_document_tags(generator)
+        finally:
+            flickr_insert.render_photo = render_photo
+
+        self.assertEqual(sorted(renders), ['medium', 'small'])
+        content = generator.articles[0]._content
+        self.assertEqual(content.count('_secret1000_z.jpg'), 3)
+        self.assertEqual(content.count('_secret1000_m.jpg'), 1)
+
+    def test_snippets_rendered_once_per_build(self):
+        flickr = FakeFlickr(self.titles)
+        contents = ['<p>[flickr:id=1000,float=left]</p>'] * 3 + \
+                   ['<p>[flickr:id=1000,float=right]</p>']
+        generator = make_generator(contents, self.cache_dir, flickr)
+
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(flickr_insert.render_stats,
+                         {'renders': 2, 'hits': 2})
+        self.assertEqual(generator.articles[0]._content,
+                         generator.articles[2]._content)
+        self.assertIn('pull-right', generator.articles[3]._content)
+
+    def test_render_photo_matches_template_render(self):
+        template = flickr_insert.Template(flickr_insert.DEFAULT_TEMPLATE)
+        context = {'FLICKR_TAG_INCLUDE_DIMENSIONS': True, 'width': 640,
+                   'title': 'Site title'}
+        photo = {'url': 'https://flic.kr/p/qoN1RX', 'title': 'Photo',
+                 'insert_image_url': 'https://example.com/1_z.jpg',
+                 'float': 'left', 'show_caption': True}
+
+        expected = template.render(dict(context, **photo))
+        self.assertEqual(
+            flickr_insert.render_photo(template, photo, context), expected)
+        self.assertEqual(context['title'], 'Site title')
+
+    def test_photo_template_matches_template_render(self):
+        source = flickr_insert.DEFAULT_TEMPLATE
+        template = flickr_insert.Template(source)
+        fast = flickr_insert.PhotoTemplate(template, source)
+        minimal = flickr_insert.PhotoTemplate(template, source, fast=False)
+        self.assertIsNotNone(fast.fast_render)
+        self.assertIsNone(minimal.fast_render)
+        self.assertIn('insert_image_url', minimal.names)
+        self.assertNotIn('article', minimal.names)
+
+        photo = {'url': 'https://flic.kr/p/qoN1RX', 'title': 'A <b> & {0}',
+                 'insert_image_url': 'https://example.com/1_z.jpg'}
+        for float_value in ['left', '', None]:
+            for show_caption in [True, False]:
+                for srcset, sizes in [
+                        ('https://example.com/1_m.jpg 240w', '240px'),
+                        ('https://example.com/1_m.jpg 240w', ''),
+                        ('', '240px')]:
+                    for dimensions in [True, False]:
+                        context = {'FLICKR_TAG_INCLUDE_DIMENSIONS': dimensions,
+                                   'width': 640, 'article': 'Not used'}
+                        values = dict(photo, float=float_value,
+                                      show_caption=show_caption,
+                                      srcset=srcset, sizes=sizes)
+                        if float_value is None:
+                            del values['float']
+                        expected = template.render(dict(context, **values))
+                        self.assertEqual(fast.render(values, context),
+                                         expected)
+                        self.assertEqual(minimal.render(values, context),
+                                         expected)
+                        self.assertEqual(flickr_insert.render_photo(
+                            fast, values, context), expected)
+
+    def test_photo_template_without_source_uses_context(self):
+        template = flickr_insert.Template('{{title}} {{site}}')
+        photo_template = flickr_insert.PhotoTemplate(template)
+        self.assertIsNone(photo_template.names)
+        self.assertEqual(photo_template.render({'title': 'Photo'},
+                                               {'site': 'Site'}),
+                         'Photo Site')
+
+    def test_parallel_rendering_matches_serial(self):
+        contents = ['<p>Intro %d</p>\n<p>[flickr:id=%s,size=small]</p>\n'
+                    '<p>[flickr:id=1000,float=right]</p>' % (n, pic_id)
+                    for n, pic_id in enumerate(sorted(self.titles))]
+        contents.append('<p>No photos here</p>')
+
+        serial = make_generator(contents, self.cache_dir,
+                                FakeFlickr(self.titles))
+        flickr_insert.replace_document_tags(serial)
+        flickr_insert.flush_photo_cache()
+
+        parallel = make_generator(contents, self.cache_dir,
+                                  FakeFlickr(self.titles),
+                                  cache_cfg={'document_index_filename': None},
+                                  FLICKR_INSERT_PROCESSES=2,
+                                  FLICKR_INSERT_PROCESS_THRESHOLD=1)
+        flickr_insert.replace_document_tags(parallel)
+
+        self.assertEqual([document._content for document in parallel.articles],
+                         [document._content for document in serial.articles])
+        self.assertEqual(flickr_insert.render_stats['renders'] +
+                         flickr_insert.render_stats['hits'], 20)
+
+    def test_parallel_rendering_uses_template_environment(self):
+        contents = ['<p>[flickr:id=%s]</p>' % pic_id
+                    for pic_id in sorted(self.titles)]
+        jinja_options = {'trim_blocks': True, 'lstrip_blocks': True}
+        outputs = []
+        for processes in (1, 2):
+            environment = jinja2.Environment(
+                loader=jinja2.DictLoader({'photo.html': (
+                    '<div>\n  {% if title %}\n  <b>{{ title|shout }}</b>\n'
+                    '  {% endif %}\n</div>')}), **jinja_options)
+            environment.filters['shout'] = shout
+            generator = make_generator(
+                contents, self.cache_dir, FakeFlickr(self.titles),
+                environment=environment,
+                cache_cfg={'document_index_filename': None},
+                JINJA_ENVIRONMENT=jinja_options,
+                FLICKR_INSERT_TEMPLATE_NAME='photo',
+                FLICKR_INSERT_PROCESSES=processes,
+                FLICKR_INSERT_PROCESS_THRESHOLD=1)
+            flickr_insert.replace_document_tags(generator)
+            outputs.append([document._content
+                            for document in generator.articles])
+            # Nothing was left for the serial fallback
+            self.assertEqual(bool(flickr_insert._render_cache),
+                             processes == 1)
+            flickr_insert.flush_photo_cache()
+
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertIn('<div>\n  <b>PHOTO 0</b>\n</div>', outputs[0][0])
+
+    def test_get_worker_context(self):
+        context = {'FLICKR_TAG_INCLUDE_DIMENSIONS': True, 'articles': [1]}
+        self.assertEqual(
+            flickr_insert.get_worker_context(flickr_insert.DEFAULT_TEMPLATE,
+                                             context),
+            {'FLICKR_TAG_INCLUDE_DIMENSIONS': True})
+        self.assertIsNone(flickr_insert.get_worker_context(
+            '{{ lock }}', {'lock': threading.Lock()}))
+
+    def test_unchanged_documents_reuse_output(self):
+        contents = ['<p>[flickr:id=1000]</p>', '<p>[flickr:id=1001]</p>']
+
+        first = make_generator(contents, self.cache_dir,
+                               FakeFlickr(self.titles))
+        flickr_insert.replace_document_tags(first)
+        flickr_insert.flush_photo_cache()
+
+        # The second document changes, and the first one's photo has a
+        #  new title by the third build
+        contents[1] = '<p>Edited</p>\n' + contents[1]
+        second = make_generator(contents, self.cache_dir,
+                                FakeFlickr(self.titles))
+        index = second.context['flickr_insert_ctx']['cache'].document_index
+        flickr_insert.replace_document_tags(second)
+        self.assertEqual(index.stats, {'hits': 1, 'misses': 1})
+        self.assertEqual(flickr_insert.render_stats['renders'], 1)
+        self.assertEqual(second.articles[0]._content,
+                         first.articles[0]._content)
+        flickr_insert.flush_photo_cache()
+
+        cache_cfg = second.settings['FLICKR_INSERT_CACHE_CFG']
+        cache = flickr_insert.PhotoCache(cache_cfg)
+        cache['1000']['title'] = 'Renamed'
+        cache['1000']['last_changed'] = 1
+        cache.save()
+
+        third = make_generator(contents, self.cache_dir,
+                               FakeFlickr(self.titles))
+        index = third.context['flickr_insert_ctx']['cache'].document_index
+        flickr_insert.replace_document_tags(third)
+        self.assertEqual(index.stats, {'hits': 1, 'misses': 1})
+        self.assertIn('title="Renamed"', third.articles[0]._content)
+        self.assertEqual(third.articles[1]._content,
+                         second.articles[1]._content)
+
+    def test_untagged_documents_not_indexed(self):
+        contents = ['<p>[flickr:id=1000]</p>', '<p>No photos here</p>']
+        for _ in range(2):
+            generator = make_generator(contents, self.cache_dir,
+                                       FakeFlickr(self.titles))
+            index = generator.context['flickr_insert_ctx'][
+                'cache'].document_index
+            flickr_insert.replace_document_tags(generator)
+            flickr_insert.flush_photo_cache()
+
+        self.assertEqual(index.stats, {'hits': 1, 'misses': 0})
+        self.assertEqual(generator.articles[1]._content, contents[1])
+        with open(index.filename) as index_file:
+            self.assertEqual(len(json.load(index_file)), 1)
+
+    def test_photo_looked_up_once_per_build(self):
+        flickr = FakeFlickr(self.titles)
+        # With no session interval every generator would check the photo
+        cache_cfg = {'session_interval': 0}
+        articles = make_generator(['<p>[flickr:id=1000]</p>'],
+                                  self.cache_dir, flickr, cache_cfg=cache_cfg)
+        pages = make_generator(['<p>[flickr:id=1000,size=small]</p>'],
+                               self.cache_dir, flickr,
+                               generator_class=PagesGenerator,
+                               cache_cfg=cache_cfg)
+
+        flickr_insert.replace_document_tags(articles)
+        flickr_insert.replace_document_tags(pages)
+
+        self.assertEqual(flickr.photos.calls, ['1000'])
+        self.assertEqual(flickr_insert.get_photo_lookups().stats,
+                         {'resolved': 1, 'shared': 1})
+        self.assertIn('title="Photo 0"', pages.pages[0]._content)
+
+    def test_concurrent_lookups_share_result(self):
+        flickr = FakeFlickr(self.titles, latency=0.05)
+        lookups = flickr_insert.SingleFlight()
+
+        infos = flickr_insert.fetch_flickr_infos(
+            flickr, ['1000', '1001'] * 4, max_workers=8, lookups=lookups)
+
+        self.assertEqual(sorted(flickr.photos.calls), ['1000', '1001'])
+        self.assertEqual(infos['1001']['title'], 'Photo 1')
+        self.assertEqual(lookups.stats, {'resolved': 2, 'shared': 6})
+
+    def test_refresh_budget_defers_overdue_photos(self):
+        cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'])
+        cache_cfg['filename'] = os.path.join(self.cache_dir, 'cache.csv')
+        cached = {}
+        for n, pic_id in enumerate(['1000', '1001', '1002']):
+            cached[pic_id] = {
+                'pic_id': pic_id, 'title': 'Old %d' % n,
+                'insert_image_url_base': 'https://old/%s_' % pic_id,
+                'last_updated': 1, 'last_changed': 1,
+                'next_update': 100 - n}
+        flickr_insert.save_cache_to_csv(
+            cached, filename=cache_cfg['filename'],
+            fieldnames=cache_cfg['field_names'], key_name='pic_id')
+
+        flickr = FakeFlickr(self.titles)
+        contents = ['<p>[flickr:id=%s]</p>' % pic_id
+                    for pic_id in ['1000', '1001', '1002', '1003']]
+        generator = make_generator(
+            contents, self.cache_dir, flickr,
+            FLICKR_INSERT_REFRESH_BUDGET={'max_calls': 2})
+        flickr_insert.replace_document_tags(generator)
+
+        # The uncached photo is fetched regardless, then the most overdue
+        self.assertEqual(sorted(flickr.photos.calls), ['1002', '1003'])
+        self.assertIn('title="Old 0"', generator.articles[0]._content)
+        self.assertIn('title="Photo 2"', generator.articles[2]._content)
+        self.assertEqual(flickr_insert.get_refresh_budget().stats,
+                         {'refreshed': 2, 'deferred': 2})
+
+    def test_refresh_budget_by_time(self):
+        clock = FakeClock()
+        budget = flickr_insert.RefreshBudget(max_seconds=10, clock=clock)
+        self.assertTrue(budget.take())
+        clock.now += 11
+        self.assertFalse(budget.take())
+        self.assertTrue(budget.take(required=True))
+
+    def test_refresh_load_report(self):
+        day = 86400
+        cache = {str(n): {'next_update': next_update}
+                 for n, next_update in enumerate(
+                     [0, 10, day + 30, 2 * day + 30, 30 * day])}
+        self.assertEqual(
+            flickr_insert.get_refresh_load_report(cache, 20, days=3),
+            [2, 1, 1, 1])
+
+    def test_build_report(self):
+        flickr = FakeFlickr(self.titles)
+        report_filename = os.path.join(self.cache_dir, 'report.json')
+        profile_filename = os.path.join(self.cache_dir, 'build.prof')
+        contents = ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>',
+                    '<p>[flickr:id=1000,size=small]</p>']
+        generator = make_generator(
+            contents, self.cache_dir, flickr,
+            FLICKR_INSERT_PROFILE={'json_filename': report_filename,
+                                   'cprofile_filename': profile_filename})
+
+        flickr_insert.replace_document_tags(generator)
+        flickr_insert.flush_photo_cache()
+
+        with open(report_filename) as report_file:
+            report = json.load(report_file)
+        self.assertEqual(report['photos'], 2)
+        self.assertEqual(report['cache']['misses'], 2)
+        stages = report['stages']
+        self.assertEqual(stages['flickr_get_info']['calls'], 2)
+        self.assertEqual(stages['replace']['calls'], 2)
+        self.assertEqual(stages['render']['calls'], 3)
+        self.assertEqual(stages['cache_save']['calls'], 1)
+        self.assertLessEqual(stages['render']['p50'],
+                             stages['render']['p95'])
+        self.assertTrue(os.path.exists(profile_filename))
+
+    def test_killed_build_replays_journal(self):
+        contents = ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>']
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(contents, self.cache_dir, flickr)
+        flickr_insert.replace_document_tags(generator)
+        self.assertEqual(sorted(flickr.photos.calls), ['1000', '1001'])
+        # The prefetch's fetches are synced to disk together
+        journal = generator.context['flickr_insert_ctx']['cache'].journal
+        self.assertEqual(journal.stats, {'entries': 2, 'syncs': 1})
+
+        # The build dies before Pelican's finalized signal saves the cache,
+        #  part way through journaling a third photo
+        cache_cfg = generator.settings['FLICKR_INSERT_CACHE_CFG']
+        flickr_insert._photo_cache = None
+        journal_filename = os.path.join(self.cache_dir, 'cache.csv.journal')
+        with open(journal_filename, 'a') as journal_file:
+            journal_file.write('{"pic_id": "1002", "ti')
+        self.assertEqual(
+            flickr_insert.CsvCacheBackend(cache_cfg).load(), {})
+        self.assertEqual(
+            sorted(flickr_insert.PhotoCache(cache_cfg).entries),
+            ['1000', '1001'])
+
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(contents, self.cache_dir, flickr)
+        flickr_insert.replace_document_tags(generator)
+        self.assertEqual(flickr.photos.calls, [])
+        self.assertIn('title="Photo 1"', generator.articles[0]._content)
+
+        flickr_insert.flush_photo_cache()
+        self.assertFalse(os.path.exists(journal_filename))
+        self.assertEqual(
+            sorted(flickr_insert.PhotoCache(cache_cfg).entries),
+            ['1000', '1001'])
+
+    def test_get_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(flickr_insert.get_percentile(samples, 50), 50)
+        self.assertEqual(flickr_insert.get_percentile(samples, 95), 95)
+        self.assertEqual(flickr_insert.get_percentile([3], 95), 3)
+
+    def save_stale_cache(self, photo_ids):
+        cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'])
+        cache_cfg['filename'] = os.path.join(self.cache_dir, 'cache.csv')
+        flickr_insert.save_cache_to_csv(
+            {pic_id: {'pic_id': pic_id, 'title': 'Stale ' + pic_id,
+                      'insert_image_url_base': 'https://stale/%s_' % pic_id,
+                      'last_updated': 1, 'last_changed': 1, 'next_update': 2}
+             for pic_id in photo_ids},
+            filename=cache_cfg['filename'],
+            fieldnames=cache_cfg['field_names'], key_name='pic_id')
+
+    def test_compaction_archives_unused_photos(self):
+        archive_filename = os.path.join(self.cache_dir, 'archive.csv')
+        cache_cfg = {'evict_after_builds': 2,
+                     'archive_filename': archive_filename}
+
+        def build(contents):
+            flickr = FakeFlickr(self.titles)
+            generator = make_generator(contents, self.cache_dir, flickr,
+                                       cache_cfg=cache_cfg)
+            flickr_insert.replace_document_tags(generator)
+            cache = generator.context['flickr_insert_ctx']['cache']
+            flickr_insert.flush_photo_cache()
+            return flickr, generator, cache
+
+        build(['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'])
+        # Unused by one build is not yet enough
+        _, _, cache = build(['<p>[flickr:id=1000]</p>'])
+        self.assertEqual(cache.compaction_stats['evicted'], 0)
+        self.assertEqual(cache['1001']['last_seen_build'], 1)
+        self.assertEqual(cache['1000']['last_seen_build'], 2)
+
+        _, _, cache = build(['<p>[flickr:id=1000]</p>'])
+        stats = cache.compaction_stats
+        self.assertEqual((stats['build'], stats['before'], stats['after'],
+                          stats['evicted'], stats['archived']),
+                         (3, 2, 1, 1, 1))
+        self.assertNotIn('1001', flickr_insert.load_cache_from_csv(
+            os.path.join(self.cache_dir, 'cache.csv'), key_name='pic_id'))
+        self.assertIn('1001', flickr_insert.load_cache_from_csv(
+            archive_filename, key_name='pic_id'))
+
+        # A photo used again comes back without calling Flickr
+        flickr, generator, cache = build(['<p>[flickr:id=1001]</p>'])
+        self.assertEqual(flickr.photos.calls, [])
+        self.assertIn('title="Photo 1"', generator.articles[0]._content)
+        self.assertEqual(cache['1001']['last_seen_build'], 4)
+        self.assertEqual(flickr_insert.load_cache_from_csv(
+            archive_filename, key_name='pic_id'), {})
+
+    def test_compaction_writes_used_entries_sparingly(self):
+        cache_cfg = {'evict_after_builds': 6, 'backend': 'sqlite',
+                     'sqlite_filename': os.path.join(self.cache_dir,
+                                                     'cache.sqlite3')}
+        contents = ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>\n'
+                    '<p>[flickr:id=1002]</p>']
+        builds = []
+        for _ in range(5):
+            generator = make_generator(contents, self.cache_dir,
+                                       FakeFlickr(self.titles),
+                                       cache_cfg=cache_cfg)
+            flickr_insert.replace_document_tags(generator)
+            cache = generator.context['flickr_insert_ctx']['cache']
+            flickr_insert.flush_photo_cache()
+            builds.append((cache.compaction_stats['build'],
+                           cache.stats['written']))
+
+        # Only the entry carrying the build number is written until the
+        #  others are half way to eviction
+        self.assertEqual(builds, [(1, 3), (2, 1), (3, 1), (4, 2), (5, 1)])
+
+    def test_compaction_with_older_field_names(self):
+        # Settings written before the bookkeeping columns were added
+        cache_cfg = {'evict_after_builds': 1, 'field_names': [
+            'title', 'insert_image_url_base', 'last_changed',
+            'last_updated', 'next_update', 'flickr_error']}
+        for contents in [['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'],
+                         ['<p>[flickr:id=1000]</p>']]:
+            generator = make_generator(contents, self.cache_dir,
+                                       FakeFlickr(self.titles),
+                                       cache_cfg=cache_cfg)
+            flickr_insert.replace_document_tags(generator)
+            cache = generator.context['flickr_insert_ctx']['cache']
+            flickr_insert.flush_photo_cache()
+
+        self.assertEqual(cache.compaction_stats['evicted'], 1)
+        loaded = flickr_insert.CsvCacheBackend(
+            generator.settings['FLICKR_INSERT_CACHE_CFG']).load()
+        self.assertEqual(sorted(loaded), ['1000'])
+        self.assertEqual(loaded['1000']['last_seen_build'], 2)
+        self.assertEqual(loaded['1000']['owner'], '34299485@N00')
+
+    def test_compaction_off_by_default(self):
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(['<p>[flickr:id=1000]</p>'],
+                                   self.cache_dir, flickr)
+        flickr_insert.replace_document_tags(generator)
+        cache = generator.context['flickr_insert_ctx']['cache']
+        flickr_insert.flush_photo_cache()
+
+        self.assertIsNone(cache.compaction_stats)
+        self.assertNotIn('last_seen', cache['1000'])
+
+    def test_is_unused_entry(self):
+        entry = {'last_seen': 1000, 'last_seen_build': 5}
+        day = 86400
+        self.assertTrue(flickr_insert.is_unused_entry(
+            entry, 8, 1000, max_builds=3))
+        self.assertFalse(flickr_insert.is_unused_entry(
+            entry, 7, 1000, max_builds=3))
+        self.assertTrue(flickr_insert.is_unused_entry(
+            entry, 6, 1000 + 30 * day, max_days=30))
+        # With both limits, both must be reached
+        self.assertFalse(flickr_insert.is_unused_entry(
+            entry, 20, 1000 + day, max_builds=3, max_days=30))
+        self.assertFalse(flickr_insert.is_unused_entry(
+            entry, 6, 1000 + 60 * day, max_builds=3, max_days=30))
+
+    def test_cache_only_mode(self):
+        self.save_stale_cache(['1000'])
+        flickr = FakeFlickr(self.titles)
+        generator = make_generator(
+            ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'],
+            self.cache_dir, flickr, FLICKR_INSERT_MODE='cache_only')
+
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(flickr.photos.calls, [])
+        self.assertIn('title="Stale 1000"', generator.articles[0]._content)
+
+        cache = generator.context['flickr_insert_ctx']['cache']
+        pending = flickr_insert.get_pending_updates(
+            cache, ['1000', '1001'], int(time.time()),
+            generator.settings['FLICKR_INSERT_CACHE_CFG'])
+        self.assertEqual(flickr_insert.get_offline_report(cache, pending),
+                         {'missing': ['1001'], 'stale': ['1000']})
+
+    def test_cache_first_async_mode(self):
+        self.save_stale_cache(['1000'])
+        flickr = FakeFlickr(self.titles, latency=0.05)
+        generator = make_generator(
+            ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'],
+            self.cache_dir, flickr, FLICKR_INSERT_MODE='cache_first_async')
+
+        flickr_insert.replace_document_tags(generator)
+
+        # The missing photo held up the build, the stale one didn't
+        content = generator.articles[0]._content
+        self.assertIn('title="Stale 1000"', content)
+        self.assertIn('title="Photo 1"', content)
+
+        flickr_insert.flush_photo_cache()
+        self.assertEqual(sorted(flickr.photos.calls), ['1000', '1001'])
+        cache = flickr_insert.load_cache_from_csv(
+            os.path.join(self.cache_dir, 'cache.csv'), key_name='pic_id')
+        self.assertEqual(cache['1000']['title'], 'Photo 0')
+
+    def test_unknown_mode(self):
+        self.assertRaises(Exception, make_generator, [], self.cache_dir,
+                          FakeFlickr(self.titles), FLICKR_INSERT_MODE='fast')
+
+    def test_cache_shared_across_generators(self):
+        flickr = FakeFlickr(self.titles)
+        articles = make_generator(
+            ['<p>[flickr:id=1000]</p>'], self.cache_dir, flickr)
+        pages = make_generator(
+            ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'],
+            self.cache_dir, flickr, generator_class=PagesGenerator)
+
+        cache = articles.context['flickr_insert_ctx']['cache']
+        self.assertIs(cache, pages.context['flickr_insert_ctx']['cache'])
+        self.assertFalse(cache.is_loaded)
+
+        flickr_insert.replace_document_tags(articles)
+        flickr_insert.replace_document_tags(pages)
+        self.assertEqual(sorted(flickr.photos.calls), ['1000', '1001'])
+
+        stats = flickr_insert.flush_photo_cache()
+        self.assertEqual(stats, {'loaded': 0, 'hits': 1, 'misses': 2,
+                                 'written': 2})
+        self.assertTrue(os.path.exists(
+            os.path.join(self.cache_dir, 'cache.csv')))
+
+
+class TestCacheBackends(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'])
+        self.cache_cfg.update({
+            'backend': 'sqlite',
+            'filename': os.path.join(self.cache_dir, 'cache.csv'),
+            'sqlite_filename': os.path.join(self.cache_dir, 'cache.sqlite3'),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_entry(self):
+        entry = flickr_insert.CacheEntry(
+            {'pic_id': '1000', 'title': 'A', 'last_updated': '1500000000',
+             'last_updated_str': 'ignored', 'next_update': '',
+             'owner': 'someone'})
+        self.assertEqual(entry['last_updated'], 1500000000)
+        self.assertEqual(entry['last_updated_str'],
+                         flickr_insert.epoch_to_str(1500000000))
+        self.assertNotIn('next_update', entry)
+        self.assertEqual(entry.get('next_update', 0), 0)
+        self.assertEqual(entry['owner'], 'someone')
+        self.assertEqual(dict(entry), {
+            'pic_id': '1000', 'title': 'A', 'last_updated': 1500000000,
+            'last_updated_str': flickr_insert.epoch_to_str(1500000000),
+            'owner': 'someone'})
+        self.assertFalse(hasattr(entry, '__dict__'))
+
+        del entry['title']
+        self.assertRaises(KeyError, entry.__getitem__, 'title')
+
+    def test_csv_cache_file_unchanged_by_load_and_save(self):
+        entries = {
+            '1000': {'pic_id': '1000', 'title': 'A, with a comma',
+                     'insert_image_url_base': 'https://farm9/1000_',
+                     'last_changed': 1500000000,
+                     'last_changed_str': flickr_insert.epoch_to_str(
+                         1500000000),
+                     'flickr_error': ''},
+            '1001': {'pic_id': '1001', 'title': 'B'},
+        }
+        flickr_insert.save_cache_to_csv(
+            entries, filename=self.cache_cfg['filename'],
+            fieldnames=self.cache_cfg['field_names'], key_name='pic_id')
+        with open(self.cache_cfg['filename']) as csv_file:
+            before = csv_file.read()
+
+        self.cache_cfg['backend'] = 'csv'
+        backend = flickr_insert.CsvCacheBackend(self.cache_cfg)
+        loaded = backend.load()
+        self.assertIsInstance(loaded['1000'], flickr_insert.CacheEntry)
+        self.assertEqual(loaded['1000']['last_changed'], 1500000000)
+        backend.save(loaded, set(loaded))
+        with open(self.cache_cfg['filename']) as csv_file:
+            self.assertEqual(csv_file.read(), before)
+
+    def test_sqlite_migrates_csv(self):
+        entries = {
+            '1000': {'pic_id': '1000', 'title': 'A', 'next_update': '50'},
+            '1001': {'pic_id': '1001', 'title': 'B', 'next_update': '40'},
+        }
+        flickr_insert.save_cache_to_csv(
+            entries, filename=self.cache_cfg['filename'],
+            fieldnames=self.cache_cfg['field_names'], key_name='pic_id')
+
+        loaded = flickr_insert.SqliteCacheBackend(self.cache_cfg).load()
+        self.assertEqual(sorted(loaded), ['1000', '1001'])
+        self.assertEqual(loaded['1000']['title'], 'A')
+        self.assertEqual(loaded['1001']['next_update'], 40)
+
+        conn = sqlite3.connect(self.cache_cfg['sqlite_filename'])
+        indexes = [row[1] for row in conn.execute(
+            "SELECT * FROM sqlite_master WHERE type = 'index'")]
+        conn.close()
+        self.assertIn('photos_next_update', indexes)
+
+    def test_sqlite_writes_only_dirty_entries(self):
+        cache = flickr_insert.PhotoCache(self.cache_cfg)
+        cache.get_entry('1000')['title'] = 'A'
+        cache.get_entry('1001')['title'] = 'B'
+        cache.save()
+        self.assertEqual(cache.stats['written'], 2)
+
+        cache = flickr_insert.PhotoCache(self.cache_cfg)
+        self.assertEqual(len(cache), 2)
+        cache['1001']['title'] = 'C'
+        cache.mark_dirty('1001')
+        cache.save()
+        self.assertEqual(cache.stats['written'], 1)
+
+        loaded = flickr_insert.SqliteCacheBackend(self.cache_cfg).load()
+        self.assertEqual(loaded['1000']['title'], 'A')
+        self.assertEqual(loaded['1001']['title'], 'C')
+
+    def test_unknown_backend(self):
+        self.cache_cfg['backend'] = 'nosuchbackend'
+        self.assertRaises(Exception, flickr_insert.get_cache_backend,
+                          self.cache_cfg)
+
+
+# Bytes that start like a JPEG of the given size
+def make_jpeg(width, height):
+    return (b'\xff\xd8\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' +
+            b'\x00' * 9 + b'\xff\xc0' +
+            struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x00' * 9 +
+            b'\xff\xd9')
+
+
+# Serves images as a Flickr photo server would, recording the paths asked for
+class FakeImageHandler(http.server.BaseHTTPRequestHandler):
+    images = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        data = self.images.get(self.path, None)
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestImageMirror(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.cache_dir, 'output')
+
+        FakeImageHandler.images = {
+            '/1000_secret_m.jpg': make_jpeg(240, 160),
+            '/1000_secret_z.jpg': make_jpeg(640, 427),
+            '/1000_secret_b.jpg': make_jpeg(1024, 683),
+        }
+        FakeImageHandler.requests = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      FakeImageHandler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url_base = 'http://127.0.0.1:%d/' % self.server.server_port
+
+        cur_time = int(time.time())
+        flickr_insert.save_cache_to_csv(
+            {pic_id: {'pic_id': pic_id, 'title': 'Photo ' + pic_id,
+                      'insert_image_url_base':
+                          self.url_base + pic_id + '_secret_',
+                      'last_changed': cur_time, 'last_updated': cur_time,
+                      'next_update': cur_time + 86400}
+             for pic_id in ('1000', '1001')},
+            filename=os.path.join(self.cache_dir, 'cache.csv'),
+            fieldnames=flickr_insert.plugin_settings[
+                'FLICKR_INSERT_CACHE_CFG']['default']['field_names'],
+            key_name='pic_id')
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def build(self, contents, **settings):
+        mirror_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_MIRROR']['default'])
+        mirror_cfg.update({
+            'enabled': True,
+            'store_dir': os.path.join(self.cache_dir, 'store'),
+        })
+        generator = make_generator(
+            contents, self.cache_dir, FakeFlickr({}),
+            FLICKR_INSERT_MIRROR=mirror_cfg,
+            FLICKR_TAG_INCLUDE_DIMENSIONS=True,
+            OUTPUT_PATH=self.output_path, SITEURL='https://example.com',
+            **settings)
+        flickr_insert.replace_document_tags(generator)
+        flickr_insert.flush_photo_cache()
+        return generator
+
+    def test_images_mirrored_with_dimensions_and_srcset(self):
+        generator = self.build(['<p>[flickr:id=1000]</p>'])
+        content = generator.articles[0]._content
+
+        self.assertEqual(sorted(FakeImageHandler.requests),
+                         ['/1000_secret_b.jpg', '/1000_secret_m.jpg',
+                          '/1000_secret_z.jpg'])
+        self.assertNotIn(self.url_base, content)
+        self.assertIn('width="640"', content)
+        self.assertIn('height="427"', content)
+
+        image_dir = os.path.join(self.output_path, 'images', 'flickr')
+        images = {}
+        for name in os.listdir(image_dir):
+            with open(os.path.join(image_dir, name), 'rb') as image_file:
+                images[image_file.read()] = \
+                    'https://example.com/images/flickr/' + name
+        self.assertEqual(len(images), 3)
+        src = images[FakeImageHandler.images['/1000_secret_z.jpg']]
+        self.assertIn('src="%s"' % src, content)
+        self.assertIn('srcset="%s 240w, %s 640w, %s 1024w"' % (
+            images[FakeImageHandler.images['/1000_secret_m.jpg']], src,
+            images[FakeImageHandler.images['/1000_secret_b.jpg']]), content)
+        self.assertIn('sizes="(max-width: 640px) 100vw, 640px"', content)
+
+    def test_srcset_sizes_follow_chosen_size(self):
+        generator = self.build(['<p>[flickr:id=1000,size=small]</p>'])
+        content = generator.articles[0]._content
+
+        self.assertIn('width="240"', content)
+        self.assertIn('sizes="(max-width: 240px) 100vw, 240px"', content)
+        self.assertIn(' 1024w"', content)
+
+    def test_stored_images_not_downloaded_again(self):
+        first = self.build(['<p>[flickr:id=1000]</p>'])
+        shutil.rmtree(self.output_path)
+        FakeImageHandler.requests = []
+
+        second = self.build(['<p>[flickr:id=1000]</p>'])
+        self.assertEqual(FakeImageHandler.requests, [])
+        self.assertEqual(second.articles[0]._content,
+                         first.articles[0]._content)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.output_path, 'images',
+                                        'flickr'))), 3)
+
+    def test_failed_download_keeps_flickr_url(self):
+        generator = self.build(['<p>[flickr:id=1001]</p>'])
+        self.assertIn('src="%s1001_secret_z.jpg"' % self.url_base,
+                      generator.articles[0]._content)
+        self.assertNotIn('srcset', generator.articles[0]._content)
+
+    def test_cache_only_build_uses_stored_images(self):
+        self.build(['<p>[flickr:id=1000]</p>'])
+        FakeImageHandler.requests = []
+
+        content = self.build(['<p>[flickr:id=1000,size=thumb]</p>',
+                              '<p>[flickr:id=1000]</p>'],
+                             FLICKR_INSERT_MODE='cache_only')
+
+        self.assertEqual(FakeImageHandler.requests, [])
+        self.assertIn('%s1000_secret_t.jpg' % self.url_base,
+                      content.articles[0]._content)
+        self.assertNotIn(self.url_base, content.articles[1]._content)
+
+    def test_tag_sizes_mirrored(self):
+        FakeImageHandler.images['/1000_secret_t.jpg'] = make_jpeg(100, 67)
+        content = self.build(
+            ['<p>[flickr:id=1000,size=thumb]</p>']).articles[0]._content
+
+        self.assertIn('/1000_secret_t.jpg', FakeImageHandler.requests)
+        self.assertNotIn(self.url_base, content)
+        self.assertIn('width="100"', content)
+
+    def test_indexed_document_mirrored_once_downloads_work(self):
+        contents = ['<p>[flickr:id=1001]</p>']
+        self.assertIn(self.url_base,
+                      self.build(contents).articles[0]._content)
+
+        FakeImageHandler.images['/1001_secret_z.jpg'] = make_jpeg(640, 427)
+        content = self.build(contents).articles[0]._content
+
+        self.assertNotIn(self.url_base, content)
+        self.assertIn('width="640"', content)
+
+    def test_broken_downloads_not_stored(self):
+        def make_opener(error=None, data=b''):
+            def opener(url, timeout):
+                if error is not None:
+                    raise error
+                return io.BytesIO(data)
+            return opener
+
+        for opener in [
+                make_opener(http.client.RemoteDisconnected('closed')),
+                make_opener(http.client.IncompleteRead(b'\xff\xd8')),
+                make_opener(data=b'\x89PNG\r\n\x1a\n\0\0\0\rIHDR\0\0'),
+                make_opener(data=b'GIF89a\x01')]:
+            mirror = flickr_insert.ImageMirror(
+                os.path.join(self.cache_dir, 'store'), self.output_path,
+                '/images', opener=opener)
+            self.assertEqual(mirror.mirror([self.url_base + 'photo.png']), 1)
+            self.assertEqual(mirror.stats['failed'], 1)
+
+    def test_get_image_size(self):
+        self.assertEqual(flickr_insert.get_image_size(make_jpeg(640, 427)),
+                         (640, 427))
+        png = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + \
+            struct.pack('>II', 300, 200)
+        self.assertEqual(flickr_insert.get_image_size(png), (300, 200))
+        self.assertIsNone(flickr_insert.get_image_size(b'not an image'))
+
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.titles = {'1000': 'Photo 0', '1001': 'Photo 1'}
+        self.server = flickr_insert_cache_server.make_server(port=0)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.remote_url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        self.stop_server()
+        shutil.rmtree(self.cache_dir)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # Builds a site with its own local cache, returning its Flickr
+    def build_site(self, name, contents, remote_url=None, **cache_cfg):
+        site_dir = os.path.join(self.cache_dir, name)
+        if not os.path.exists(site_dir):
+            os.mkdir(site_dir)
+        flickr = FakeFlickr(self.titles)
+        cache_cfg.update({'backend': 'remote',
+                          'remote_url': remote_url or self.remote_url,
+                          'remote_timeout': 1})
+        generator = make_generator(contents, site_dir, flickr,
+                                   cache_cfg=cache_cfg)
+        flickr_insert.replace_document_tags(generator)
+        flickr_insert.flush_photo_cache()
+        return flickr, generator
+
+    def test_sites_share_fetched_photos(self):
+        first, _ = self.build_site('first', ['<p>[flickr:id=1000]</p>'])
+        self.assertEqual(first.photos.calls, ['1000'])
+        self.assertEqual(len(self.server.store), 1)
+
+        second, generator = self.build_site(
+            'second', ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>'])
+        self.assertEqual(second.photos.calls, ['1001'])
+        self.assertIn('title="Photo 0"', generator.articles[0]._content)
+        self.assertEqual(len(self.server.store), 2)
+
+        # The second site kept its own copy of what it was sent
+        loaded = flickr_insert.CsvCacheBackend(
+            generator.settings['FLICKR_INSERT_CACHE_CFG']).load()
+        self.assertEqual(sorted(loaded), ['1000', '1001'])
+
+        # Entries the server sent aren't sent back
+        self.assertEqual(self.server.store.stats['puts'], 2)
+
+    def test_sites_keep_their_own_compaction(self):
+        # A busier site has used photo 1000 in many more builds
+        self.server.store.put_many({'1000': {
+            'pic_id': '1000', 'title': 'Photo 0',
+            'insert_image_url_base': 'https://farm9/1000_',
+            'last_updated': int(time.time()), 'next_update': 2 ** 31,
+            'last_seen': 1, 'last_seen_build': 500}})
+
+        contents = ['<p>[flickr:id=1000]</p>\n<p>[flickr:id=1001]</p>']
+        self.build_site('site', contents, evict_after_builds=3)
+        _, generator = self.build_site('site', contents,
+                                       evict_after_builds=3)
+
+        loaded = flickr_insert.CsvCacheBackend(
+            generator.settings['FLICKR_INSERT_CACHE_CFG']).load()
+        self.assertEqual(sorted(loaded), ['1000', '1001'])
+        self.assertEqual([loaded[pic_id]['last_seen_build']
+                          for pic_id in sorted(loaded)], [2, 2])
+        shared = self.server.store.get_many(['1001'])['1001']
+        self.assertNotIn('last_seen_build', shared)
+        self.assertNotIn('last_seen', shared)
+
+    def test_unreachable_server_uses_local_cache(self):
+        self.stop_server()
+        flickr, generator = self.build_site(
+            'offline', ['<p>[flickr:id=1000]</p>'])
+        self.assertEqual(flickr.photos.calls, ['1000'])
+        self.assertIn('title="Photo 0"', generator.articles[0]._content)
+
+    def test_store_keeps_newest_entry(self):
+        store = flickr_insert_cache_server.SharedPhotoStore()
+        store.put_many({'1000': {'pic_id': '1000', 'title': 'New',
+                                 'last_updated': 200}})
+        self.assertEqual(store.put_many(
+            {'1000': {'pic_id': '1000', 'title': 'Old',
+                      'last_updated': 100}}), 0)
+        self.assertEqual(store.get_many(['1000', '1001']),
+                         {'1000': {'pic_id': '1000', 'title': 'New',
+                                   'last_updated': 200}})
+
+
+class TestBulkWarm(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        with open(os.path.join(
+                TEST_DATA_DIR, 'flickr_listings.yaml'), 'r') as f:
+            self.listings = yaml.safe_load(f)
+        self.flickr = FakeFlickr({'1000': 'Not listed'},
+                                 listings=self.listings)
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        shutil.rmtree(self.cache_dir)
+
+    def test_warm_cache_from_listings(self):
+        cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'])
+        cache_cfg['filename'] = os.path.join(self.cache_dir, 'cache.csv')
+        cache = flickr_insert.PhotoCache(cache_cfg)
+        warmed = flickr_insert.warm_cache_from_listings(
+            self.flickr, cache, 1000, cache_cfg,
+            photoset_ids=['72157652839476219'], user_ids=['34299485@N00'],
+            per_page=2)
+
+        self.assertEqual(warmed, 4)
+        self.assertEqual(self.flickr.photosets.calls, [1, 2])
+        self.assertEqual(self.flickr.people.calls, [1])
+        self.assertEqual(cache['18420963172']['title'], 'Sierra sunset')
+        self.assertEqual(
+            cache['16010503393']['insert_image_url_base'],
+            'https://farm9.staticflickr.com/8579/16010503393_7cfe88c078_')
+        self.assertEqual(cache['19112233445']['last_updated'], 1000)
+
+    def test_build_uses_listings_before_getinfo(self):
+        contents = ['<p>[flickr:id=16010503393]</p>',
+                    '<p>[flickr:id=1000]</p>']
+        generator = make_generator(
+            contents, self.cache_dir, self.flickr,
+            FLICKR_INSERT_BULK_WARM={
+                'photoset_ids': ['72157652839476219'], 'per_page': 2})
+
+        flickr_insert.replace_document_tags(generator)
+
+        # Only the photo missing from the album needs its own lookup
+        self.assertEqual(self.flickr.photos.calls, ['1000'])
+        self.assertIn('title="Past Truckee"', generator.articles[0]._content)
+        self.assertIn('title="Not listed"', generator.articles[1]._content)
+
+    def test_build_survives_listing_network_error(self):
+        self.flickr.photosets = FailingFlickrListing(
+            self.listings['photosets.getPhotos'],
+            IOError('connection reset'), fail_page=2)
+        contents = ['<p>[flickr:id=16010503393]</p>',
+                    '<p>[flickr:id=18420963172]</p>']
+        self.flickr.photos.titles['18420963172'] = 'Sierra sunset'
+        generator = make_generator(
+            contents, self.cache_dir, self.flickr,
+            FLICKR_INSERT_BULK_WARM={
+                'photoset_ids': ['72157652839476219'], 'per_page': 2})
+
+        flickr_insert.replace_document_tags(generator)
+
+        # The photo on the page that failed is looked up on its own
+        self.assertEqual(self.flickr.photosets.calls, [1, 2])
+        self.assertEqual(self.flickr.photos.calls, ['18420963172'])
+        self.assertIn('title="Sierra sunset"', generator.articles[1]._content)
+
+    def test_bulk_warm_command(self):
+        cache_file = os.path.join(self.cache_dir, 'cache.csv')
+        flickr_insert.main(['--cache-file', cache_file, 'bulk-warm',
+                            '--user', '34299485@N00', '--per-page', '2'],
+                           flickr_conn=self.flickr)
+
+        cache = flickr_insert.load_cache_from_csv(cache_file,
+                                                  key_name='pic_id')
+        self.assertEqual(sorted(cache), ['16010503393', '19112233445'])
+        self.assertEqual(cache['19112233445']['title'], 'Reno arch')
+
+
+class TestRevalidation(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        with open(os.path.join(
+                TEST_DATA_DIR, 'flickr_listings.yaml'), 'r') as f:
+            self.listings = yaml.safe_load(f)
+        self.flickr = FakeFlickr(
+            {'16010503393': 'Past Truckee', '19112233445': 'Reno arch',
+             '1000': 'Not mine'}, listings=self.listings)
+
+        # Every photo is due a refresh.  The first hasn't changed on Flickr
+        #  since it was cached, the second has and the third belongs to
+        #  someone else
+        cached = {pic_id: {
+            'pic_id': pic_id, 'title': 'Photo ' + pic_id,
+            'insert_image_url_base': 'https://farm9/' + pic_id + '_',
+            'last_changed': 1000, 'last_updated': last_updated,
+            'next_update': 1, 'owner': owner, 'lastupdate': lastupdate}
+            for pic_id, last_updated, owner, lastupdate in [
+                ('16010503393', 1437000000, '34299485@N00', 1436372580),
+                ('19112233445', 1438000000, '34299485@N00', 1436000000),
+                ('1000', 1437000000, '12345678@N00', 1436000000)]}
+        cache_cfg = flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+            'default']
+        flickr_insert.save_cache_to_csv(
+            cached, filename=os.path.join(self.cache_dir, 'cache.csv'),
+            fieldnames=cache_cfg['field_names'], key_name='pic_id')
+        self.contents = ['<p>[flickr:id=%s]</p>' % pic_id
+                         for pic_id in sorted(cached)]
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        shutil.rmtree(self.cache_dir)
+
+    def build(self, **revalidate):
+        revalidate.setdefault('user_ids', ['34299485@N00'])
+        generator = make_generator(self.contents, self.cache_dir, self.flickr,
+                                   FLICKR_INSERT_REVALIDATE=revalidate)
+        start = int(time.time())
+        flickr_insert.replace_document_tags(generator)
+        cache = generator.context['flickr_insert_ctx']['cache']
+        self.assertGreaterEqual(cache['16010503393']['last_updated'], start)
+        self.assertEqual(cache['16010503393']['title'], 'Photo 16010503393')
+        self.assertGreater(cache['16010503393']['next_update'], start)
+        return cache
+
+    def test_unchanged_photos_not_fetched(self):
+        cache = self.build()
+
+        self.assertEqual(sorted(self.flickr.photos.calls),
+                         ['1000', '19112233445'])
+        self.assertEqual(self.flickr.people.calls, [1])
+        self.assertEqual(self.flickr.people.kwargs[0]['extras'],
+                         'last_update')
+        self.assertEqual(cache['19112233445']['title'], 'Reno arch')
+        self.assertEqual(cache['19112233445']['lastupdate'], 1440000000)
+
+    def test_recently_updated(self):
+        self.build(recently_updated=True)
+
+        self.assertEqual(sorted(self.flickr.photos.calls),
+                         ['1000', '19112233445'])
+        self.assertEqual(self.flickr.people.calls, [])
+        self.assertEqual(
+            self.flickr.photos.recentlyUpdated.kwargs[0]['min_date'],
+            1437000000)
+
+    def test_failed_listing_falls_back_to_getinfo(self):
+        self.listings['people.getPhotos'][0] = {'stat': 'fail',
+                                                'message': 'Unavailable'}
+        generator = make_generator(
+            self.contents, self.cache_dir, self.flickr,
+            FLICKR_INSERT_REVALIDATE={'user_ids': ['34299485@N00']})
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(len(self.flickr.photos.calls), 3)
+
+    def test_dropped_connection_falls_back_to_getinfo(self):
+        self.flickr.people = FailingFlickrListing(
+            self.listings['people.getPhotos'], IOError('connection reset'))
+        generator = make_generator(
+            self.contents, self.cache_dir, self.flickr,
+            FLICKR_INSERT_REVALIDATE={'user_ids': ['34299485@N00']})
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(len(self.flickr.photos.calls), 3)
+
+    def test_long_listing_not_paged_through(self):
+        # More pages than the two photos that could be revalidated
+        self.listings['people.getPhotos'][0]['photos']['pages'] = 3
+        self.build()
+
+        self.assertEqual(self.flickr.people.calls, [1])
+        self.assertEqual(sorted(self.flickr.photos.calls),
+                         ['1000', '19112233445'])
+
+    def test_long_recently_updated_listing_not_used(self):
+        self.listings['photos.recentlyUpdated'][0]['photos']['pages'] = 3
+        generator = make_generator(
+            self.contents, self.cache_dir, self.flickr,
+            FLICKR_INSERT_REVALIDATE={'user_ids': ['34299485@N00'],
+                                      'recently_updated': True})
+        flickr_insert.replace_document_tags(generator)
+
+        self.assertEqual(self.flickr.photos.recentlyUpdated.calls, [1])
+        self.assertEqual(len(self.flickr.photos.calls), 3)
+
+
+class TestFlickrClient(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.titles = {'1000': 'Photo 0'}
+
+    def make_client(self, errors, **kwargs):
+        flickr = FakeFlickr(self.titles)
+        flickr.photos = FailingFlickrPhotos(self.titles, errors)
+        client = flickr_insert.FlickrClient(
+            flickr, clock=self.clock, sleep=self.clock.sleep, **kwargs)
+        return flickr, client
+
+    def test_retries_with_backoff(self):
+        error = flickr_insert.flickrapi.exceptions.FlickrError
+        flickr, client = self.make_client(
+            [error('Service unavailable', code=105), IOError('reset')],
+            backoff=1.0)
+
+        info = flickr_insert.get_info_from_flickr(client, '1000')
+
+        self.assertEqual(info['title'], 'Photo 0')
+        self.assertEqual(flickr.photos.calls, ['1000'] * 3)
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(0.5 <= self.clock.sleeps[0] <= 1.0)
+        self.assertTrue(1.0 <= self.clock.sleeps[1] <= 2.0)
+
+        stats = client.get_stats()
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['methods']['photos.getInfo']['calls'], 3)
+
+    def test_photo_not_found_not_retried(self):
+        error = flickr_insert.flickrapi.exceptions.FlickrError
+        flickr, client = self.make_client([error('Photo not found', code=1)])
+
+        info = flickr_insert.get_info_from_flickr(client, '1000')
+
+        self.assertIn('Photo not found', info['flickr_error'])
+        self.assertEqual(client.get_stats()['retries'], 0)
+        self.assertFalse(client.breaker.is_open)
+
+    def test_breaker_opens_and_resets(self):
+        errors = [IOError('timeout')] * 4
+        flickr, client = self.make_client(
+            errors, max_retries=1, breaker_threshold=2, breaker_reset=30)
+
+        flickr_insert.get_info_from_flickr(client, '1000')
+        self.assertTrue(client.breaker.is_open)
+
+        # While open, calls fail immediately without reaching Flickr
+        info = flickr_insert.get_info_from_flickr(client, '1000')
+        self.assertIn('suspended', info['flickr_error'])
+        self.assertEqual(len(flickr.photos.calls), 2)
+        self.assertEqual(client.get_stats()['rejected'], 1)
+
+        # After the reset time a trial call is let through; it fails, so
+        #  the breaker opens again
+        self.clock.now += 31
+        flickr_insert.get_info_from_flickr(client, '1000')
+        self.assertEqual(len(flickr.photos.calls), 3)
+        self.assertTrue(client.breaker.is_open)
+
+        self.clock.now += 31
+        flickr.photos.errors = []
+        info = flickr_insert.get_info_from_flickr(client, '1000')
+        self.assertEqual(info['title'], 'Photo 0')
+        self.assertFalse(client.breaker.is_open)
+
+    def test_rate_limit(self):
+        flickr, client = self.make_client([], rate=2.0, burst=2)
+        for _ in range(6):
+            client.photos.getInfo(photo_id='1000')
+
+        # Two calls are free, then each waits half a second
+        self.assertAlmostEqual(sum(self.clock.sleeps), 2.0)
+
+    def test_build_keeps_stale_entries_on_failure(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache_cfg = dict(
+                flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                    'default'])
+            cache_cfg['filename'] = os.path.join(cache_dir, 'cache.csv')
+            flickr_insert.save_cache_to_csv(
+                {'1000': {'pic_id': '1000', 'title': 'Stale title',
+                          'insert_image_url_base': 'https://stale/1000_',
+                          'next_update': 1}},
+                filename=cache_cfg['filename'],
+                fieldnames=cache_cfg['field_names'], key_name='pic_id')
+
+            flickr, client = self.make_client(
+                [IOError('timeout')] * 10, max_retries=0,
+                breaker_threshold=1)
+            generator = make_generator(['<p>[flickr:id=1000]</p>'],
+                                       cache_dir, client)
+            flickr_insert.replace_document_tags(generator)
+
+            self.assertIn('title="Stale title"',
+                          generator.articles[0]._content)
+            cache = generator.context['flickr_insert_ctx']['cache']
+            self.assertEqual(cache['1000']['next_update'], 1)
+            self.assertEqual(cache['1000']['flickr_error'], 'timeout')
+        finally:
+            flickr_insert.flush_photo_cache()
+            shutil.rmtree(cache_dir)
+
+
+class FakeFlickrRestHandler(http.server.BaseHTTPRequestHandler):
+    # Answers photos.getInfo as Flickr's REST API does, over keep-alive
+    #  connections
+    protocol_version = 'HTTP/1.1'
+    titles = {}
+    delay = 0.0
+    requests = []
+    connections = set()
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(
+            urllib.parse.urlsplit(self.path).query))
+        self.requests.append(query)
+        self.connections.add(self.client_address)
+        time.sleep(self.delay)
+
+        photo_id = query.get('photo_id')
+        if query.get('method') != 'flickr.photos.getInfo':
+            response = {'stat': 'fail', 'code': 112,
+                        'message': 'Method not found'}
+        elif photo_id not in self.titles:
+            response = {'stat': 'fail', 'code': 1,
+                        'message': 'Photo not found'}
+        else:
+            response = FakeFlickrPhotos(self.titles).getInfo(photo_id)
+
+        body = json.dumps(response).encode('utf-8')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up waiting
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAsyncFlickrAPI(unittest.TestCase):
+    def setUp(self):
+        self.titles = {str(1000 + n): 'Photo %d' % n for n in range(20)}
+        FakeFlickrRestHandler.titles = self.titles
+        FakeFlickrRestHandler.delay = 0.0
+        FakeFlickrRestHandler.requests = []
+        FakeFlickrRestHandler.connections = set()
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakeFlickrRestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.endpoint = 'http://127.0.0.1:%d/services/rest/' \
+            % self.server.server_port
+        self.apis = []
+
+    def tearDown(self):
+        for api in self.apis:
+            api.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_api(self, **kwargs):
+        api = flickr_insert.AsyncFlickrAPI('key', endpoint=self.endpoint,
+                                           **kwargs)
+        self.apis.append(api)
+        return api
+
+    def test_info_matches_flickrapi(self):
+        expected = flickr_insert.get_info_from_flickr(
+            FakeFlickr(self.titles), '1000')
+
+        client = flickr_insert.FlickrClient(self.make_api())
+        self.assertEqual(flickr_insert.get_info_from_flickr(client, '1000'),
+                         expected)
+        self.assertEqual(
+            asyncio.run(self.make_api().get_infos(['1000']))['1000'],
+            expected)
+        self.assertEqual(FakeFlickrRestHandler.requests[0], {
+            'method': 'flickr.photos.getInfo', 'api_key': 'key',
+            'photo_id': '1000', 'format': 'json', 'nojsoncallback': '1'})
+
+    def test_connections_pooled_and_pipelined(self):
+        api = self.make_api(pool_size=2, pipeline=4)
+        photo_ids = sorted(self.titles)
+
+        infos = asyncio.run(api.get_infos(photo_ids))
+
+        self.assertEqual([infos[photo_id]['title'] for photo_id in photo_ids],
+                         [self.titles[photo_id] for photo_id in photo_ids])
+        self.assertEqual(len(FakeFlickrRestHandler.connections), 2)
+        self.assertEqual(api.get_stats(),
+                         {'connections': 2, 'requests': 20, 'reused': 18})
+
+    def test_calls_from_threads_share_connections(self):
+        client = flickr_insert.FlickrClient(self.make_api(pool_size=2),
+                                            rate=1000.0)
+        photo_ids = sorted(self.titles)
+
+        infos = flickr_insert.fetch_flickr_infos(client, photo_ids,
+                                                 max_workers=8)
+
+        self.assertEqual(len(infos), 20)
+        self.assertLessEqual(len(FakeFlickrRestHandler.connections), 2)
+        self.assertEqual(client.get_stats()['calls'], 20)
+
+    def test_flickr_errors(self):
+        client = flickr_insert.FlickrClient(self.make_api())
+
+        info = flickr_insert.get_info_from_flickr(client, '999')
+
+        self.assertEqual(info, {'flickr_error': 'Error: 1: Photo not found'})
+        self.assertEqual(client.get_stats()['retries'], 0)
+
+    def test_timeout(self):
+        FakeFlickrRestHandler.delay = 0.5
+        api = self.make_api(timeout=0.1)
+
+        info = asyncio.run(api.get_info('1000'))
+
+        self.assertIn('did not answer', info['flickr_error'])
+
+    def test_get_flickr_client(self):
+        async_cfg = dict(flickr_insert.plugin_settings[
+            'FLICKR_INSERT_ASYNC_CLIENT']['default'])
+        async_cfg.update({'enabled': True, 'endpoint': self.endpoint})
+        try:
+            client = flickr_insert.get_flickr_client('key', 'secret',
+                                                     async_cfg=async_cfg)
+            self.assertIsInstance(client.flickr,
+                                  flickr_insert.AsyncFlickrAPI)
+            self.assertEqual(client.photos.getInfo(
+                photo_id='1001')['photo']['title']['_content'], 'Photo 1')
+        finally:
+            flickr_insert.flush_photo_cache()
+        self.assertIsNone(client.flickr.loop)
+
+
+class TestCacheCommand(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.content_dir = os.path.join(self.cache_dir, 'content')
+        os.makedirs(os.path.join(self.content_dir, 'pages'))
+        with open(os.path.join(self.content_dir, 'post.md'), 'w') as f:
+            f.write('Title: Post\n\n[flickr:id=1000,size=small]\n\n'
+                    '[flickr:url=https://flic.kr/p/%s]\n'
+                    % flickr_insert.shorturl.encode('1001'))
+        with open(os.path.join(self.content_dir, 'pages', 'about.rst'),
+                  'w') as f:
+            f.write('About\n=====\n\n[FLICKR:id=1002]\n')
+        self.titles = {str(1000 + n): 'Photo %d' % n for n in range(4)}
+        self.cache_file = os.path.join(self.cache_dir, 'cache.csv')
+
+    def tearDown(self):
+        flickr_insert.flush_photo_cache()
+        shutil.rmtree(self.cache_dir)
+
+    def run_command(self, *args, **kwargs):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            flickr_insert.main(['--cache-file', self.cache_file] +
+                               list(args), **kwargs)
+        return output.getvalue()
+
+    def load_cache(self):
+        return flickr_insert.load_cache_from_csv(self.cache_file,
+                                                 key_name='pic_id')
+
+    def test_warm_and_refresh(self):
+        flickr = FakeFlickr(self.titles)
+        output = self.run_command('warm', '--content', self.content_dir,
+                                  '--workers', '4', flickr_conn=flickr)
+
+        self.assertIn('refreshed: 3', output)
+        self.assertEqual(sorted(flickr.photos.calls),
+                         ['1000', '1001', '1002'])
+        self.assertEqual(self.load_cache()['1002']['title'], 'Photo 2')
+        self.assertFalse(os.path.exists(self.cache_file + '.tmp'))
+
+        # Nothing is due straight after warming
+        flickr = FakeFlickr(self.titles)
+        output = self.run_command('refresh', flickr_conn=flickr)
+        self.assertIn('checked: 3, refreshed: 0', output)
+        self.assertEqual(flickr.photos.calls, [])
+
+    def test_stats(self):
+        self.run_command('warm', '--content', self.content_dir,
+                         flickr_conn=FakeFlickr(self.titles))
+        output = self.run_command('stats')
+        self.assertIn('Entries: 3', output)
+        self.assertIn('Without Flickr info: 0', output)
+
+    def test_prune(self):
+        sqlite_file = os.path.join(self.cache_dir, 'cache.sqlite3')
+        self.run_command('--cache-backend', 'sqlite', '--sqlite-file',
+                         sqlite_file, 'warm', '--content', self.content_dir,
+                         flickr_conn=FakeFlickr(self.titles))
+        os.remove(os.path.join(self.content_dir, 'pages', 'about.rst'))
+
+        output = self.run_command('--cache-backend', 'sqlite',
+                                  '--sqlite-file', sqlite_file, 'prune',
+                                  '--content', self.content_dir)
+
+        self.assertIn('Removed 1 of 3 entries', output)
+        cache_cfg = dict(
+            flickr_insert.plugin_settings['FLICKR_INSERT_CACHE_CFG'][
+                'default'], sqlite_filename=sqlite_file)
+        self.assertEqual(
+            sorted(flickr_insert.SqliteCacheBackend(cache_cfg).load()),
+            ['1000', '1001'])
+
+    def test_missing_content_directory(self):
+        self.run_command('warm', '--content', self.content_dir,
+                         flickr_conn=FakeFlickr(self.titles))
+        missing_dir = os.path.join(self.cache_dir, 'contnet')
+
+        with redirect_stderr(io.StringIO()):
+            for command in ('prune', 'warm'):
+                with self.assertRaises(SystemExit):
+                    self.run_command(command, '--content', missing_dir,
+                                     flickr_conn=FakeFlickr(self.titles))
+
+        self.assertEqual(sorted(self.load_cache()), ['1000', '1001', '1002'])
+
+    def test_prune_without_tags_needs_force(self):
+        self.run_command('warm', '--content', self.content_dir,
+                         flickr_conn=FakeFlickr(self.titles))
+        empty_dir = os.path.join(self.cache_dir, 'empty')
+        os.makedirs(empty_dir)
+
+        with redirect_stderr(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                self.run_command('prune', '--content', empty_dir)
+        self.assertEqual(len(self.load_cache()), 3)
+
+        output = self.run_command('prune', '--content', empty_dir, '--force')
+
+        self.assertIn('Removed 3 of 3 entries', output)
+        self.assertEqual(self.load_cache(), {})
+
+
 if __name__ == "__main__":
     unittest.main()